@@ -0,0 +1,182 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+from pychmlib.stats import DecodeStats
+
+# the RequestTiming of the request being worked on by each thread
+_local = threading.local()
+
+
+class RequestTiming:
+    """Where the time answering one request went, by phase: lookup of the
+    entry in the archive directory, transcoding and writing to the socket.
+    While it is active in a thread, the blocks read there are also counted
+    in decode, a DecodeStats, from decode_stats of the archives served."""
+
+    def __init__(self, decode_stats):
+        self.phases = {}
+        self.decode = DecodeStats()
+        self._decode_stats = decode_stats
+
+    @contextmanager
+    def phase(self, name):
+        "use as: with timing.phase('write'): write"
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def active(self):
+        "use as: with timing.active(): work on the request in this thread"
+        previous = getattr(_local, "timing", None)
+        _local.timing = self
+        try:
+            with self._decode_stats.counting(self.decode):
+                yield
+        finally:
+            _local.timing = previous
+
+
+def active(timing):
+    "Make timing, if any, active in this thread"
+    return nullcontext() if timing is None else timing.active()
+
+
+def call_active(timing, function, *args):
+    "Call function with timing, if any, active; for use from thread pools"
+    with active(timing):
+        return function(*args)
+
+
+def timed(timing, name):
+    "Time what follows as phase name of timing, if any"
+    return nullcontext() if timing is None else timing.phase(name)
+
+
+def phase(name):
+    "Time what follows as phase name of the request active in this thread"
+    return timed(getattr(_local, "timing", None), name)
+
+
+class AccessLog:
+    """Writes a line of JSON for each request to the file at path, or to
+    standard output for "-". Lines are written by a background thread, so
+    requests do not wait for the file; when max_queue of them are waiting,
+    more are dropped and counted in dropped.
+
+    At high request rates, set sample to the share of requests to time and
+    log. Server errors are logged even when they are not sampled, without
+    timings."""
+
+    def __init__(self, path="-", sample=1.0, max_queue=10000):
+        self.sample = sample
+        self.dropped = 0
+        if path == "-":
+            self._file = sys.stdout
+        else:
+            self._file = open(path, "a", encoding="utf-8")
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name="chm-access-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sampled(self):
+        "Return whether to time and log the next request"
+        return self.sample >= 1 or random.random() < self.sample
+
+    def log(self, client, method, target, response, seconds, timing=None):
+        """Log a request answered with response in seconds. timing is that of
+        a sampled request, None for others."""
+        if timing is None and response.status < 500:
+            return
+        record = (
+            time.time(),
+            client,
+            method,
+            target,
+            response.status,
+            response.headers.get("Content-Type"),
+            response.bytes_sent,
+            seconds,
+            timing,
+        )
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        "Write the lines waiting and close the file"
+        self._queue.put(None)
+        self._thread.join()
+        if self._file is not sys.stdout:
+            self._file.close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                self._file.write(format_record(record) + "\n")
+                if self._queue.empty():
+                    self._file.flush()
+            except (OSError, ValueError):
+                self.dropped += 1
+
+
+def format_record(record):
+    "Return the line of JSON for a record queued by AccessLog.log"
+    now, client, method, target, status, content_type, length, seconds, timing = (
+        record
+    )
+    line = {
+        "time": datetime.fromtimestamp(now, timezone.utc).isoformat(
+            timespec="milliseconds"
+        ),
+        "client": client,
+        "method": method,
+        "path": target,
+        "status": status,
+        "bytes": length,
+        "type": content_type and content_type.split(";")[0],
+        "ms": _ms(seconds),
+    }
+    if timing is not None:
+        decode = timing.decode.stats()
+        phases = timing.phases
+        line["lookup_ms"] = _ms(phases.get("lookup", 0.0))
+        line["decode_ms"] = _ms(decode["seconds"])
+        line["blocks"] = decode["blocks"]
+        line["block_hits"] = decode["block_hits"]
+        line["content_hits"] = decode["content_hits"]
+        line["transcode_ms"] = _ms(phases.get("transcode", 0.0))
+        line["write_ms"] = _ms(phases.get("write", 0.0))
+    return json.dumps(line)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
@@ -0,0 +1,445 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+
+import server
+from accesslog import active, call_active, timed, RequestTiming
+from pychmlib.cancel import CancelToken, Cancelled
+from server import FileBody, Request, error_response, make_site, MAX_BODY_BYTES
+
+HOST = server.HOST
+PORT = server.PORT
+
+# longest request line and headers accepted
+MAX_HEADER_BYTES = 65536
+
+server_instance = None
+
+
+def start(filename, hhc_callback=None, **options):
+    """Serve filename, a CHM file or a directory of them, from an event loop
+    in a background thread. options are passed on to AsyncCHMServer."""
+    global server_instance
+    server_instance = AsyncCHMServer((HOST, PORT), filename, hhc_callback, **options)
+    server_instance.start()
+    return server_instance
+
+
+def stop():
+    global server_instance
+    if server_instance:
+        server_instance.shutdown()
+        server_instance = None
+
+
+class AsyncCHMServer:
+    """Serves one CHM file, or a directory of them, from an asyncio event
+    loop running in its own thread. The loop only parses requests and writes
+    responses: bodies that need reading or decoding are produced by a pool
+    of max_threads threads, so a response that is ready never waits behind
+    a decode. With max_threads=0 they are produced on the loop itself.
+
+    Connections are kept open for up to max_keepalive_requests requests, and
+    closed after keepalive_timeout seconds without one. An idle connection
+    costs no thread, so thousands of them can be open at once. shutdown
+    stops accepting connections and gives responses in progress
+    drain_timeout seconds to finish. With an access_log (see
+    accesslog.AccessLog), requests are logged there. Other options are
+    passed on to make_site."""
+
+    def __init__(
+        self,
+        server_address,
+        chm_filename,
+        hhc_callback=None,
+        max_threads=8,
+        keepalive_timeout=15,
+        max_keepalive_requests=100,
+        drain_timeout=10,
+        access_log=None,
+        **options,
+    ):
+        self.server_address = server_address
+        self.access_log = access_log
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.drain_timeout = drain_timeout
+        self.site = make_site(chm_filename, hhc_callback, **options)
+        self._executor = None
+        if max_threads:
+            self._executor = ThreadPoolExecutor(
+                max_threads, thread_name_prefix="chm-server"
+            )
+        self._loop = None
+        self._thread = None
+        self._server = None
+        # connection task -> True while it is busy with a request
+        self._connections = {}
+        self._stopping = False
+        gauges = self.site.stats.gauges
+        gauges["connections_open"] = lambda: len(self._connections)
+        gauges["connections_busy"] = lambda: sum(self._connections.values())
+
+    def start(self):
+        """Start serving in a background thread, once listening has begun"""
+        _raise_open_file_limit()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._listen(), self._loop).result()
+        except Exception:
+            self._stop_loop()
+            self.site.close()
+            raise
+        host, port = self.server_address[:2]
+        print(f"CHM server started on http://{host}:{port}/")
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result()
+        self._stop_loop()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.site.close()
+        print("CHM server stopped")
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _listen(self):
+        host, port = self.server_address
+        self._server = await asyncio.start_server(
+            self._serve_connection, host, port, backlog=1024, limit=MAX_HEADER_BYTES
+        )
+        self.server_address = self._server.sockets[0].getsockname()
+
+    async def _drain(self):
+        """Stop accepting connections, close the idle ones and wait for the
+        others to finish their response"""
+        self._stopping = True
+        self._server.close()
+        for task, busy in self._connections.items():
+            if not busy:
+                task.cancel()
+        if self._connections:
+            done, pending = await asyncio.wait(
+                list(self._connections), timeout=self.drain_timeout
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = False
+        try:
+            keep_alive = True
+            requests = 0
+            while keep_alive and not self._stopping:
+                try:
+                    head = await asyncio.wait_for(
+                        _read_head(reader), self.keepalive_timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except ValueError as e:
+                    await self._send(writer, "GET", error_response(431, str(e)), False)
+                    break
+                if head is None:
+                    break
+                self._connections[task] = True
+                requests += 1
+                last = requests >= self.max_keepalive_requests
+                keep_alive = await self._serve_request(head, reader, writer, last)
+                self._connections[task] = False
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # closed by shutdown
+            pass
+        except Exception as e:
+            print(f"Error serving connection: {e}")
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _serve_request(self, head, reader, writer, last=False):
+        """Answer the request whose head was read, closing the connection
+        after it if last. Returns whether the connection can be used for
+        another request."""
+        started = time.perf_counter()
+        try:
+            method, target, version, headers = parse_request(head)
+        except ValueError as e:
+            await self._send(writer, "GET", error_response(400, str(e)), False)
+            return False
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = "keep-alive" in connection
+        else:
+            keep_alive = "close" not in connection
+
+        # requests for CHM content have no body, skip over any that is sent
+        if "transfer-encoding" in headers:
+            keep_alive = False
+        elif "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                length = -1
+            if not 0 <= length <= MAX_BODY_BYTES:
+                await self._send(writer, method, error_response(400), False)
+                return False
+            await reader.readexactly(length)
+
+        access_log = self.access_log
+        timing = None
+        if access_log is not None and access_log.sampled():
+            timing = RequestTiming(self.site.stats.decode)
+        if method not in ("GET", "HEAD"):
+            response = error_response(501, f"Unsupported method ({method!r})")
+        else:
+            # stop decoding for a client that has gone, or closed its side
+            token = CancelToken(
+                lambda: writer.transport.is_closing() or reader.at_eof()
+            )
+            request = Request(method, target, headers, token)
+            with active(timing):
+                response = self.site.respond(request)
+            if response.load is not None:
+                if self._executor is None:
+                    response = call_active(timing, self.site.complete, response)
+                else:
+                    response = await self._loop.run_in_executor(
+                        self._executor,
+                        call_active,
+                        timing,
+                        self.site.complete,
+                        response,
+                    )
+                if token.is_cancelled():
+                    response.close()
+                    return False
+        keep_alive = keep_alive and not last and not self._stopping
+        try:
+            return await self._send(
+                writer, method, response, keep_alive, version, timing
+            )
+        finally:
+            seconds = time.perf_counter() - started
+            self.site.stats.request_done(
+                response.headers.get("Content-Type"),
+                response.status,
+                seconds,
+                response.bytes_sent,
+            )
+            if access_log is not None:
+                client = writer.get_extra_info("peername")
+                access_log.log(
+                    client and client[0], method, target, response, seconds, timing
+                )
+
+    async def _send(
+        self, writer, method, response, keep_alive, version="HTTP/1.1", timing=None
+    ):
+        """Write response, timing the writing with timing if any. Returns
+        whether the connection can be used for another request."""
+        status = HTTPStatus(response.status)
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Date: " + formatdate(usegmt=True),
+        ]
+        lines += [f"{name}: {value}" for name, value in response.headers.items()]
+        length = response.get_length()
+        chunked = False
+        if status == 304:
+            pass
+        elif length is not None:
+            lines.append(f"Content-Length: {length}")
+        elif version != "HTTP/1.0":
+            lines.append("Transfer-Encoding: chunked")
+            chunked = True
+        else:
+            # the body ends when the connection does
+            keep_alive = False
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if method == "HEAD" or status == 304:
+            response.close()
+            await writer.drain()
+            return keep_alive
+        if not response.is_streamed():
+            with timed(timing, "write"):
+                writer.write(response.body)
+                await writer.drain()
+            response.bytes_sent = len(response.body)
+            return keep_alive
+        if (
+            isinstance(response.body, FileBody)
+            and response.body.can_sendfile()
+            and writer.get_extra_info("sslcontext") is None
+        ):
+            with timed(timing, "write"):
+                sent = await self._send_file(writer, response.body)
+            if sent is not None:
+                response.bytes_sent = sent
+                return keep_alive
+        sent = await self._send_stream(writer, response, chunked, timing)
+        return sent and keep_alive
+
+    async def _send_file(self, writer, body):
+        """Send body from its file without copying it through Python.
+        Returns the number of bytes sent, or None with body left open if the
+        transport cannot send files: falling back to seeking and reading the
+        archive's file would race with the threads reading it too."""
+        await writer.drain()
+        try:
+            sent = await self._loop.sendfile(
+                writer.transport, body.file, body.offset, body.length, fallback=False
+            )
+        except asyncio.SendfileNotAvailableError:
+            # raised before anything is sent
+            return None
+        except BaseException:
+            body.close()
+            raise
+        body.close()
+        return sent
+
+    async def _send_stream(self, writer, response, chunked, timing=None):
+        """Write a streamed body, producing each chunk in the executor once
+        the previous one is written, with timing active. Returns False if it
+        was cut short."""
+        chunks = iter(response.body)
+        try:
+            while True:
+                if self._executor is None:
+                    chunk = call_active(timing, next, chunks, None)
+                else:
+                    chunk = await self._loop.run_in_executor(
+                        self._executor, call_active, timing, next, chunks, None
+                    )
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                with timed(timing, "write"):
+                    if chunked:
+                        writer.write(b"%x\r\n" % len(chunk))
+                        writer.write(chunk)
+                        writer.write(b"\r\n")
+                    else:
+                        writer.write(chunk)
+                    await writer.drain()
+                response.bytes_sent += len(chunk)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except asyncio.CancelledError:
+            # the executor may still be producing a chunk, leave the body be
+            raise
+        except ConnectionError:
+            response.close()
+            raise
+        except Cancelled:
+            response.close()
+            return False
+        except Exception as e:
+            # too late for an error response, cut the body short instead
+            print(f"Error streaming response: {e}")
+            response.close()
+            return False
+        response.close()
+        return True
+
+
+def parse_request(head):
+    """Split the head of an HTTP/1.x request into method, target, version
+    and a dict of headers with lower case names. Raises ValueError if it is
+    malformed."""
+    lines = head.decode("latin-1").split("\r\n")
+    words = lines[0].split()
+    if len(words) != 3 or not words[2].startswith("HTTP/1."):
+        raise ValueError(f"Bad request line ({lines[0]!r})")
+    method, target, version = words
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, colon, value = line.partition(":")
+        if not colon or not name or name != name.strip():
+            raise ValueError(f"Bad header line ({line!r})")
+        name = name.lower()
+        value = value.strip()
+        if name in headers:
+            value = headers[name] + ", " + value
+        headers[name] = value
+    return method, target, version, headers
+
+
+async def _read_head(reader):
+    """Read the request line and headers, or return None at end of stream"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        # clients may send empty lines between requests
+        while not head.strip():
+            head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise
+        return None
+    except asyncio.LimitOverrunError:
+        raise ValueError("Request header too long")
+    return head.lstrip()
+
+
+def _raise_open_file_limit():
+    """Every open connection holds a file descriptor; raise the soft limit on
+    them as far as the hard limit allows"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 65536
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+if __name__ == "__main__":
+    import sys
+
+    filenames = sys.argv[1:]
+    if filenames:
+        start(filenames.pop())
+        # serve chm files for 30 seconds
+        time.sleep(30)
+        stop()
+    else:
+        print("Please provide a CHM file as parameter")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Benchmark CHM server page-load latency with simultaneous browser-style fetches
+"""
+
+import argparse
+import http.client
+import os
+import sys
+import threading
+import time
+
+import aserver
+import server
+from pychmlib.chm import chm
+from pychmlib.cache import LRUCache
+from pychmlib.sharedcache import SharedBlockCache
+
+
+def pick_page(filename, count):
+    """Pick the largest HTML entry plus the smallest other entries, the way a
+    page with many small images and stylesheets looks to the server"""
+    chm_file = chm(filename)
+    try:
+        files = [ui for ui in chm_file.content_files() if ui.length > 0]
+    finally:
+        chm_file.close()
+    pages = [ui for ui in files if ui.name.endswith((".htm", ".html"))]
+    page = max(pages or files, key=lambda ui: ui.length)
+    resources = sorted(
+        (ui for ui in files if ui is not page), key=lambda ui: ui.length
+    )
+    return [page.name] + [ui.name for ui in resources[: count - 1]]
+
+
+def fetch(port, path):
+    connection = http.client.HTTPConnection(server.HOST, port)
+    connection.request("GET", path)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+
+
+def fetch_all(port, paths, delay=0.01):
+    """Fetch the page, then after delay every other path, each on its own
+    connection and all at the same time. Returns the latency of each request
+    in seconds."""
+    latencies = [None] * len(paths)
+
+    def timed_fetch(i, path):
+        started = time.perf_counter()
+        fetch(port, path)
+        latencies[i] = time.perf_counter() - started
+
+    threads = [
+        threading.Thread(target=timed_fetch, args=(i, path))
+        for i, path in enumerate(paths)
+    ]
+    threads[0].start()
+    time.sleep(delay)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def page_load(port, paths, connections, keep_alive=True):
+    """Fetch paths the way a browser loads a page, each of the connections
+    fetching its share of them in turn. Without keep_alive every request
+    opens a new connection. Returns the time taken in seconds."""
+
+    def load(share):
+        connection = None
+        for path in share:
+            if connection is None:
+                connection = http.client.HTTPConnection(server.HOST, port)
+            headers = {} if keep_alive else {"Connection": "close"}
+            connection.request("GET", path, headers=headers)
+            connection.getresponse().read()
+            if not keep_alive:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    threads = [
+        threading.Thread(target=load, args=(paths[i::connections],))
+        for i in range(connections)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def report(label, latencies):
+    page, resources = latencies[0], sorted(latencies[1:])
+    median = resources[len(resources) // 2] if resources else 0
+    print(
+        f"{label:>22}: page {page * 1000:8.1f} ms, "
+        f"resources median {median * 1000:8.1f} ms, "
+        f"max {max(latencies) * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("chm_file", help="Path to CHM file to serve")
+    parser.add_argument(
+        "--requests", type=int, default=20, help="Simultaneous fetches (default: 20)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Server threads for the concurrent run (default: 8)",
+    )
+    parser.add_argument("--port", type=int, default=8181, help="First port to use")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Decoding processes for the concurrent run (default: 0)",
+    )
+    parser.add_argument(
+        "--asyncio", action="store_true", help="Benchmark the asyncio server"
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.chm_file):
+        print(f"Error: CHM file '{args.chm_file}' not found")
+        sys.exit(1)
+
+    backend = aserver if args.asyncio else server
+    paths = pick_page(args.chm_file, args.requests)
+    print(f"Fetching {len(paths)} entries, page {paths[0]}")
+    for port, threads in enumerate([0, args.threads], args.port):
+        # a fresh server each time. Resources are fetched once so that they are
+        # in the block cache, like the images and stylesheets shared by the
+        # pages of a manual, while the page itself has to be decoded.
+        backend.PORT = port
+        processes = args.processes if threads else 0
+        if processes:
+            block_cache = SharedBlockCache(slots=1024)
+        else:
+            block_cache = LRUCache()
+        backend.start(
+            args.chm_file,
+            max_threads=threads,
+            block_cache=block_cache,
+            decode_processes=processes,
+        )
+        try:
+            for path in paths[1:]:
+                fetch(port, path)
+            latencies = fetch_all(port, paths)
+        finally:
+            backend.stop()
+            if processes:
+                block_cache.close()
+        label = f"{threads} threads" if threads else "serial"
+        if processes:
+            label += f", {processes} processes"
+        report(label, latencies)
+
+    print(f"Loading the {len(paths)} entries again, all cached")
+    backend.PORT = port = args.port + 2
+    backend.start(args.chm_file, max_threads=args.threads, block_cache=LRUCache())
+    try:
+        page_load(port, paths, 1)
+        for label, connections, keep_alive in [
+            ("1 connection", 1, True),
+            ("1 connection per request", 1, False),
+            ("6 connections", 6, True),
+            ("6 at a time, 1 per request", 6, False),
+        ]:
+            best = min(
+                page_load(port, paths, connections, keep_alive) for i in range(5)
+            )
+            print(f"{label:>26}: {best * 1000:8.1f} ms")
+    finally:
+        backend.stop()
+
+
+if __name__ == "__main__":
+    main()
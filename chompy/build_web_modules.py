@@ -18,6 +18,7 @@ def build_chm_viewer_js():
     modules = {
         'pychmlib/chm.py': read_file('pychmlib/chm.py'),
         'pychmlib/lzx.py': read_file('pychmlib/lzx.py'),
+        'pychmlib/sidecar.py': read_file('pychmlib/sidecar.py'),
         'hhc.py': read_file('hhc.py')
     }
     
@@ -4,23 +4,41 @@ Modern CHM file server - serves CHM files via HTTP without Symbian dependencies
 """
 
 import argparse
+import atexit
 import sys
 import os
 import time
 import signal
-from server import start, stop
+import aserver
+import server
+from accesslog import AccessLog
+from warmup import AccessProfile, warm_up
+from server import AdmissionControl, Prefetcher, ResponseCache
+from pychmlib.contentcache import ContentCache
+from pychmlib.scheduler import DecodeScheduler
+from pychmlib.cache import LRUCache
+from pychmlib.sharedcache import SharedBlockCache, open_shared
+
+
+# server or aserver, whichever is serving
+backend = server
 
 
 def signal_handler(sig, frame):
     """Handle Ctrl+C gracefully"""
     print("\nShutting down CHM server...")
-    stop()
+    backend.stop()
     sys.exit(0)
 
 
 def main():
+    global backend
     parser = argparse.ArgumentParser(description="Serve CHM files via HTTP")
-    parser.add_argument("chm_file", help="Path to CHM file to serve")
+    parser.add_argument(
+        "chm_file",
+        help="Path to CHM file to serve, or to a directory of CHM files to "
+        "serve each under /<name>/",
+    )
     parser.add_argument(
         "--host", default="127.0.0.1", help="Host to bind to (default: 127.0.0.1)"
     )
@@ -28,6 +46,166 @@ def main():
         "--port", type=int, default=8081, help="Port to bind to (default: 8081)"
     )
     parser.add_argument("--timeout", type=int, help="Auto-shutdown timeout in seconds")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Requests handled concurrently, 0 for one at a time (default: 8)",
+    )
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=32,
+        help="Connections accepted while all threads are busy (default: 32)",
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=int,
+        default=15,
+        metavar="SECONDS",
+        help="Close connections idle for this long (default: 15)",
+    )
+    parser.add_argument(
+        "--max-keepalive-requests",
+        type=int,
+        default=100,
+        metavar="N",
+        help="Close connections after this many requests (default: 100)",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Serve connections from an asyncio event loop, with --threads "
+        "threads for reading and decoding content",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Decode content in this many worker processes, 0 to decode in "
+        "the server threads (default: 0)",
+    )
+    parser.add_argument(
+        "--max-open",
+        type=int,
+        default=64,
+        metavar="N",
+        help="With a directory, most CHM files kept open at once (default: 64)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=300,
+        metavar="SECONDS",
+        help="With a directory, close CHM files unused for this long "
+        "(default: 300)",
+    )
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        help="Cache parsed archive metadata in a file next to the CHM file",
+    )
+    parser.add_argument(
+        "--content-cache",
+        metavar="DIR",
+        help="Decompress archives once into DIR and serve later reads from there",
+    )
+    parser.add_argument(
+        "--content-cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="Maximum size of the content cache directory (default: 1024)",
+    )
+    parser.add_argument(
+        "--block-cache",
+        type=int,
+        default=32,
+        metavar="MB",
+        help="Memory for decoded LZX blocks, 0 to disable (default: 32)",
+    )
+    parser.add_argument(
+        "--response-cache",
+        type=int,
+        default=16,
+        metavar="MB",
+        help="Memory for responses ready to send, 0 to disable (default: 16)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Read the images, style sheets and linked pages of pages sent "
+        "into the caches in the background",
+    )
+    parser.add_argument(
+        "--max-decodes",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Responses decoded at once, 0 for no admission control; "
+        "requests needing decoding beyond the limits below get a 503 "
+        "(default: 4)",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=64,
+        metavar="N",
+        help="Responses waiting for their turn to be decoded (default: 64)",
+    )
+    parser.add_argument(
+        "--max-decode-bytes",
+        type=int,
+        default=64,
+        metavar="MB",
+        help="Decoded content of the responses in progress (default: 64)",
+    )
+    parser.add_argument(
+        "--access-log",
+        metavar="FILE",
+        help="Log each request as a line of JSON with a breakdown of where "
+        "its time went to FILE, - for standard output",
+    )
+    parser.add_argument(
+        "--access-log-sample",
+        type=float,
+        default=1.0,
+        metavar="RATE",
+        help="Share of requests to log, server errors aside (default: 1.0)",
+    )
+    parser.add_argument(
+        "--admin-token",
+        default=os.environ.get("CHM_ADMIN_TOKEN"),
+        metavar="TOKEN",
+        help="Answer admin requests, such as /__profile?seconds=N, that send "
+        "Authorization: Bearer TOKEN (default: $CHM_ADMIN_TOKEN, or none)",
+    )
+    parser.add_argument(
+        "--warmup",
+        metavar="FILE",
+        help="Keep the most read entries in FILE, and read those saved by the "
+        "last run into the caches in the background on startup",
+    )
+    parser.add_argument(
+        "--warmup-top",
+        type=int,
+        default=200,
+        metavar="N",
+        help="Number of entries kept for warmup (default: 200)",
+    )
+    parser.add_argument(
+        "--warmup-budget",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+        help="CPU time warmup may use on startup (default: 30)",
+    )
+    parser.add_argument(
+        "--shared-block-cache",
+        metavar="NAME",
+        help="Keep decoded blocks in the named shared memory segment, "
+        "shared with other servers using the same name",
+    )
 
     args = parser.parse_args()
 
@@ -39,23 +217,100 @@ def main():
     # Set up signal handler for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
 
-    # Update global host/port if specified
-    import server
+    if args.asyncio:
+        backend = aserver
 
-    server.HOST = args.host
-    server.PORT = args.port
+    # Update global host/port if specified
+    backend.HOST = args.host
+    backend.PORT = args.port
 
     try:
         print(f"Starting CHM server for: {args.chm_file}")
         print(f"Server will be available at: http://{args.host}:{args.port}/")
 
-        server_instance = start(args.chm_file)
+        content_cache = None
+        if args.content_cache:
+            content_cache = ContentCache(
+                args.content_cache, args.content_cache_size * 1024 * 1024
+            )
+
+        block_cache = None
+        if args.shared_block_cache:
+            block_cache = open_shared(
+                args.shared_block_cache, slots=max(args.block_cache, 1) * 32
+            )
+            atexit.register(block_cache.close)
+        elif args.processes and args.block_cache:
+            # share decoded blocks with the worker processes
+            block_cache = SharedBlockCache(slots=args.block_cache * 32)
+            atexit.register(block_cache.close)
+        elif args.block_cache:
+            block_cache = LRUCache(args.block_cache * 1024 * 1024)
+
+        response_cache = None
+        if args.response_cache:
+            response_cache = ResponseCache(args.response_cache * 1024 * 1024)
+
+        prefetcher = None
+        if args.prefetch:
+            prefetcher = Prefetcher()
+            atexit.register(prefetcher.close)
+
+        admission = None
+        if args.max_decodes:
+            admission = AdmissionControl(
+                args.max_decodes, args.max_queued, args.max_decode_bytes * 1024 * 1024
+            )
+
+        access_log = None
+        if args.access_log:
+            access_log = AccessLog(args.access_log, args.access_log_sample)
+            atexit.register(access_log.close)
+
+        access_profile = None
+        if args.warmup:
+            access_profile = AccessProfile(args.warmup, args.warmup_top)
+            atexit.register(access_profile.close)
+
+        scheduler = DecodeScheduler()
+        options = {}
+        if not args.asyncio:
+            options["max_queue"] = args.queue
+
+        server_instance = backend.start(
+            args.chm_file,
+            use_sidecar=args.sidecar,
+            content_cache=content_cache,
+            block_cache=block_cache,
+            max_threads=args.threads,
+            keepalive_timeout=args.keepalive_timeout,
+            max_keepalive_requests=args.max_keepalive_requests,
+            decode_processes=args.processes,
+            response_cache=response_cache,
+            prefetcher=prefetcher,
+            scheduler=scheduler,
+            admission=admission,
+            access_log=access_log,
+            admin_token=args.admin_token,
+            access_profile=access_profile,
+            max_open=args.max_open,
+            idle_timeout=args.idle_timeout,
+            **options,
+        )
+
+        if access_profile is not None and access_profile.previous:
+            warm_up(
+                server_instance.site,
+                access_profile.previous,
+                scheduler,
+                args.warmup_budget,
+            )
 
         if args.timeout:
             print(f"Server will auto-shutdown in {args.timeout} seconds")
             time.sleep(args.timeout)
             print("Timeout reached, shutting down...")
-            stop()
+            backend.stop()
         else:
             print("Press Ctrl+C to stop the server")
             # Keep the main thread alive
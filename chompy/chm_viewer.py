@@ -7,13 +7,15 @@ import os
 import sys
 import argparse
 from pychmlib.chm import chm
+from pychmlib import sidecar
 import hhc
 
 
 class CHMViewer:
-    def __init__(self, filename):
+    def __init__(self, filename, use_sidecar=False):
         try:
-            self.chm_file = chm(filename)
+            sidecar_path = sidecar.default_path(filename) if use_sidecar else None
+            self.chm_file = chm(filename, sidecar_path)
             self.filename = filename
             self.encoding = self.chm_file.encoding
         except Exception as e:
@@ -26,15 +28,26 @@ class CHMViewer:
 
         # Try to get table of contents
         try:
-            hhc_file = self.chm_file.get_hhc()
-            if hhc_file:
-                contents = hhc.parse(hhc_file.get_content())
+            contents = self.get_toc()
+            if contents:
                 self._print_toc(contents)
             else:
                 print("No table of contents found")
         except Exception as e:
             print(f"Error reading table of contents: {e}")
 
+    def get_toc(self):
+        """Return the parsed table of contents, using the sidecar cache if any"""
+        data = self.chm_file.get_cached("toc")
+        if data is not None:
+            return data and hhc.from_data(data)
+        hhc_file = self.chm_file.get_hhc()
+        if not hhc_file:
+            return None
+        contents = hhc.parse(hhc_file.get_content())
+        self.chm_file.set_cached("toc", hhc.to_data(contents))
+        return contents
+
     def _print_toc(self, node, indent=0):
         """Recursively print table of contents"""
         for child in node.children:
@@ -108,6 +121,11 @@ def main():
     )
     parser.add_argument("--output", "-o", help="Output file for extraction")
     parser.add_argument("--extract-all", help="Extract all files to directory")
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        help="Cache parsed archive metadata in a file next to the CHM file",
+    )
 
     args = parser.parse_args()
 
@@ -116,7 +134,7 @@ def main():
         sys.exit(1)
 
     try:
-        viewer = CHMViewer(args.chm_file)
+        viewer = CHMViewer(args.chm_file, args.sidecar)
 
         if args.list:
             viewer.list_contents()
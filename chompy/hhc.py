@@ -121,6 +121,47 @@ def parse(html):
         return root
 
 
+def to_data(node):
+    """converts a parsed table of contents to nested lists of
+    [name, local, children] that can be serialized as JSON"""
+    children = None
+    if node.is_inner_node:
+        children = [to_data(child) for child in node.children]
+    return [node.name, node.local, children]
+
+
+def from_data(data, parent=None):
+    "rebuilds a table of contents converted with to_data"
+    name, local, children = data
+    node = HHCObject()
+    node.type = "text/sitemap"
+    node.name = name
+    node.local = local
+    if parent is None:
+        node.is_root = True
+    else:
+        parent.add_child(node)
+    if children is not None:
+        node._set_as_inner_node()
+        for child in children:
+            from_data(child, node)
+    return node
+
+
+def number(root):
+    """numbers the nodes of a table of contents in document order, starting
+    with 0 for root, and returns them in a list indexed by their id"""
+    nodes = []
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        node.id = len(nodes)
+        nodes.append(node)
+        if node.is_inner_node:
+            pending.extend(reversed(node.children))
+    return nodes
+
+
 if __name__ == "__main__":
     import sys
     from pychmlib.chm import chm
@@ -0,0 +1,152 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from html.parser import HTMLParser
+from bisect import bisect_left
+
+from hhc import _sanitize
+
+# appended to a prefix to get the upper bound of all keys starting with it
+_KEY_MAX = "\U0010ffff"
+
+
+class HHKParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.entries = []
+        self._parents = []
+        self._last_keyword = None
+        self._object = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "object":
+            if dict(attrs).get("type") == "text/sitemap":
+                self._object = {"keyword": None, "title": None, "topics": []}
+        elif tag == "param":
+            if self._object is not None:
+                self._add_param(dict(attrs))
+        elif tag == "ul":
+            # nested lists hold sub-keywords of the last keyword read
+            self._parents.append(self._last_keyword)
+
+    def handle_endtag(self, tag):
+        if tag == "object":
+            obj = self._object
+            self._object = None
+            if obj is not None and obj["keyword"]:
+                parts = [p for p in self._parents if p]
+                parts.append(obj["keyword"])
+                keyword = ", ".join(parts)
+                self.entries.append((keyword, obj["topics"]))
+                self._last_keyword = obj["keyword"]
+        elif tag == "ul":
+            if self._parents:
+                self._last_keyword = self._parents.pop()
+
+    def _add_param(self, param):
+        name = (param.get("name") or "").lower()
+        value = param.get("value")
+        obj = self._object
+        if name == "name":
+            # the first name is the keyword, the rest are topic titles
+            if obj["keyword"] is None:
+                obj["keyword"] = value
+            else:
+                obj["title"] = value
+        elif name == "local":
+            obj["topics"].append((obj["title"] or obj["keyword"], value))
+            obj["title"] = None
+
+
+class HHKIndex:
+    "a sorted keyword table supporting prefix lookup"
+
+    def __init__(self, entries=()):
+        merged = {}
+        for keyword, topics in entries:
+            key = keyword.lower()
+            if key in merged:
+                merged[key][1].extend(topics)
+            else:
+                merged[key] = (keyword, list(topics))
+        keys = sorted(merged)
+        # parallel lists, indexed by position in sort order
+        self.keys = keys
+        self.names = [merged[k][0] for k in keys]
+        self.topics = [merged[k][1] for k in keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def prefix_range(self, prefix):
+        "returns the (start, stop) positions of keywords starting with prefix"
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        if not prefix:
+            return start, len(self.keys)
+        return start, bisect_left(self.keys, prefix + _KEY_MAX, start)
+
+    def lookup(self, prefix, start=0, count=50):
+        """returns the total number of keywords matching prefix and a page of
+        (keyword, topics) tuples, where topics is a list of (title, local)"""
+        lo, hi = self.prefix_range(prefix)
+        first = min(lo + max(start, 0), hi)
+        last = min(first + max(count, 0), hi)
+        page = [(self.names[i], self.topics[i]) for i in range(first, last)]
+        return hi - lo, page
+
+
+def to_data(index):
+    "converts an index to a list of [keyword, topics] that can be serialized as JSON"
+    return [[name, topics] for name, topics in zip(index.names, index.topics)]
+
+
+def from_data(data):
+    "rebuilds an index converted with to_data"
+    return HHKIndex((name, [tuple(t) for t in topics]) for name, topics in data)
+
+
+def parse(html):
+    # Handle both bytes and string input
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="ignore")
+    parser = HHKParser()
+    parser.feed(_sanitize(html))
+    parser.close()
+    return HHKIndex(parser.entries)
+
+
+if __name__ == "__main__":
+    import sys
+    from pychmlib.chm import chm
+
+    args = sys.argv[1:]
+    if args:
+        chm_file = chm(args[0])
+        hhk_file = chm_file.get_hhk()
+        if hhk_file:
+            index = parse(hhk_file.get_content())
+            prefix = args[1] if len(args) > 1 else ""
+            total, page = index.lookup(prefix, count=20)
+            print("%d keywords match %r" % (total, prefix))
+            for keyword, topics in page:
+                print(keyword)
+                for title, local in topics:
+                    print("  " + title + " (" + local + ")")
+        else:
+            print("CHM file contains no HHK file")
+        chm_file.close()
+    else:
+        print("Please provide a CHM file as parameter")
@@ -0,0 +1,268 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from pychmlib.stats import DecodeStats
+
+# upper bounds of the request latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Counts values by the least of bounds they do not exceed, like a
+    Prometheus histogram. Not thread-safe on its own."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_data(self):
+        "Return the count, sum and cumulative count of each bucket"
+        buckets = OrderedDict()
+        total = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            buckets[_bound_label(bound)] = total
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class ServerStats:
+    """Counts the requests a server answers by content type and status, with
+    a histogram of their latency by content type, and the body bytes sent.
+    decode counts the reads and LZX decoding of the archives served.
+
+    gauges maps names to functions returning the current depth of a queue;
+    servers and sites add theirs."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.decode = DecodeStats()
+        self.gauges = OrderedDict()
+        # (content type, status) -> count
+        self._requests = {}
+        # content type -> Histogram
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def request_done(self, content_type, status, seconds, bytes_sent):
+        "Count a request answered in seconds with bytes_sent of body"
+        content_type = (content_type or "none").split(";")[0].strip()
+        with self._lock:
+            key = (content_type, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            latency = self._latency.get(content_type)
+            if latency is None:
+                latency = self._latency[content_type] = Histogram()
+            latency.observe(seconds)
+            self.bytes_sent += bytes_sent
+
+    def snapshot(self):
+        "Return the stats as a dict that can be sent as JSON"
+        with self._lock:
+            requests = OrderedDict()
+            for (content_type, status), count in sorted(self._requests.items()):
+                requests.setdefault(content_type, OrderedDict())[str(status)] = count
+            latency = OrderedDict(
+                (content_type, histogram.to_data())
+                for content_type, histogram in sorted(self._latency.items())
+            )
+            bytes_sent = self.bytes_sent
+        queues = OrderedDict()
+        for name, depth in list(self.gauges.items()):
+            queues[name] = depth()
+        decode = self.decode.stats()
+        return OrderedDict(
+            [
+                ("uptime_seconds", time.time() - self.started),
+                ("requests", requests),
+                ("latency_seconds", latency),
+                ("bytes_sent", bytes_sent),
+                (
+                    "lzx",
+                    {
+                        "blocks_decoded": decode["blocks"],
+                        "decode_seconds": decode["seconds"],
+                    },
+                ),
+                ("queues", queues),
+            ]
+        )
+
+
+def hit_stats(hits, misses):
+    "Return the hits and misses of a cache with its hit ratio"
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0.0,
+    }
+
+
+def to_prometheus(data):
+    """Return a snapshot of ServerStats, with the caches, admission and
+    archives sections sites add to it, in the Prometheus text format"""
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            if labels:
+                label_text = ",".join(
+                    f'{label}="{_escape(label_value)}"' for label, label_value in labels
+                )
+                lines.append(f"{name}{suffix}{{{label_text}}} {_number(value)}")
+            else:
+                lines.append(f"{name}{suffix} {_number(value)}")
+
+    metric(
+        "chm_uptime_seconds",
+        "gauge",
+        "Seconds since the server started.",
+        [("", (), data["uptime_seconds"])],
+    )
+    metric(
+        "chm_requests_total",
+        "counter",
+        "Requests answered, by content type and status.",
+        [
+            ("", (("content_type", content_type), ("status", status)), count)
+            for content_type, statuses in data["requests"].items()
+            for status, count in statuses.items()
+        ],
+    )
+    samples = []
+    for content_type, latency in data["latency_seconds"].items():
+        for bound, count in latency["buckets"].items():
+            samples.append(
+                ("_bucket", (("content_type", content_type), ("le", bound)), count)
+            )
+        samples.append(("_sum", (("content_type", content_type),), latency["sum"]))
+        samples.append(
+            ("_count", (("content_type", content_type),), latency["count"])
+        )
+    metric(
+        "chm_request_duration_seconds",
+        "histogram",
+        "Time from reading a request to sending all of its response.",
+        samples,
+    )
+    metric(
+        "chm_bytes_sent_total",
+        "counter",
+        "Response body bytes sent.",
+        [("", (), data["bytes_sent"])],
+    )
+    metric(
+        "chm_lzx_blocks_decoded_total",
+        "counter",
+        "LZX blocks decoded.",
+        [("", (), data["lzx"]["blocks_decoded"])],
+    )
+    metric(
+        "chm_lzx_decode_seconds_total",
+        "counter",
+        "Time spent decoding LZX blocks.",
+        [("", (), data["lzx"]["decode_seconds"])],
+    )
+    caches = data.get("caches", {})
+    for key, kind, help in (
+        ("hits", "counter", "Cache lookups that found what they looked for."),
+        ("misses", "counter", "Cache lookups that did not."),
+        ("hit_ratio", "gauge", "Share of cache lookups that were hits."),
+    ):
+        suffix = "_total" if kind == "counter" else ""
+        metric(
+            f"chm_cache_{key}{suffix}",
+            kind,
+            help,
+            [("", (("cache", name),), stats[key]) for name, stats in caches.items()],
+        )
+    metric(
+        "chm_queue_depth",
+        "gauge",
+        "Work waiting in each queue.",
+        [("", (("queue", name),), depth) for name, depth in data["queues"].items()],
+    )
+    admission = data.get("admission")
+    if admission:
+        for key, value in admission.items():
+            if key == "rejected":
+                metric(
+                    "chm_admission_rejected_total",
+                    "counter",
+                    "Requests turned away by admission control.",
+                    [("", (), value)],
+                )
+            else:
+                metric(
+                    f"chm_admission_{key}",
+                    "gauge",
+                    "Admission control use and limits.",
+                    [("", (), value)],
+                )
+    metric(
+        "chm_archive_opens_total",
+        "counter",
+        "Times each archive was opened.",
+        [
+            ("", (("archive", name),), count)
+            for name, count in data.get("archives", {}).items()
+        ],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def _bound_label(bound):
+    return "+Inf" if bound == math.inf else f"{bound:g}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
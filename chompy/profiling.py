@@ -0,0 +1,84 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# sort orders of per-request profiles
+PROFILE_SORTS = ("cumulative", "tottime", "calls")
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Look at the stack of every other thread every interval seconds for
+    seconds. Returns how often each stack was seen, by stack: a tuple of
+    the thread name and the functions called, outermost first."""
+    me = threading.get_ident()
+    labels = {}
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while True:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = _label(code)
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(_thread_label(names.get(ident, "unknown")))
+            stack.reverse()
+            counts[tuple(stack)] += 1
+        if time.monotonic() >= deadline:
+            return counts
+        time.sleep(interval)
+
+
+def collapse(counts):
+    """Return stacks counted by sample_stacks in the collapsed format of
+    flame graph tools: a line of frames separated by ; and a count each"""
+    return "".join(
+        f"{';'.join(stack)} {count}\n" for stack, count in sorted(counts.items())
+    )
+
+
+def profile(function, sort="cumulative", limit=40):
+    """Call function under cProfile. Returns its result and a report of the
+    limit functions first in the sort order."""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function)
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats(sort).print_stats(limit)
+    return result, report.getvalue()
+
+
+def _label(code):
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _thread_label(name):
+    # the threads of a pool are told apart by a number, merge them
+    return re.sub(r"_\d+$", "", name).replace(";", ",")
@@ -0,0 +1,45 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class Cancelled(Exception):
+    "raised by a read whose cancellation token has been cancelled"
+
+
+class CancelToken:
+    """tells reads of CHM content to stop decoding. Pass it to get_content,
+    read or stream: it is checked before each LZX block is decoded and,
+    unless the blocks go into a block cache, also before each Huffman tree
+    rebuild within a block. A block being decoded for a block cache is
+    finished, so that it is kept for the next read.
+
+    poll, if given, is called by checks until it returns True, which cancels
+    the token; for instance to find out whether a client has gone."""
+
+    def __init__(self, poll=None):
+        self._poll = poll
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        if not self._cancelled and self._poll is not None and self._poll():
+            self._cancelled = True
+        return self._cancelled
+
+    def check(self):
+        "raises Cancelled if the token is cancelled"
+        if self.is_cancelled():
+            raise Cancelled()
@@ -13,9 +13,16 @@
 # limitations under the License.
 
 
-from struct import unpack, pack
+from struct import unpack, error as struct_error
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
 
 from . import lzx
+from . import sidecar
 
 _CHARSET_TABLE = {
     0x0804: "gbk",
@@ -32,17 +39,47 @@ _CHARSET_TABLE = {
 
 _ITSF_MAX_LENGTH = 0x60
 _ITSP_MAX_LENGTH = 0x54
+# uncompressed content is streamed in pieces of the usual LZX block length
+_STREAM_PIECE_LENGTH = 0x8000
+# reset intervals whose decoding is kept to be continued by later reads
+_KEPT_INTERVALS = 2
 _RESET_TABLE = "::DataSpace/Storage/MSCompressed/Transform/{7FC28940-9D31-11D0-9B27-00A0C91E9C7C}/InstanceData/ResetTable"
 _CONTENT = "::DataSpace/Storage/MSCompressed/Content"
 _LZXC_CONTROLDATA = "::DataSpace/Storage/MSCompressed/ControlData"
 
+_pread = getattr(os, "pread", None)
+
 
 class _CHMFile:
     "a class to manage access to CHM files"
 
-    def __init__(self, filename):
+    sidecar_path = None
+    _sidecar = None
+    _sidecar_data = None
+    _key = None
+    _content_map = None
+    _content_gaps = ()
+    _closed = False
+    # decoded blocks keyed by (identity, block number), see pychmlib.cache
+    block_cache = None
+    # takes turns decoding with other threads, see pychmlib.scheduler
+    scheduler = None
+    # counts reads and decoding, see pychmlib.stats
+    decode_stats = None
+    # guards seek and read on files that do not support positioned reads
+    _seek_lock = threading.Lock()
+
+    def __init__(self, filename, sidecar_path=None):
+        """opens a CHM file. If sidecar_path is given, parsed metadata is
+        read from and saved to that file to speed up later opens."""
         self.filename = filename
+        self.sidecar_path = sidecar_path
         self.file = open(filename, "rb")
+        # reset interval start -> _Interval being decoded
+        self._intervals = OrderedDict()
+        self._intervals_lock = threading.Lock()
+        # guards attaching the content map against closing
+        self._content_lock = threading.Lock()
         self._parse_chm()
 
     def _parse_chm(self):
@@ -51,6 +88,8 @@ class _CHMFile:
             self.encoding = self._get_encoding()
             self.itsp = self._get_ITSP()
             self._dir_offset = self.itsf.dir_offset + self.itsp.length
+            if self.sidecar_path and self._load_sidecar():
+                return
             self.pmgi = self._get_PMGI()
             entry = self.resolve_object(_RESET_TABLE)
             self.lrt = self._get_LRT(entry)
@@ -59,12 +98,90 @@ class _CHMFile:
             self._lzx_block_offset = entry.offset + self.itsf.data_offset
             entry = self.resolve_object(_LZXC_CONTROLDATA)
             self.clcd = self._get_CLCD(entry)
+            if self.sidecar_path:
+                self._save_sidecar()
         except:
             # in case of errors, close file as it will not be used again
             self.file.close()
             raise
 
+    def _get_key(self):
+        if self._key is None:
+            try:
+                stat = os.fstat(self.file.fileno())
+                size, mtime = stat.st_size, stat.st_mtime_ns
+            except (AttributeError, OSError):
+                # not backed by a real file, only the headers identify it
+                size, mtime = 0, 0
+            header = self._get_segment(0, _ITSF_MAX_LENGTH) + self._get_segment(
+                self.itsf.dir_offset, _ITSP_MAX_LENGTH
+            )
+            self._key = (size, mtime, hashlib.sha1(header).digest())
+        return self._key
+
+    def get_identity(self):
+        "returns a string that changes whenever the archive file changes"
+        size, mtime, header_hash = self._get_key()
+        return "%x-%x-%s" % (size, mtime, header_hash.hex()[:16])
+
+    def _load_sidecar(self):
+        try:
+            cache = sidecar.Sidecar(self.sidecar_path)
+        except (OSError, ValueError, KeyError, struct_error):
+            return False
+        if cache.key != self._get_key():
+            cache.close()
+            return False
+        self._sidecar = cache
+        self.pmgi = None
+        self.lrt = _Section()
+        self.lrt.block_length, self.lrt.block_addresses = cache.lrt()
+        self.clcd = _Section()
+        (
+            self.clcd.version,
+            self.clcd.reset_interval,
+            self.clcd.window_size,
+        ) = cache.clcd()
+        self._lzx_block_offset, self._lzx_block_length = cache.content()
+        return True
+
+    def _save_sidecar(self):
+        entries = [
+            (ui.name, ui.compressed, ui.offset, ui.length)
+            for ui in self.enumerate_files()
+        ]
+        return sidecar.write(
+            self.sidecar_path,
+            self._get_key(),
+            (self.lrt.block_length, self.lrt.block_addresses),
+            (self.clcd.version, self.clcd.reset_interval, self.clcd.window_size),
+            (self._lzx_block_offset, self._lzx_block_length),
+            entries,
+            self._sidecar_data,
+        )
+
+    def get_cached(self, name):
+        "returns application data saved in the sidecar file with set_cached"
+        if self._sidecar_data is None:
+            self._sidecar_data = self._sidecar.data() if self._sidecar else {}
+        return self._sidecar_data.get(name)
+
+    def set_cached(self, name, value):
+        """saves JSON serializable application data (e.g. a parsed table of
+        contents) in the sidecar file. Does nothing if no sidecar is used."""
+        if not self.sidecar_path:
+            return
+        self.get_cached(name)
+        self._sidecar_data[name] = value
+        self._save_sidecar()
+
     def enumerate_files(self, condition=None):
+        if self._sidecar:
+            for name, section, offset, length in self._sidecar.entries():
+                ui = UnitInfo(self, name, section, length, offset)
+                if not condition or condition(ui):
+                    yield ui
+            return
         pmgl = self._get_PMGL(self.itsp.first_pmgl_block)
         while pmgl:
             for ui in pmgl.entries():
@@ -96,6 +213,16 @@ class _CHMFile:
             return content
         return None
 
+    def get_hhk(self):
+        def hhk_only(ui):
+            name = ui.name
+            if name.endswith(".hhk"):
+                return True
+
+        for content in self.enumerate_files(hhk_only):
+            return content
+        return None
+
     def all_files(self):
         return self.enumerate_files()
 
@@ -104,6 +231,12 @@ class _CHMFile:
 
     def resolve_object(self, filename):
         filename = filename.lower()
+        if self._sidecar:
+            entry = self._sidecar.find(filename)
+            if entry:
+                name, section, offset, length = entry
+                return UnitInfo(self, name, section, length, offset)
+            return None
         start = self.itsp.first_pmgl_block
         stop = self.itsp.last_pmgl_block
         if self.pmgi:
@@ -125,6 +258,185 @@ class _CHMFile:
                 else:
                     start = pmgl.next_block
 
+    def _read_content(self, offset, length, token=None):
+        """returns length bytes at offset of the decompressed content section.
+        Decoding stops with Cancelled once token, if any, is cancelled."""
+        if length <= 0:
+            return b""
+        end = offset + length
+        content_map = self._content_map
+        if content_map is not None and not self._in_content_gap(offset, end):
+            if self.decode_stats is not None:
+                self.decode_stats.read(True)
+            return content_map[offset:end]
+        return b"".join(self._iter_content(offset, length, token))
+
+    def _iter_content(self, offset, length, token=None):
+        """yields the length bytes at offset of the decompressed content
+        section in pieces of at most one block, each read when asked for"""
+        if length <= 0:
+            return
+        bytes_per_block = self.lrt.block_length
+        end = offset + length
+        content_map = self._content_map
+        content_hit = content_map is not None and not self._in_content_gap(
+            offset, end
+        )
+        if self.decode_stats is not None:
+            self.decode_stats.read(content_hit)
+        if content_hit:
+            for start in range(offset, end, bytes_per_block):
+                yield content_map[start : min(start + bytes_per_block, end)]
+            return
+        for block_no, content in self._iter_blocks(
+            offset // bytes_per_block, (end - 1) // bytes_per_block, token
+        ):
+            block_start = block_no * bytes_per_block
+            yield content[
+                max(offset - block_start, 0) : min(end - block_start, bytes_per_block)
+            ]
+
+    def _needs_decoding(self, offset, length):
+        "whether reading length bytes at offset has LZX blocks to decode"
+        if length <= 0:
+            return False
+        end = offset + length
+        if self._content_map is not None and not self._in_content_gap(offset, end):
+            return False
+        cache = self.block_cache
+        if cache is None:
+            return True
+        identity = self.get_identity()
+        bytes_per_block = self.lrt.block_length
+        last = (end - 1) // bytes_per_block
+        for block_no in range(offset // bytes_per_block, last + 1):
+            if (identity, block_no) not in cache:
+                return True
+        return False
+
+    def _in_content_gap(self, start, end):
+        first = start // self.lrt.block_length
+        last = (end - 1) // self.lrt.block_length
+        for block_no in self._content_gaps:
+            if first <= block_no <= last:
+                return True
+        return False
+
+    def _iter_blocks(self, start_block, end_block, token=None):
+        """yields (block_no, content) for blocks start_block to end_block,
+        taking leading blocks from the block cache and decoding the rest"""
+        cache = self.block_cache
+        if cache is not None:
+            identity = self.get_identity()
+            while start_block <= end_block:
+                content = cache.get((identity, start_block))
+                if content is None:
+                    break
+                if self.decode_stats is not None:
+                    self.decode_stats.block_hit()
+                yield start_block, content
+                start_block += 1
+        if start_block <= end_block:
+            for block in self._decode_blocks(start_block, end_block, token):
+                yield block
+
+    def _decode_blocks(self, start_block, end_block, token=None):
+        """yields (block_no, content) for blocks start_block to end_block,
+        continuing the decoding of their reset intervals, from the start if
+        need be. Every decoded block is added to the block cache."""
+        reset_interval = self.clcd.reset_interval
+        interval = None
+        for block_no in range(start_block, end_block + 1):
+            first = block_no - block_no % reset_interval
+            if interval is None or interval.first != first:
+                interval = self._get_interval(first)
+            yield block_no, self._decode_block(interval, block_no, token)
+
+    def _get_interval(self, first):
+        """returns the decoding of the reset interval starting at block first.
+        With a block cache it is shared: reads of any entries in the interval
+        continue the same decoding, and wait for a block another thread is
+        decoding rather than decoding it again."""
+        if self.block_cache is None:
+            # blocks are not kept, every read decodes its own
+            return _Interval(first)
+        with self._intervals_lock:
+            interval = self._intervals.get(first)
+            if interval is None:
+                interval = self._intervals[first] = _Interval(first)
+                if len(self._intervals) > _KEPT_INTERVALS:
+                    self._intervals.popitem(last=False)
+            else:
+                self._intervals.move_to_end(first)
+            return interval
+
+    def _decode_block(self, interval, block_no, token=None):
+        """returns the content of block_no, continuing the decoding of
+        interval. token is checked before each block; within a block only
+        when there is no block cache to keep it in once it is finished."""
+        cache = self.block_cache
+        lzx_token = token
+        if cache is not None:
+            identity = self.get_identity()
+            lzx_token = None
+        turn = self.scheduler.turn if self.scheduler is not None else nullcontext
+        while True:
+            with interval.lock:
+                if cache is not None:
+                    content = cache.get((identity, block_no))
+                    if content is not None:
+                        if self.decode_stats is not None:
+                            self.decode_stats.block_hit()
+                        return content
+                if interval.block_no == block_no:
+                    return interval.content
+                if interval.block_no > block_no:
+                    # the block has left the cache, start over
+                    interval.reset()
+            # the interval is not held while waiting for a turn, threads of
+            # higher priority reading it would wait behind this one
+            with turn():
+                if token is not None:
+                    token.check()
+                with interval.lock:
+                    if interval.block_no >= block_no:
+                        # decoded meanwhile, or started over
+                        continue
+                    started = time.perf_counter()
+                    try:
+                        interval.block = self._get_lzx_block(
+                            interval.block_no + 1, interval.block, lzx_token
+                        )
+                    except BaseException:
+                        interval.reset()
+                        raise
+                    if self.decode_stats is not None:
+                        self.decode_stats.decoded(time.perf_counter() - started)
+                    interval.block_no += 1
+                    interval.content = bytes(interval.block.content)
+                    if cache is not None:
+                        cache.put((identity, interval.block_no), interval.content)
+                    if interval.block_no == block_no:
+                        return interval.content
+
+    def _get_lzx_segment(self, block):
+        addresses = self.lrt.block_addresses
+        if block < len(addresses) - 1:
+            length = addresses[block + 1] - addresses[block]
+        else:
+            length = self._lzx_block_length - addresses[block]
+        return self._get_segment(self._lzx_block_offset + addresses[block], length)
+
+    def _get_lzx_block(self, block_no, prev_block=None, token=None):
+        return lzx.create_lzx_block(
+            block_no,
+            self.clcd.window_size,
+            self._get_lzx_segment(block_no),
+            self.lrt.block_length,
+            prev_block,
+            token,
+        )
+
     def _get_PMGL(self, start):
         if start == -1:
             return None
@@ -169,8 +481,12 @@ class _CHMFile:
         return self._itsp(self._get_segment(offset, _ITSP_MAX_LENGTH))
 
     def _get_segment(self, start, length):
-        self.file.seek(start)
-        return self.file.read(length)
+        # positioned reads let several threads share one file
+        if _pread and hasattr(self.file, "fileno"):
+            return _pread(self.file.fileno(), length, start)
+        with self._seek_lock:
+            self.file.seek(start)
+            return self.file.read(length)
 
     def _itsf(self, segment):
         section = _Section()
@@ -301,6 +617,14 @@ class _CHMFile:
 
     def close(self):
         self.file.close()
+        with self._content_lock:
+            self._closed = True
+            if self._content_map is not None:
+                self._content_map.close()
+                self._content_map = None
+        if self._sidecar:
+            self._sidecar.close()
+            self._sidecar = None
 
     __del__ = close
 
@@ -309,6 +633,20 @@ class _Section:
     pass
 
 
+class _Interval:
+    "the decoding of a reset interval, up to the last block decoded"
+
+    def __init__(self, first):
+        self.first = first
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.block = None
+        self.block_no = self.first - 1
+        self.content = None
+
+
 class UnitInfo:
 
     def __init__(self, chm, name=None, compressed=False, length=0, offset=0):
@@ -318,15 +656,15 @@ class UnitInfo:
         self.length = length
         self.offset = offset
 
-    def get_content(self):
+    def get_content(self, token=None):
+        """returns the content, decoding it if need be until token, if any,
+        is cancelled (see CancelToken)"""
         if self.compressed == False:
             data = self.chm._get_segment(
                 self.chm.itsf.data_offset + self.offset, self.length
             )
             # For HTML/text content, try to decode as string, otherwise return bytes
-            if self.name.endswith(
-                (".htm", ".html", ".hhc", ".hhk", ".css", ".js", ".txt")
-            ):
+            if self.is_text():
                 try:
                     if isinstance(data, bytes):
                         return data.decode(self.chm.encoding, errors="ignore")
@@ -336,58 +674,58 @@ class UnitInfo:
                     return data
             return data
         else:
-            bytes_per_block = self.chm.lrt.block_length
-            start_block = self.offset // bytes_per_block
-            end_block = (self.offset + self.length) // bytes_per_block
-            start_offset = self.offset % bytes_per_block
-            end_offset = (self.offset + self.length) % bytes_per_block
-            ini_block = start_block - start_block % self.chm.clcd.reset_interval
-            data = [None for i in range(end_block - start_block + 1)]
-            start = ini_block
-            block = self._get_lzx_block(start)
-            while start <= end_block:
-                if start == start_block and start == end_block:
-                    data[0] = block.content[start_offset:end_offset]
-                    break
-                if start == start_block:
-                    data[0] = block.content[start_offset:]
-                if start > start_block and start < end_block:
-                    data[start - start_block] = block.content
-                if start == end_block:
-                    data[start - start_block] = block.content[0:end_offset]
-                    break
-                start += 1
-                if start % self.chm.clcd.reset_interval == 0:
-                    block = self._get_lzx_block(start)
-                else:
-                    block = self._get_lzx_block(start, block)
-            byte_list = self._flatten(data)
-            return pack("B" * len(byte_list), *byte_list)
-
-    def _get_lzx_segment(self, block):
-        addresses = self.chm.lrt.block_addresses
-        if block < len(addresses) - 1:
-            length = addresses[block + 1] - addresses[block]
+            return self.chm._read_content(self.offset, self.length, token)
+
+    def read(self, start, length, token=None):
+        """returns up to length bytes of the content from start, always as
+        bytes. Only the LZX blocks holding them are decoded, starting from the
+        reset interval they are in."""
+        start = max(start, 0)
+        length = min(length, self.length - start)
+        if length <= 0:
+            return b""
+        if self.compressed == False:
+            return self.chm._get_segment(
+                self.chm.itsf.data_offset + self.offset + start, length
+            )
+        return self.chm._read_content(self.offset + start, length, token)
+
+    def stream(self, start=0, length=None, token=None):
+        """yields the bytes read(start, length) returns in pieces of at most
+        one LZX block, so that only one piece needs to be held at a time"""
+        start = max(start, 0)
+        if length is None:
+            length = self.length
+        length = min(length, self.length - start)
+        if self.compressed == False:
+            data_start = self.chm.itsf.data_offset + self.offset
+            end = start + length
+            for offset in range(start, end, _STREAM_PIECE_LENGTH):
+                piece_length = min(_STREAM_PIECE_LENGTH, end - offset)
+                yield self.chm._get_segment(data_start + offset, piece_length)
         else:
-            length = self.chm._lzx_block_length - addresses[block]
-        return self.chm._get_segment(
-            self.chm._lzx_block_offset + addresses[block], length
-        )
+            for piece in self.chm._iter_content(self.offset + start, length, token):
+                yield piece
 
-    def _get_lzx_block(self, block_no, prev_block=None):
-        return lzx.create_lzx_block(
-            block_no,
-            self.chm.clcd.window_size,
-            self._get_lzx_segment(block_no),
-            self.chm.lrt.block_length,
-            prev_block,
+    def get_file_range(self):
+        """returns (file, offset, length) of the content within the CHM file
+        if it is stored there as is, None if it is compressed"""
+        if self.compressed != False:
+            return None
+        return self.chm.file, self.chm.itsf.data_offset + self.offset, self.length
+
+    def is_text(self):
+        "whether get_content returns str rather than bytes"
+        return self.compressed == False and self.name.endswith(
+            (".htm", ".html", ".hhc", ".hhk", ".css", ".js", ".txt")
         )
 
-    def _flatten(self, data):
-        res = []
-        for item in data:
-            res.extend(item)
-        return res
+    def needs_decoding(self):
+        """whether get_content has LZX blocks to decode, as opposed to finding
+        them in the block cache or content cache"""
+        return bool(self.compressed) and self.chm._needs_decoding(
+            self.offset, self.length
+        )
 
     def __repr__(self):
         return self.name
@@ -0,0 +1,234 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import os
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from struct import pack, unpack_from
+
+from .chm import chm
+from .scheduler import BULK, SchedulerBusy
+
+_SUFFIX = ".content"
+_LOCK_SUFFIX = ".lock"
+# ends every materialized file, after the numbers of the blocks in gaps
+_MAGIC = b"CHMC"
+# a lock older than this belongs to a process that died while populating
+_STALE_LOCK_SECONDS = 600
+
+
+class ContentCache:
+    """a directory holding the fully decompressed content section of archives,
+    shared by all processes using the same directory. Once an archive has been
+    materialized, reads of compressed entries are slices of a memory map."""
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path_for(self, chm_file):
+        return os.path.join(self.directory, chm_file.get_identity() + _SUFFIX)
+
+    def attach(self, chm_file, background=True):
+        """makes chm_file read compressed entries from the cache. If the archive
+        has not been materialized yet, it is done now or in a background
+        thread; reads decode as usual until it is done."""
+        if self._attach_existing(chm_file):
+            return True
+        if background:
+            thread = threading.Thread(target=self._populate, args=(chm_file,))
+            thread.daemon = True
+            thread.start()
+            return False
+        return self._populate(chm_file)
+
+    def _attach_existing(self, chm_file):
+        path = self.path_for(chm_file)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return False
+        try:
+            content_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file
+            content_map = None
+        finally:
+            f.close()
+        gaps = _read_gaps(content_map, _content_size(chm_file))
+        if gaps is None:
+            # left by a writer that did not finish, or by another version
+            if content_map is not None:
+                content_map.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False
+        with chm_file._content_lock:
+            if chm_file._closed:
+                # closed while this was being materialized
+                content_map.close()
+                return False
+            chm_file._content_gaps = gaps
+            chm_file._content_map = content_map
+        try:
+            # the modification time records when the file was last used
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def _populate(self, chm_file):
+        path = self.path_for(chm_file)
+        if _content_size(chm_file) > self.max_bytes:
+            return False
+        if not self._lock(path):
+            # another process is materializing this archive
+            return False
+        try:
+            self.materialize(chm_file.filename, path, chm_file.scheduler)
+        finally:
+            self._unlock(path)
+        return self._attach_existing(chm_file)
+
+    def materialize(self, filename, path, scheduler=None):
+        """decompresses the whole content section of filename into path. With
+        a scheduler, blocks are decoded at BULK priority, waiting for their
+        turns however busy it is."""
+        # a separate handle, so that this can run alongside readers
+        source = chm(filename)
+        # the blocks are written out once, keeping them in memory is no use
+        source.block_cache = None
+        source.scheduler = scheduler
+        bulk = nullcontext()
+        if scheduler is not None:
+            bulk = scheduler.priority(BULK, shed=False)
+        try:
+            self.evict(_content_size(source))
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            try:
+                f = os.fdopen(fd, "wb")
+                try:
+                    with bulk:
+                        gaps = _write_content(source, f)
+                    f.write(pack("<%dI" % (len(gaps) + 1), *(gaps + [len(gaps)])))
+                    f.write(_MAGIC)
+                finally:
+                    f.close()
+                os.chmod(tmp, 0o644)
+                # readers only ever see a complete file
+                os.replace(tmp, path)
+            except:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        finally:
+            source.close()
+
+    def evict(self, needed=0):
+        """removes the least recently used materialized archives until needed
+        more bytes fit within max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total + needed <= self.max_bytes:
+                break
+            try:
+                # processes that have it mapped keep their view of it
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def _lock(self, path):
+        lock = path + _LOCK_SUFFIX
+        for attempt in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(lock).st_mtime < _STALE_LOCK_SECONDS:
+                        return False
+                    os.remove(lock)
+                except OSError:
+                    pass
+            except OSError:
+                return False
+        return False
+
+    def _unlock(self, path):
+        try:
+            os.remove(path + _LOCK_SUFFIX)
+        except OSError:
+            pass
+
+
+def _content_size(chm_file):
+    return len(chm_file.lrt.block_addresses) * chm_file.lrt.block_length
+
+
+def _read_gaps(content_map, content_size):
+    """returns the blocks recorded as not decoded at the end of a materialized
+    file, or None if it is not a complete one"""
+    trailer = content_size + 4 + len(_MAGIC)
+    if content_map is None or len(content_map) < trailer:
+        return None
+    if content_map[-len(_MAGIC) :] != _MAGIC:
+        return None
+    (count,) = unpack_from("<I", content_map, len(content_map) - 4 - len(_MAGIC))
+    if len(content_map) != trailer + 4 * count:
+        return None
+    return set(unpack_from("<%dI" % count, content_map, content_size))
+
+
+def _write_content(chm_file, f):
+    """writes every decompressed block to f, one reset interval at a time.
+    Returns the blocks that could not be decoded, which are written as zeros."""
+    block_count = len(chm_file.lrt.block_addresses)
+    block_length = chm_file.lrt.block_length
+    reset_interval = chm_file.clcd.reset_interval
+    gaps = []
+    for start in range(0, block_count, reset_interval):
+        end = min(start + reset_interval, block_count) - 1
+        try:
+            data = [c for n, c in chm_file._decode_blocks(start, end)]
+        except SchedulerBusy:
+            # blocks that could be decoded are not to be published as gaps
+            raise
+        except Exception:
+            # e.g. block types the decoder does not support
+            data = [bytes(block_length) for n in range(start, end + 1)]
+            gaps.extend(range(start, end + 1))
+        f.write(b"".join(data))
+    return gaps
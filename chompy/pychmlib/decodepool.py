@@ -0,0 +1,143 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+from .library import Library
+from . import sharedcache
+from .sharedcache import SharedBlockCache
+
+# contents at least this long come back through shared memory, not the pipe
+SHARED_MEMORY_THRESHOLD = 256 * 1024
+
+# the files opened by a worker process
+_library = None
+
+
+class DecodePool:
+    """reads CHM content in a pool of worker processes, so that entries are
+    decoded on as many cores as there are processes. Each worker opens the
+    files it is asked about itself and keeps them open, with a block cache of
+    cache_bytes. If block_cache is a SharedBlockCache the workers use it
+    instead, so the blocks they decode are also found by this process.
+
+    Content of shm_threshold bytes or more is handed back in a shared memory
+    segment rather than pickled through a pipe. Reads of an entry while it
+    is being read already wait for that read instead of starting another."""
+
+    def __init__(
+        self,
+        processes=None,
+        cache_bytes=32 * 1024 * 1024,
+        block_cache=None,
+        use_sidecar=False,
+        shm_threshold=SHARED_MEMORY_THRESHOLD,
+    ):
+        shared_name = None
+        if isinstance(block_cache, SharedBlockCache):
+            shared_name = block_cache.name
+        self.shm_threshold = shm_threshold
+        # the workers must report their segments to our resource tracker
+        resource_tracker.ensure_running()
+        # forking a process that runs server threads could copy held locks
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(cache_bytes, shared_name, use_sidecar),
+        )
+        # (filename, name) -> Future of the read in progress
+        self._reading = {}
+        self._lock = threading.Lock()
+
+    def read(self, filename, name):
+        """returns what get_content returns for entry name of filename, or
+        None if there is no such entry. Blocks until a worker is done."""
+        key = (filename, name)
+        with self._lock:
+            reading = self._reading.get(key)
+            first = reading is None
+            if first:
+                reading = self._reading[key] = Future()
+        if not first:
+            return reading.result()
+        try:
+            future = self._executor.submit(_read, filename, name, self.shm_threshold)
+            reading.set_result(_receive(future.result()))
+        except BaseException as e:
+            reading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._reading[key]
+        return reading.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class _Shared:
+    "content left in a shared memory segment by a worker"
+
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+
+
+def _init_worker(cache_bytes, shared_name, use_sidecar):
+    global _library
+    block_cache = None
+    if shared_name:
+        # workers report to the resource tracker of the process that created
+        # the segment, so it must stay registered there
+        sharedcache._created.add(shared_name)
+        block_cache = SharedBlockCache(shared_name, create=False)
+    _library = Library(
+        max_open=8,
+        cache_bytes=cache_bytes,
+        block_cache=block_cache,
+        use_sidecar=use_sidecar,
+    )
+
+
+def _read(filename, name, shm_threshold):
+    with _library.archive(filename) as chm_file:
+        ui = chm_file.resolve_object(name)
+        if ui is None:
+            return None
+        content = ui.get_content()
+    if isinstance(content, bytes) and len(content) >= shm_threshold:
+        shm = shared_memory.SharedMemory(create=True, size=len(content))
+        shm.buf[: len(content)] = content
+        shm.close()
+        return _Shared(shm.name, len(content))
+    return content
+
+
+def _receive(result):
+    if not isinstance(result, _Shared):
+        return result
+    shm = shared_memory.SharedMemory(result.name)
+    try:
+        return bytes(shm.buf[: result.length])
+    finally:
+        shm.close()
+        shm.unlink()
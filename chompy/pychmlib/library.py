@@ -0,0 +1,159 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .chm import chm
+from .cache import LRUCache
+from . import sidecar
+
+
+class Library:
+    """a pool of CHM files opened lazily by path. At most max_open files are
+    kept open: the least recently used one is closed to make room, and files
+    not used for idle_timeout seconds are closed in the background. Files in
+    use are never closed, so the pool can briefly grow beyond max_open.
+
+    All files share one block cache, so memory use does not grow with the
+    number of files open."""
+
+    def __init__(
+        self,
+        max_open=64,
+        cache_bytes=64 * 1024 * 1024,
+        idle_timeout=300,
+        block_cache=None,
+        use_sidecar=False,
+        content_cache=None,
+    ):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        if block_cache is None:
+            block_cache = LRUCache(cache_bytes)
+        self.block_cache = block_cache
+        self.use_sidecar = use_sidecar
+        self.content_cache = content_cache
+        # number of times each path has been opened
+        self.open_counts = {}
+        # path -> [chm file, users, last used]
+        self._archives = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if idle_timeout:
+            thread = threading.Thread(target=self._close_idle_loop)
+            thread.daemon = True
+            thread.start()
+
+    def acquire(self, path):
+        """returns the open CHM file for path, opening it if needed. Every
+        call must be matched by a call to release."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._archives.get(path)
+            if entry is not None:
+                self._archives.move_to_end(path)
+                entry[1] += 1
+                entry[2] = time.time()
+                return entry[0]
+        # opening reads from disk, do it without holding up other users
+        chm_file = self._open(path)
+        with self._lock:
+            entry = self._archives.get(path)
+            if entry is not None:
+                # another thread opened it first
+                chm_file.close()
+            else:
+                entry = [chm_file, 0, 0]
+                self._archives[path] = entry
+                self.open_counts[path] = self.open_counts.get(path, 0) + 1
+            self._archives.move_to_end(path)
+            entry[1] += 1
+            entry[2] = time.time()
+            self._close_excess()
+            return entry[0]
+
+    def release(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._archives.get(path)
+            if entry is not None:
+                entry[1] -= 1
+                entry[2] = time.time()
+            self._close_excess()
+
+    @contextmanager
+    def archive(self, path):
+        "use as: with library.archive(path) as chm_file: ..."
+        chm_file = self.acquire(path)
+        try:
+            yield chm_file
+        finally:
+            self.release(path)
+
+    def close_idle(self, now=None):
+        "closes files not used for idle_timeout seconds"
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for path, (chm_file, users, last_used) in list(self._archives.items()):
+                if not users and now - last_used >= self.idle_timeout:
+                    del self._archives[path]
+                    chm_file.close()
+
+    def close(self):
+        "closes every file, including those in use"
+        self._closed.set()
+        with self._lock:
+            for chm_file, users, last_used in self._archives.values():
+                chm_file.close()
+            self._archives.clear()
+
+    def open_files(self):
+        "returns the paths of the files currently open"
+        with self._lock:
+            return list(self._archives)
+
+    def __len__(self):
+        return len(self._archives)
+
+    def __contains__(self, path):
+        "whether the file at path is open"
+        return os.path.abspath(path) in self._archives
+
+    def _open(self, path):
+        sidecar_path = sidecar.default_path(path) if self.use_sidecar else None
+        chm_file = chm(path, sidecar_path)
+        chm_file.block_cache = self.block_cache
+        if self.content_cache:
+            self.content_cache.attach(chm_file)
+        return chm_file
+
+    def _close_excess(self):
+        excess = len(self._archives) - self.max_open
+        for path in list(self._archives):
+            if excess <= 0:
+                break
+            chm_file, users, last_used = self._archives[path]
+            if not users:
+                del self._archives[path]
+                chm_file.close()
+                excess -= 1
+
+    def _close_idle_loop(self):
+        while not self._closed.wait(max(self.idle_timeout / 2.0, 1)):
+            self.close_idle()
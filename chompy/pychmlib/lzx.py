@@ -202,7 +202,9 @@ class _BitBuffer:
         return 1
 
 
-def create_lzx_block(block_no, window, bytes, block_length, prev_block=None):
+def create_lzx_block(
+    block_no, window, bytes, block_length, prev_block=None, token=None
+):
     block = _create_empty_block(window)
     block.block_no = block_no
     if prev_block is None:
@@ -221,6 +223,9 @@ def create_lzx_block(block_no, window, bytes, block_length, prev_block=None):
             lzx_state.intel_file_size = (buf.read_bits(16) << 16) + buf.read_bits(16)
     while block.content_length < block_length:
         if lzx_state.block_remaining == 0:
+            if token is not None:
+                # the trees are rebuilt, a good point to give up
+                token.check()
             lzx_state.type = buf.read_bits(3)
             assert lzx_state.type == 1  # can't handle anything but verbatim
             lzx_state.block_length = (buf.read_bits(16) << 8) + buf.read_bits(8)
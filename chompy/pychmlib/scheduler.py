@@ -0,0 +1,115 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from contextlib import contextmanager
+
+# priorities of decoding work, most urgent first
+INTERACTIVE = 0
+PREFETCH = 1
+BULK = 2
+
+
+class SchedulerBusy(Exception):
+    "raised when too many threads of a priority are waiting for a turn"
+
+
+class DecodeScheduler:
+    """lets threads decoding LZX blocks take turns, one block at a time, so
+    that at most slots blocks are decoded at once and a thread of higher
+    priority never waits for more than the block being decoded. Set it as
+    the scheduler of CHM files, like a block cache.
+
+    A thread that has just had a turn usually wants the next one: threads
+    of lower priority wait linger seconds after it before taking a turn.
+
+    Threads decode at INTERACTIVE priority unless they run in priority().
+    A thread asking for a turn while max_waiting[priority] threads of its
+    priority are waiting already gets SchedulerBusy instead, unless it runs
+    in priority(priority, shed=False); None means no limit."""
+
+    def __init__(self, slots=1, max_waiting=(None, 4, 4), linger=0.002):
+        self.max_waiting = max_waiting
+        self.linger = linger
+        self.blocks = [0, 0, 0]
+        self._free = slots
+        self._waiting = [0, 0, 0]
+        # when the last turn of each priority ended
+        self._ended = [0.0, 0.0, 0.0]
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    @contextmanager
+    def priority(self, priority, shed=True):
+        """use as: with scheduler.priority(BULK): ...
+        With shed=False, the thread waits for its turns however many others
+        are waiting, for work that must not be given up"""
+        previous = self.current_priority(), self._shed()
+        self._local.priority = priority
+        self._local.shed = shed
+        try:
+            yield
+        finally:
+            self._local.priority, self._local.shed = previous
+
+    def current_priority(self):
+        return getattr(self._local, "priority", INTERACTIVE)
+
+    @contextmanager
+    def turn(self):
+        "use as: with scheduler.turn(): decode one block"
+        priority = self.current_priority()
+        with self._condition:
+            delay = self._delay(priority)
+            if delay != 0:
+                limit = self.max_waiting[priority]
+                if limit is not None and self._waiting[priority] >= limit:
+                    if self._shed():
+                        raise SchedulerBusy()
+                self._waiting[priority] += 1
+                try:
+                    while delay != 0:
+                        self._condition.wait(delay)
+                        delay = self._delay(priority)
+                finally:
+                    self._waiting[priority] -= 1
+            self._free -= 1
+            self.blocks[priority] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._free += 1
+                self._ended[priority] = time.monotonic()
+                self._condition.notify_all()
+
+    def waiting(self):
+        "returns the number of threads waiting for a turn, by priority"
+        with self._condition:
+            return list(self._waiting)
+
+    def _shed(self):
+        "whether the current thread may be refused a turn"
+        return getattr(self._local, "shed", True)
+
+    def _delay(self, priority):
+        """returns 0 if a thread of priority may take a turn now, how long
+        to wait before it may, or None if that depends on other threads"""
+        if not self._free or any(self._waiting[:priority]):
+            return None
+        if priority == INTERACTIVE:
+            return 0
+        ended = max(self._ended[:priority])
+        return max(ended + self.linger - time.monotonic(), 0)
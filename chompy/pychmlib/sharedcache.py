@@ -0,0 +1,171 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import time
+from multiprocessing import shared_memory
+from struct import pack_into, unpack_from, calcsize
+from zlib import crc32
+
+_MAGIC = b"PYCHMSHM"
+# magic, number of slots, slot size
+_HEADER = "<8s I I"
+# sequence number, key hash, stamp, length, checksum of the value
+_SLOT_HEADER = "<Q Q Q I I"
+
+# names of the segments created by this process
+_created = set()
+
+
+class SharedBlockCache:
+    """a block cache for _CHMFile.block_cache kept in shared memory, so that
+    blocks decoded by one process are available to every process attached to
+    it by name. It is a fixed table of slots; each key may live in one of two
+    slots, and the one written least recently is replaced.
+
+    Lookups take no locks: every slot carries a sequence number that is odd
+    while it is written, and a checksum of its value. A slot that changed
+    while it was read, or whose checksum does not match, counts as a miss.
+    """
+
+    def __init__(self, name=None, slots=1024, slot_size=32768, create=True):
+        self._slot_length = calcsize(_SLOT_HEADER) + slot_size
+        if create:
+            self._shm = shared_memory.SharedMemory(
+                name, create=True, size=calcsize(_HEADER) + slots * self._slot_length
+            )
+            pack_into(_HEADER, self._shm.buf, 0, _MAGIC, slots, slot_size)
+            _created.add(self._shm.name)
+        else:
+            self._shm = _attach(name)
+            magic, slots, slot_size = unpack_from(_HEADER, self._shm.buf)
+            if magic != _MAGIC:
+                self._shm.close()
+                raise ValueError("not a shared block cache: " + name)
+            self._slot_length = calcsize(_SLOT_HEADER) + slot_size
+        self.name = self._shm.name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_bytes = slots * slot_size
+        self.hits = 0
+        self.misses = 0
+        self._buf = self._shm.buf
+        self._owner = create
+
+    def get(self, key):
+        key_hash = _hash(key)
+        for offset in self._candidates(key_hash):
+            value = self._read(offset, key_hash)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value, size=None):
+        if len(value) > self.slot_size:
+            return
+        key_hash = _hash(key)
+        first, second = self._candidates(key_hash)
+        seq, first_hash, first_stamp = unpack_from("<Q Q Q", self._buf, first)
+        seq, second_hash, second_stamp = unpack_from("<Q Q Q", self._buf, second)
+        if first_hash == key_hash or (
+            second_hash != key_hash and first_stamp <= second_stamp
+        ):
+            self._write(first, key_hash, value)
+        else:
+            self._write(second, key_hash, value)
+
+    def __contains__(self, key):
+        key_hash = _hash(key)
+        for offset in self._candidates(key_hash):
+            seq, slot_hash = unpack_from("<Q Q", self._buf, offset)
+            if not seq & 1 and slot_hash == key_hash:
+                return True
+        return False
+
+    def _candidates(self, key_hash):
+        base = calcsize(_HEADER)
+        return (
+            base + (key_hash % self.slots) * self._slot_length,
+            base + ((key_hash >> 32) % self.slots) * self._slot_length,
+        )
+
+    def _read(self, offset, key_hash):
+        seq, slot_hash, stamp, length, checksum = unpack_from(
+            _SLOT_HEADER, self._buf, offset
+        )
+        if seq & 1 or slot_hash != key_hash:
+            return None
+        start = offset + calcsize(_SLOT_HEADER)
+        value = bytes(self._buf[start : start + length])
+        (after,) = unpack_from("<Q", self._buf, offset)
+        if after != seq or crc32(value) != checksum:
+            return None
+        return value
+
+    def _write(self, offset, key_hash, value):
+        (seq,) = unpack_from("<Q", self._buf, offset)
+        if seq & 1:
+            # another writer is busy with this slot
+            return
+        pack_into("<Q", self._buf, offset, seq + 1)
+        start = offset + calcsize(_SLOT_HEADER)
+        self._buf[start : start + len(value)] = value
+        pack_into(
+            _SLOT_HEADER,
+            self._buf,
+            offset,
+            seq + 2,
+            key_hash,
+            time.time_ns(),
+            len(value),
+            crc32(value),
+        )
+
+    def close(self):
+        "detaches from the shared memory; the creator also frees it"
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+            _created.discard(self.name)
+
+
+def open_shared(name, slots=1024, slot_size=32768):
+    "attaches to the shared block cache called name, creating it if needed"
+    try:
+        return SharedBlockCache(name, slots, slot_size, create=True)
+    except FileExistsError:
+        return SharedBlockCache(name, create=False)
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before Python 3.13 every process that attaches also registers the
+        # segment for removal at exit, which would pull it from under the others
+        from multiprocessing import resource_tracker
+
+        shm = shared_memory.SharedMemory(name)
+        if shm.name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _hash(key):
+    # hash() is randomized per process, this must agree across processes
+    digest = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") | 1
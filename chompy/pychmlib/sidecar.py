@@ -0,0 +1,193 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from struct import pack, unpack_from, calcsize
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+SUFFIX = ".chmcache"
+
+_MAGIC = b"PYCHMSC1"
+# magic, archive size, archive mtime (ns), header hash, number of sections
+_HEADER = "<8s Q q 20s I"
+# tag, offset, length
+_SECTION = "<4s Q Q"
+# name offset, name length, section, offset, length
+_ENTRY = "<I I I Q Q"
+
+_LRT = b"LRT "
+_CLCD = b"CLCD"
+_CONTENT = b"CONT"
+_DIRECTORY = b"DIRE"
+_NAMES = b"NAME"
+_SORTED = b"SORT"
+_DATA = b"DATA"
+
+
+def default_path(filename):
+    return filename + SUFFIX
+
+
+class Sidecar:
+    "read access to the parsed metadata of a CHM file stored in a sidecar file"
+
+    def __init__(self, path):
+        f = open(path, "rb")
+        try:
+            if mmap:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._buf = f.read()
+        finally:
+            f.close()
+        magic, size, mtime, header_hash, count = unpack_from(_HEADER, self._buf)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError("not a sidecar file: " + path)
+        self.key = (size, mtime, header_hash)
+        self._sections = {}
+        pointer = calcsize(_HEADER)
+        for i in range(count):
+            tag, offset, length = unpack_from(_SECTION, self._buf, pointer)
+            self._sections[tag] = (offset, length)
+            pointer += calcsize(_SECTION)
+        self._entry_count = self._sections[_DIRECTORY][1] // calcsize(_ENTRY)
+
+    def lrt(self):
+        "returns the block length and block addresses of the reset table"
+        offset, length = self._sections[_LRT]
+        count = length // 8 - 1
+        result = unpack_from("<%dq" % (count + 1), self._buf, offset)
+        return result[0], result[1:]
+
+    def clcd(self):
+        "returns the version, reset interval and window size of the LZX data"
+        offset, length = self._sections[_CLCD]
+        return unpack_from("<3q", self._buf, offset)
+
+    def content(self):
+        "returns the offset and length of the compressed content section"
+        offset, length = self._sections[_CONTENT]
+        return unpack_from("<2q", self._buf, offset)
+
+    def entries(self):
+        "yields (name, section, offset, length) in directory order"
+        for i in range(self._entry_count):
+            yield self._entry(i)
+
+    def find(self, name):
+        "returns the (name, section, offset, length) entry for name, or None"
+        target = name.encode("utf-8")
+        sorted_offset = self._sections[_SORTED][0]
+        lo, hi = 0, self._entry_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (i,) = unpack_from("<I", self._buf, sorted_offset + mid * 4)
+            current = self._name(i)
+            if current < target:
+                lo = mid + 1
+            elif current > target:
+                hi = mid
+            else:
+                return self._entry(i)
+        return None
+
+    def data(self):
+        "returns the dictionary of application data stored with the archive"
+        offset, length = self._sections.get(_DATA, (0, 0))
+        if not length:
+            return {}
+        return json.loads(bytes(self._buf[offset : offset + length]).decode("utf-8"))
+
+    def _name(self, i):
+        pointer = self._sections[_DIRECTORY][0] + i * calcsize(_ENTRY)
+        name_offset, name_length = unpack_from("<I I", self._buf, pointer)
+        start = self._sections[_NAMES][0] + name_offset
+        return bytes(self._buf[start : start + name_length])
+
+    def _entry(self, i):
+        pointer = self._sections[_DIRECTORY][0] + i * calcsize(_ENTRY)
+        name_offset, name_length, section, offset, length = unpack_from(
+            _ENTRY, self._buf, pointer
+        )
+        return str(self._name(i), "utf-8"), section, offset, length
+
+    def close(self):
+        if mmap and isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+
+def write(path, key, lrt, clcd, content, entries, data=None):
+    """writes a sidecar file atomically, so that concurrent readers either see
+    the old file or the new one. Fails silently if the file cannot be written."""
+    names = []
+    directory = []
+    name_offset = 0
+    for name, section, offset, length in entries:
+        encoded = name.encode("utf-8")
+        directory.append(pack(_ENTRY, name_offset, len(encoded), section, offset, length))
+        names.append(encoded)
+        name_offset += len(encoded)
+    order = sorted(range(len(names)), key=names.__getitem__)
+    block_length, addresses = lrt
+    sections = [
+        (_LRT, pack("<%dq" % (len(addresses) + 1), block_length, *addresses)),
+        (_CLCD, pack("<3q", *clcd)),
+        (_CONTENT, pack("<2q", *content)),
+        (_DIRECTORY, b"".join(directory)),
+        (_NAMES, b"".join(names)),
+        (_SORTED, pack("<%dI" % len(order), *order)),
+    ]
+    if data:
+        sections.append((_DATA, json.dumps(data).encode("utf-8")))
+
+    size, mtime, header_hash = key
+    header = pack(_HEADER, _MAGIC, size, mtime, header_hash, len(sections))
+    offset = len(header) + calcsize(_SECTION) * len(sections)
+    table = []
+    for tag, body in sections:
+        table.append(pack(_SECTION, tag, offset, len(body)))
+        offset += len(body)
+
+    try:
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(path), dir=os.path.dirname(path) or "."
+        )
+    except OSError:
+        return False
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(header)
+            f.write(b"".join(table))
+            for tag, body in sections:
+                f.write(body)
+        finally:
+            f.close()
+        # mkstemp creates private files, but the cache is as public as the archive
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
@@ -0,0 +1,82 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from contextlib import contextmanager
+
+
+class DecodeStats:
+    """counts the reads of compressed content of the CHM files it is set
+    on, as their decode_stats: how many there were, how many were served
+    from a materialized copy (see pychmlib.contentcache), and for the
+    others the blocks found in the block cache and the LZX blocks decoded,
+    with the time that took.
+
+    Within counting(other), what a thread reads is counted in other too;
+    for instance to find out what one request cost."""
+
+    def __init__(self):
+        self.reads = 0
+        self.content_hits = 0
+        self.block_hits = 0
+        self.blocks = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def counting(self, other):
+        "use as: with stats.counting(request_stats): read"
+        previous = getattr(self._local, "other", None)
+        self._local.other = other
+        try:
+            yield
+        finally:
+            self._local.other = previous
+
+    def read(self, content_hit):
+        with self._lock:
+            self.reads += 1
+            if content_hit:
+                self.content_hits += 1
+        other = getattr(self._local, "other", None)
+        if other is not None:
+            other.read(content_hit)
+
+    def block_hit(self):
+        "counts one block found in the block cache"
+        with self._lock:
+            self.block_hits += 1
+        other = getattr(self._local, "other", None)
+        if other is not None:
+            other.block_hit()
+
+    def decoded(self, seconds):
+        "counts one block decoded in seconds"
+        with self._lock:
+            self.blocks += 1
+            self.seconds += seconds
+        other = getattr(self._local, "other", None)
+        if other is not None:
+            other.decoded(seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "reads": self.reads,
+                "content_hits": self.content_hits,
+                "block_hits": self.block_hits,
+                "blocks": self.blocks,
+                "seconds": self.seconds,
+            }
@@ -0,0 +1,125 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from accesslog import AccessLog, RequestTiming, format_record, phase, timed
+from pychmlib.cache import LRUCache
+from pychmlib.chm import chm
+from pychmlib.stats import DecodeStats
+from server import Response
+
+# 2009-02-13 23:31:30.250 UTC
+NOW = 1234567890.25
+
+
+class AccessLogTest(unittest.TestCase):
+    "test cases for AccessLog and format_record"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        self.chm_file.block_cache = LRUCache()
+        self.chm_file.decode_stats = DecodeStats()
+
+    def timing(self):
+        "returns the timing of reading back.jpg and backfwd.jpg"
+        timing = RequestTiming(self.chm_file.decode_stats)
+        with timing.active():
+            with phase("lookup"):
+                ui = self.chm_file.resolve_object("/back.jpg")
+            ui.get_content()
+            # backfwd.jpg is in block 13, decoded for back.jpg
+            self.chm_file.resolve_object("/backfwd.jpg").get_content()
+            with phase("transcode"):
+                pass
+        with timed(timing, "write"):
+            pass
+        # phases outside of any timing are not counted
+        with phase("lookup"):
+            pass
+        return timing
+
+    def test_format(self):
+        content_type = "text/html; charset=utf-8"
+        record = (NOW, "127.0.0.1", "GET", "/a.htm?q=1", 200, content_type)
+        record += (10, 0.0125, None)
+        self.assertEqual(
+            {
+                "time": "2009-02-13T23:31:30.250+00:00",
+                "client": "127.0.0.1",
+                "method": "GET",
+                "path": "/a.htm?q=1",
+                "status": 200,
+                "bytes": 10,
+                "type": "text/html",
+                "ms": 12.5,
+            },
+            json.loads(format_record(record)),
+        )
+
+    def test_format_timing(self):
+        timing = self.timing()
+        record = (NOW, None, "GET", "/back.jpg", 200, "image/jpeg", 22929, 0.5, timing)
+        line = json.loads(format_record(record))
+        self.assertEqual("image/jpeg", line["type"])
+        self.assertEqual(2, line["blocks"])
+        self.assertEqual(1, line["block_hits"])
+        self.assertEqual(0, line["content_hits"])
+        self.assertTrue(line["decode_ms"] > 0)
+        for name in ["lookup_ms", "transcode_ms", "write_ms"]:
+            self.assertTrue(line[name] >= 0)
+            self.assertEqual(
+                round(timing.phases[name[:-3]] * 1000, 3), line[name], name
+            )
+        self.assertEqual(500.0, line["ms"])
+
+    def test_log(self):
+        path = os.path.join(self.dir, "access.log")
+        log = AccessLog(path)
+        self.assertTrue(log.sampled())
+        log.log("127.0.0.1", "GET", "/back.jpg", Response(200), 0.1, self.timing())
+        # requests not sampled are only logged for server errors
+        log.log("127.0.0.1", "GET", "/a.htm", Response(200), 0.1)
+        log.log("127.0.0.1", "GET", "/b.htm", Response(500), 0.1)
+        log.close()
+        with open(path, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(["/back.jpg", "/b.htm"], [line["path"] for line in lines])
+        self.assertEqual(2, lines[0]["blocks"])
+        self.assertFalse("blocks" in lines[1])
+        self.assertEqual(None, lines[1]["type"])
+        self.assertEqual(0, log.dropped)
+
+    def test_sample(self):
+        log = AccessLog(os.path.join(self.dir, "access.log"), sample=0)
+        self.assertFalse(log.sampled())
+        log.close()
+
+    def tearDown(self):
+        self.chm_file.close()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+from struct import calcsize
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.chm import chm
+from pychmlib.cache import LRUCache
+from pychmlib.sharedcache import SharedBlockCache, open_shared, _hash, _SLOT_HEADER
+
+
+class LRUCacheTest(unittest.TestCase):
+    "test cases for LRUCache"
+
+    def test_get_put(self):
+        cache = LRUCache(10)
+        self.assertEqual(None, cache.get("a"))
+        cache.put("a", b"12345")
+        self.assertEqual(b"12345", cache.get("a"))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(5, cache.size)
+
+    def test_eviction(self):
+        cache = LRUCache(10)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        cache.get("a")
+        cache.put("c", b"1234")
+        self.assertEqual(b"1234", cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(8, cache.size)
+        cache.put("d", b"12345678901")
+        self.assertEqual(None, cache.get("d"))
+
+    def test_replace(self):
+        cache = LRUCache(10)
+        cache.put("a", b"1234")
+        cache.put("a", b"12")
+        self.assertEqual(2, cache.size)
+        cache.discard("a")
+        self.assertEqual(0, cache.size)
+
+
+class SharedBlockCacheTest(unittest.TestCase):
+    "test cases for SharedBlockCache"
+
+    def setUp(self):
+        self.cache = SharedBlockCache(slots=8, slot_size=64)
+
+    def test_get_put(self):
+        self.assertEqual(None, self.cache.get(("a", 1)))
+        self.cache.put(("a", 1), b"x" * 64)
+        self.assertEqual(b"x" * 64, self.cache.get(("a", 1)))
+        self.cache.put(("a", 1), b"y")
+        self.assertEqual(b"y", self.cache.get(("a", 1)))
+        self.cache.put(("a", 2), b"z" * 65)
+        self.assertEqual(None, self.cache.get(("a", 2)))
+
+    def test_attach(self):
+        other = open_shared(self.cache.name)
+        self.assertEqual(8, other.slots)
+        self.cache.put(("a", 1), b"shared")
+        self.assertEqual(b"shared", other.get(("a", 1)))
+        other.close()
+
+    def test_corrupt_slot(self):
+        self.cache.put(("a", 1), b"value")
+        for offset in self.cache._candidates(_hash(("a", 1))):
+            start = offset + calcsize(_SLOT_HEADER)
+            self.cache._buf[start : start + 5] = b"VALUE"
+        self.assertEqual(None, self.cache.get(("a", 1)))
+
+    def test_block_cache(self):
+        self.cache.close()
+        self.cache = SharedBlockCache(slots=64, slot_size=32768)
+        chm_file = chm(get_filename("chm_files/CHM-example.chm"))
+        chm_file.block_cache = self.cache
+        ui = chm_file.resolve_object("/design.css")
+        first = ui.get_content()
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(first, ui.get_content())
+        self.assertTrue(self.cache.hits > 0)
+        chm_file.close()
+
+    def tearDown(self):
+        self.cache.close()
+
+
+class BlockCacheTest(unittest.TestCase):
+    "test cases for reading through a block cache"
+
+    def test_cached_content(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        chm_file.block_cache = LRUCache()
+        for name in ["/browstip.htm", "/search.jpg", "/searchbutton.jpg"]:
+            expected = read_file(get_filename("chm_files/" + name[1:]))
+            ui = chm_file.resolve_object(name)
+            self.assertEqual(expected, ui.get_content())
+            hits = chm_file.block_cache.hits
+            self.assertEqual(expected, ui.get_content())
+            self.assertTrue(chm_file.block_cache.hits > hits)
+        chm_file.close()
+
+    def test_shared_decoding(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        chm_file.block_cache = LRUCache()
+        decoded = []
+        get_lzx_block = chm_file._get_lzx_block
+
+        def counting_get_lzx_block(block_no, *args):
+            decoded.append(block_no)
+            return get_lzx_block(block_no, *args)
+
+        chm_file._get_lzx_block = counting_get_lzx_block
+        # entries in the reset interval of blocks 12 and 13
+        names = ["/back.jpg", "/backfwd.jpg", "/browstip.htm", "/cert_def.htm"]
+        barrier = threading.Barrier(len(names))
+        contents = {}
+
+        def read(name):
+            ui = chm_file.resolve_object(name)
+            barrier.wait()
+            contents[name] = ui.get_content()
+
+        threads = [threading.Thread(target=read, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([12, 13], sorted(decoded))
+        for name in ["/back.jpg", "/browstip.htm"]:
+            expected = read_file(get_filename("chm_files/" + name[1:]))
+            self.assertEqual(expected, contents[name])
+        chm_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
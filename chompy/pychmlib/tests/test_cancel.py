@@ -0,0 +1,73 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.cache import LRUCache
+from pychmlib.cancel import CancelToken, Cancelled
+from pychmlib.chm import chm
+
+
+class CancelTokenTest(unittest.TestCase):
+    "test cases for cancelling reads with a CancelToken"
+
+    def setUp(self):
+        self.chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        self.polls = 0
+
+    def poll_twice(self):
+        "cancels the token on the second check"
+        self.polls += 1
+        return self.polls == 2
+
+    def test_cancelled(self):
+        token = CancelToken()
+        token.cancel()
+        self.assertRaises(Cancelled, token.check)
+        ui = self.chm_file.resolve_object("/back.jpg")
+        self.assertRaises(Cancelled, ui.get_content, token)
+        self.assertRaises(Cancelled, list, ui.stream(token=token))
+        # nothing to decode
+        ui = self.chm_file.resolve_object("/#SYSTEM")
+        self.assertEqual(ui.length, len(ui.get_content(token)))
+
+    def test_cancel_within_block(self):
+        # back.jpg spans blocks 12 and 13, the trees are built early in 12
+        ui = self.chm_file.resolve_object("/back.jpg")
+        self.assertRaises(Cancelled, ui.get_content, CancelToken(self.poll_twice))
+        self.assertEqual(2, self.polls)
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        self.assertEqual(expected, ui.get_content())
+
+    def test_cancel_between_blocks(self):
+        cache = self.chm_file.block_cache = LRUCache(64 * 32768)
+        identity = self.chm_file.get_identity()
+        ui = self.chm_file.resolve_object("/back.jpg")
+        self.assertRaises(Cancelled, ui.get_content, CancelToken(self.poll_twice))
+        # the block begun is finished and kept
+        self.assertTrue((identity, 12) in cache)
+        self.assertFalse((identity, 13) in cache)
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        self.assertEqual(expected, ui.get_content())
+
+    def tearDown(self):
+        self.chm_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
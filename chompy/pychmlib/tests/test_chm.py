@@ -20,7 +20,7 @@ from pychmlib.tests.util import *
 
 load_modules()
 
-from chm import chm, UnitInfo
+from pychmlib.chm import chm, UnitInfo
 
 
 class CHMFile1Test(unittest.TestCase):
@@ -191,6 +191,37 @@ class UnitInfoTest(unittest.TestCase):
         assert_unit_info(self, chm_file, "/searchbutton.jpg")
         assert_unit_info(self, chm_file, "/back.jpg")
 
+    def test_read(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        ui = chm_file.resolve_object("/back.jpg")
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        for start, length in [(0, 10), (100, 5000), (22000, 929), (22900, 100)]:
+            self.assertEqual(expected[start : start + length], ui.read(start, length))
+        self.assertEqual(b"", ui.read(len(expected), 10))
+        # uncompressed
+        ui = chm_file.resolve_object("/#SYSTEM")
+        self.assertEqual(ui.get_content()[10:30], ui.read(10, 20))
+        self.assertFalse(ui.is_text())
+
+    def test_file_range(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        self.assertEqual(None, chm_file.resolve_object("/back.jpg").get_file_range())
+        ui = chm_file.resolve_object("/#SYSTEM")
+        file, offset, length = ui.get_file_range()
+        file.seek(offset)
+        self.assertEqual(ui.get_content(), file.read(length))
+
+    def test_stream(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        ui = chm_file.resolve_object("/back.jpg")
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        pieces = list(ui.stream())
+        self.assertEqual(2, len(pieces))
+        self.assertEqual(expected, b"".join(pieces))
+        self.assertEqual(expected[100:30000], b"".join(ui.stream(100, 29900)))
+        ui = chm_file.resolve_object("/#SYSTEM")
+        self.assertEqual(ui.get_content(), b"".join(ui.stream()))
+
 
 def assert_unit_info(test, chm_file, entry_name, test_file=None):
     if not test_file:
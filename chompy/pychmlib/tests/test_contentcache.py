@@ -0,0 +1,134 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from struct import unpack_from
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.chm import chm
+from pychmlib.contentcache import ContentCache
+from pychmlib.scheduler import DecodeScheduler
+
+
+class ContentCacheTest(unittest.TestCase):
+    "test cases for the materialized content cache"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chm = chm(get_filename("chm_files/iexplore.chm"))
+
+    def test_attach(self):
+        cache = ContentCache(self.dir)
+        self.assertTrue(cache.attach(self.chm, background=False))
+        self.assertTrue(os.path.exists(cache.path_for(self.chm)))
+        self.assertNotEqual(None, self.chm._content_map)
+        for name in ["/browstip.htm", "/search.jpg", "/back.jpg", "/DLG_LMZL.htm"]:
+            ui = self.chm.resolve_object(name)
+            expected = read_file(get_filename("chm_files/" + name[1:]))
+            self.assertEqual(expected, ui.get_content())
+
+    def test_attach_existing(self):
+        ContentCache(self.dir).attach(self.chm, background=False)
+        other = chm(get_filename("chm_files/iexplore.chm"))
+        self.assertTrue(ContentCache(self.dir).attach(other, background=False))
+        other.close()
+
+    def test_truncated(self):
+        cache = ContentCache(self.dir)
+        path = cache.path_for(self.chm)
+        for data in [b"", b"\0" * 100]:
+            with open(path, "wb") as f:
+                f.write(data)
+            self.assertFalse(cache._attach_existing(self.chm))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(None, self.chm._content_map)
+        # a bad file is materialized again
+        cache.materialize(self.chm.filename, path)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertTrue(cache.attach(self.chm, background=False))
+        ui = self.chm.resolve_object("/back.jpg")
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        self.assertEqual(expected, ui.get_content())
+
+    def test_closed(self):
+        cache = ContentCache(self.dir)
+        cache.materialize(self.chm.filename, cache.path_for(self.chm))
+        self.chm.close()
+        self.assertFalse(cache.attach(self.chm, background=False))
+        self.assertEqual(None, self.chm._content_map)
+
+    def test_size_limit(self):
+        cache = ContentCache(self.dir, max_bytes=1024)
+        self.assertFalse(cache.attach(self.chm, background=False))
+        self.assertEqual(None, self.chm._content_map)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_evict(self):
+        cache = ContentCache(self.dir)
+        cache.attach(self.chm, background=False)
+        other = chm(get_filename("chm_files/CHM-example.chm"))
+        first = cache.path_for(self.chm)
+        os.utime(first, (1, 1))
+        cache.max_bytes = os.path.getsize(first) + 1
+        self.assertTrue(cache.attach(other, background=False))
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(cache.path_for(other)))
+        other.close()
+
+    def test_locked(self):
+        cache = ContentCache(self.dir)
+        open(cache.path_for(self.chm) + ".lock", "w").close()
+        self.assertFalse(cache.attach(self.chm, background=False))
+        self.assertFalse(os.path.exists(cache.path_for(self.chm)))
+
+    def test_scheduled(self):
+        # more materializations at once than may wait for a turn
+        cache = ContentCache(self.dir)
+        scheduler = DecodeScheduler(max_waiting=(None, 1, 1))
+        filename = get_filename("chm_files/iexplore.chm")
+        paths = [os.path.join(self.dir, "%d.content" % n) for n in range(4)]
+        threads = [
+            threading.Thread(target=cache.materialize, args=(filename, path, scheduler))
+            for path in paths
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.materialize(filename, os.path.join(self.dir, "alone"))
+        expected = self.gaps(os.path.join(self.dir, "alone"))
+        for path in paths:
+            self.assertEqual(expected, self.gaps(path))
+
+    def gaps(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        (count,) = unpack_from("<I", data, len(data) - 8)
+        return unpack_from("<%dI" % count, data, len(data) - 8 - 4 * count)
+
+    def tearDown(self):
+        self.chm.close()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.chm import chm
+from pychmlib.decodepool import DecodePool
+from pychmlib.sharedcache import SharedBlockCache
+
+
+class DecodePoolTest(unittest.TestCase):
+    "test cases for DecodePool"
+
+    def setUp(self):
+        self.filename = get_filename("chm_files/iexplore.chm")
+        self.block_cache = SharedBlockCache(slots=64, slot_size=32768)
+        self.pool = DecodePool(1, block_cache=self.block_cache, shm_threshold=20000)
+
+    def test_read(self):
+        for name in ["/browstip.htm", "/back.jpg", "/search.jpg"]:
+            expected = read_file(get_filename("chm_files/" + name[1:]))
+            self.assertEqual(expected, self.pool.read(self.filename, name))
+        self.assertEqual(None, self.pool.read(self.filename, "/missing.htm"))
+
+    def test_coalesced(self):
+        # reads of an entry while it is being read share that read
+        submitted = []
+        release = threading.Event()
+        submit = self.pool._executor.submit
+
+        def held(*args):
+            submitted.append(args[1:3])
+            release.wait(10)
+            return submit(*args)
+
+        self.pool._executor.submit = held
+        results = []
+
+        def read():
+            results.append(self.pool.read(self.filename, "/back.jpg"))
+
+        threads = [threading.Thread(target=read) for n in range(4)]
+        threads[0].start()
+        while not submitted:
+            threads[0].join(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads[1:]:
+            thread.join(0.05)
+            # waiting for the first read
+            self.assertTrue(thread.is_alive())
+        release.set()
+        for thread in threads:
+            thread.join()
+        expected = read_file(get_filename("chm_files/back.jpg"))
+        self.assertEqual([expected] * 4, results)
+        self.assertEqual([(self.filename, "/back.jpg")], submitted)
+        self.assertEqual({}, self.pool._reading)
+        # a read once it is done starts another
+        self.pool.read(self.filename, "/back.jpg")
+        self.assertEqual(2, len(submitted))
+
+    def test_shared_block_cache(self):
+        chm_file = chm(self.filename)
+        chm_file.block_cache = self.block_cache
+        ui = chm_file.resolve_object("/back.jpg")
+        self.assertTrue(ui.needs_decoding())
+        self.pool.read(self.filename, "/back.jpg")
+        self.assertFalse(ui.needs_decoding())
+        chm_file.close()
+
+    def tearDown(self):
+        self.pool.close()
+        self.block_cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
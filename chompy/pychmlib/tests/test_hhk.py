@@ -0,0 +1,133 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.chm import chm
+import hhk
+
+NESTED = """<ul>
+<li><object type="text/sitemap">
+<param name="Name" value="colors">
+<param name="Local" value="colors.htm">
+</object>
+<ul>
+<li><object type="text/sitemap">
+<param name="Name" value="red">
+<param name="Name" value="Red things">
+<param name="Local" value="red.htm">
+<param name="Name" value="Roses">
+<param name="Local" value="roses.htm">
+</object>
+</ul>
+<li><object type="text/sitemap">
+<param name="Name" value="Colors">
+<param name="Local" value="more.htm">
+</object>
+</ul>"""
+
+
+class HHKIndexTest(unittest.TestCase):
+    "test cases for HHKParser and HHKIndex"
+
+    def setUp(self):
+        self.chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        self.index = hhk.parse(self.chm_file.get_hhk().get_content())
+
+    def test_parse(self):
+        index = hhk.parse(NESTED)
+        self.assertEqual(["colors", "colors, red"], index.names)
+        # keywords differing only in case are merged
+        self.assertEqual(
+            [("colors", "colors.htm"), ("Colors", "more.htm")], index.topics[0]
+        )
+        self.assertEqual(
+            [("Red things", "red.htm"), ("Roses", "roses.htm")], index.topics[1]
+        )
+
+    def test_merge(self):
+        # security, overview is in the index twice
+        total, page = self.index.lookup("security, overview")
+        self.assertEqual(1, total)
+        keyword, topics = page[0]
+        self.assertEqual("security, overview", keyword)
+        locals = [local for title, local in topics]
+        self.assertEqual(["sec_overview.htm", "zone_ovr.htm"], locals[:2])
+        self.assertEqual(["IE_security_privacy_features_FAQ.htm"], locals[2:])
+
+    def test_sub_keywords(self):
+        total, page = self.index.lookup("activex controls", 0, 3)
+        self.assertEqual(10, total)
+        self.assertEqual(
+            [
+                "ActiveX controls",
+                "ActiveX controls, active content and ActiveX controls",
+                "ActiveX controls, ActiveX add-ons",
+            ],
+            [keyword for keyword, topics in page],
+        )
+
+    def test_prefix_range(self):
+        self.assertEqual(1097, len(self.index))
+        self.assertEqual((0, 1097), self.index.prefix_range(""))
+        self.assertEqual((1097, 1097), self.index.prefix_range("zzz"))
+        self.assertEqual((1092, 1097), self.index.prefix_range("Zooming"))
+        start, stop = self.index.prefix_range("activex")
+        self.assertEqual(10, stop - start)
+
+    def test_last_key(self):
+        example = chm(get_filename("chm_files/CHM-example.chm"))
+        index = hhk.parse(example.get_hhk().get_content())
+        example.close()
+        self.assertEqual("XP", index.names[-1])
+        total, page = index.lookup("xp")
+        self.assertEqual(1, total)
+        self.assertEqual("XP", page[0][0])
+        self.assertEqual((len(index), len(index)), index.prefix_range("xq"))
+
+    def test_paging(self):
+        total, page = self.index.lookup("activex", 2, 3)
+        self.assertEqual(10, total)
+        self.assertEqual(
+            [
+                "ActiveX controls, ActiveX add-ons",
+                "ActiveX controls, blocked ActiveX control installations, what to do",
+                "ActiveX controls, browser add-ons",
+            ],
+            [keyword for keyword, topics in page],
+        )
+        total, page = self.index.lookup("activex", 9, 3)
+        self.assertEqual(1, len(page))
+        self.assertEqual((10, []), self.index.lookup("activex", 1000, 3))
+        self.assertEqual((10, []), self.index.lookup("activex", 0, 0))
+        total, page = self.index.lookup("activex", -5, 1)
+        self.assertEqual("ActiveX controls", page[0][0])
+        self.assertEqual((0, []), self.index.lookup("no such keyword"))
+
+    def test_data(self):
+        index = hhk.from_data(hhk.to_data(self.index))
+        self.assertEqual(self.index.names, index.names)
+        self.assertEqual(self.index.topics, index.topics)
+
+    def tearDown(self):
+        self.chm_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
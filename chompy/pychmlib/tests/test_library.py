@@ -0,0 +1,83 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.library import Library
+
+
+class LibraryTest(unittest.TestCase):
+    "test cases for Library"
+
+    def setUp(self):
+        self.library = Library(max_open=1, idle_timeout=0)
+        self.example = get_filename("chm_files/CHM-example.chm")
+        self.iexplore = get_filename("chm_files/iexplore.chm")
+
+    def test_reuse(self):
+        with self.library.archive(self.example) as first:
+            with self.library.archive(self.example) as second:
+                self.assertTrue(first is second)
+        self.assertEqual(1, len(self.library))
+        self.assertEqual(1, list(self.library.open_counts.values())[0])
+        self.assertTrue(self.example in self.library)
+        self.assertFalse(self.iexplore in self.library)
+
+    def test_shared_block_cache(self):
+        with self.library.archive(self.example) as chm_file:
+            self.assertTrue(chm_file.block_cache is self.library.block_cache)
+            assert_content(self, chm_file, "/design.css")
+        with self.library.archive(self.iexplore) as chm_file:
+            assert_content(self, chm_file, "/back.jpg")
+        self.assertTrue(self.library.block_cache.size > 0)
+
+    def test_max_open(self):
+        with self.library.archive(self.example) as example:
+            # in use, so it stays open
+            with self.library.archive(self.iexplore):
+                self.assertEqual(2, len(self.library))
+            self.assertEqual(1, len(self.library))
+        self.library.acquire(self.iexplore)
+        self.library.release(self.iexplore)
+        self.assertEqual(1, len(self.library))
+        self.assertTrue(example.file.closed)
+
+    def test_close_idle(self):
+        self.library.idle_timeout = 60
+        chm_file = self.library.acquire(self.example)
+        self.library.close_idle(time.time() + 120)
+        self.assertEqual(1, len(self.library))
+        self.library.release(self.example)
+        self.library.close_idle(time.time() + 30)
+        self.assertEqual(1, len(self.library))
+        self.library.close_idle(time.time() + 120)
+        self.assertEqual(0, len(self.library))
+        self.assertTrue(chm_file.file.closed)
+
+    def tearDown(self):
+        self.library.close()
+
+
+def assert_content(test, chm_file, name):
+    expected = read_file(get_filename("chm_files/" + name[1:]))
+    test.assertEqual(expected, chm_file.resolve_object(name).get_content())
+
+
+if __name__ == "__main__":
+    unittest.main()
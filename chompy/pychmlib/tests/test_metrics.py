@@ -0,0 +1,136 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from metrics import Histogram, ServerStats, hit_stats, to_prometheus
+
+
+class HistogramTest(unittest.TestCase):
+    "test cases for Histogram"
+
+    def test_bounds(self):
+        histogram = Histogram((0.1, 1.0))
+        # a value on a bound is counted in its bucket
+        for value in [0, 0.1, 0.10001, 1.0, 1.5, 100]:
+            histogram.observe(value)
+        self.assertEqual([2, 2, 2], histogram.counts)
+        data = histogram.to_data()
+        self.assertEqual(6, data["count"])
+        self.assertAlmostEqual(102.70001, data["sum"])
+        buckets = list(data["buckets"].items())
+        self.assertEqual([("0.1", 2), ("1", 4), ("+Inf", 6)], buckets)
+
+    def test_default_bounds(self):
+        buckets = Histogram().to_data()["buckets"]
+        self.assertEqual("0.001", list(buckets)[0])
+        self.assertEqual("0.0025", list(buckets)[1])
+        self.assertEqual(["10", "+Inf"], list(buckets)[-2:])
+
+
+class ServerStatsTest(unittest.TestCase):
+    "test cases for ServerStats"
+
+    def test_snapshot(self):
+        stats = ServerStats()
+        stats.gauges["prefetch"] = lambda: 3
+        stats.request_done("text/html; charset=utf-8", 200, 0.002, 100)
+        stats.request_done("text/html", 200, 0.02, 50)
+        stats.request_done("text/html", 304, 0.0001, 0)
+        stats.request_done(None, 404, 0.5, 10)
+        data = stats.snapshot()
+        self.assertEqual(
+            {"none": {"404": 1}, "text/html": {"200": 2, "304": 1}}, data["requests"]
+        )
+        self.assertEqual(["none", "text/html"], list(data["latency_seconds"]))
+        buckets = data["latency_seconds"]["text/html"]["buckets"]
+        self.assertEqual(1, buckets["0.001"])
+        self.assertEqual(2, buckets["0.0025"])
+        self.assertEqual(3, buckets["+Inf"])
+        self.assertEqual(160, data["bytes_sent"])
+        self.assertEqual({"prefetch": 3}, data["queues"])
+        self.assertEqual(0, data["lzx"]["blocks_decoded"])
+
+    def test_hit_stats(self):
+        self.assertEqual(0.0, hit_stats(0, 0)["hit_ratio"])
+        self.assertEqual({"hits": 3, "misses": 1, "hit_ratio": 0.75}, hit_stats(3, 1))
+
+
+class PrometheusTest(unittest.TestCase):
+    "test cases for to_prometheus"
+
+    def setUp(self):
+        stats = ServerStats()
+        stats.gauges["prefetch"] = lambda: 2
+        stats.request_done("image/jpeg", 200, 0.003, 1000)
+        stats.request_done("image/jpeg", 503, 20, 0)
+        self.data = stats.snapshot()
+        self.data["uptime_seconds"] = 1.5
+        self.data["caches"] = {"block": hit_stats(3, 1)}
+        self.data["admission"] = {"queued": 1, "rejected": 4}
+        self.data["archives"] = {'a "b"\\c\nd': 2}
+
+    def test_format(self):
+        text = to_prometheus(self.data)
+        self.assertTrue(text.endswith("\n"))
+        lines = text.splitlines()
+        for line in [
+            "# HELP chm_uptime_seconds Seconds since the server started.",
+            "# TYPE chm_uptime_seconds gauge",
+            "chm_uptime_seconds 1.5",
+            "# TYPE chm_requests_total counter",
+            'chm_requests_total{content_type="image/jpeg",status="200"} 1',
+            'chm_requests_total{content_type="image/jpeg",status="503"} 1',
+            "chm_bytes_sent_total 1000",
+            "chm_lzx_blocks_decoded_total 0",
+            "chm_lzx_decode_seconds_total 0.0",
+            'chm_cache_hits_total{cache="block"} 3',
+            'chm_cache_misses_total{cache="block"} 1',
+            'chm_cache_hit_ratio{cache="block"} 0.75',
+            'chm_queue_depth{queue="prefetch"} 2',
+            "chm_admission_queued 1",
+            "# TYPE chm_admission_rejected_total counter",
+            "chm_admission_rejected_total 4",
+            'chm_archive_opens_total{archive="a \\"b\\"\\\\c\\nd"} 2',
+        ]:
+            self.assertTrue(line in lines, line)
+
+    def test_histogram(self):
+        lines = to_prometheus(self.data).splitlines()
+        name = "chm_request_duration_seconds"
+        self.assertTrue(f"# TYPE {name} histogram" in lines)
+        samples = [line for line in lines if line.startswith(name)]
+        labels = 'content_type="image/jpeg"'
+        self.assertEqual(f'{name}_bucket{{{labels},le="0.001"}} 0', samples[0])
+        self.assertEqual(f'{name}_bucket{{{labels},le="0.005"}} 1', samples[2])
+        self.assertEqual(f'{name}_bucket{{{labels},le="10"}} 1', samples[-4])
+        self.assertEqual(f'{name}_bucket{{{labels},le="+Inf"}} 2', samples[-3])
+        self.assertEqual(f"{name}_sum{{{labels}}} 20.003", samples[-2])
+        self.assertEqual(f"{name}_count{{{labels}}} 2", samples[-1])
+
+    def test_optional_sections(self):
+        for key in ["caches", "admission", "archives"]:
+            del self.data[key]
+        text = to_prometheus(self.data)
+        self.assertFalse("chm_admission" in text)
+        self.assertFalse("chm_cache_hits_total{" in text)
+
+
+if __name__ == "__main__":
+    unittest.main()
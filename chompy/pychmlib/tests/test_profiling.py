@@ -0,0 +1,82 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import unittest
+from collections import Counter
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from profiling import collapse, profile, sample_stacks
+
+
+def wait_for(event):
+    event.wait(10)
+
+
+class ProfilingTest(unittest.TestCase):
+    "test cases for the profiling helpers"
+
+    def test_collapse(self):
+        counts = Counter()
+        counts[("main", "run (a.py:1)", "read (b.py:20)")] += 3
+        counts[("main", "run (a.py:1)")] += 1
+        counts[("chm-server", "work (a.py:9)")] += 2
+        self.assertEqual(
+            "chm-server;work (a.py:9) 2\n"
+            "main;run (a.py:1) 1\n"
+            "main;run (a.py:1);read (b.py:20) 3\n",
+            collapse(counts),
+        )
+        self.assertEqual("", collapse(Counter()))
+
+    def test_sample_stacks(self):
+        event = threading.Event()
+        threads = [
+            threading.Thread(target=wait_for, args=(event,), name=name)
+            for name in ["chm-server_0", "chm-server_1", "odd;name"]
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            counts = sample_stacks(0.02, 0.005)
+        finally:
+            event.set()
+            for thread in threads:
+                thread.join()
+        lines = collapse(counts).splitlines()
+        waiting = [line for line in lines if "wait_for (test_profiling.py:" in line]
+        # threads of a pool are merged, and ; is kept out of frames
+        self.assertEqual(2, len(waiting))
+        self.assertTrue(waiting[0].startswith("chm-server;"))
+        self.assertTrue(waiting[1].startswith("odd,name;"))
+        frames, count = waiting[0].rsplit(" ", 1)
+        # both pool threads, sampled at least once each
+        self.assertTrue(int(count) >= 2)
+        self.assertTrue(";wait (threading.py:" in frames)
+        # the sampling thread itself is left out
+        self.assertFalse(any("test_sample_stacks" in line for line in lines))
+
+    def test_profile(self):
+        result, report = profile(lambda: sorted(range(1000)), "tottime", 5)
+        self.assertEqual(list(range(1000)), result)
+        self.assertTrue("function calls" in report)
+        self.assertTrue("Ordered by: internal time" in report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.cache import LRUCache
+from pychmlib.chm import chm
+from pychmlib.scheduler import (
+    DecodeScheduler,
+    SchedulerBusy,
+    INTERACTIVE,
+    PREFETCH,
+    BULK,
+)
+
+
+class DecodeSchedulerTest(unittest.TestCase):
+    "test cases for DecodeScheduler"
+
+    def setUp(self):
+        self.scheduler = DecodeScheduler(max_waiting=(None, 1, 1))
+        self.order = []
+
+    def take_turn(self, priority):
+        with self.scheduler.priority(priority):
+            with self.scheduler.turn():
+                self.order.append(priority)
+
+    def start(self, priority):
+        thread = threading.Thread(target=self.take_turn, args=(priority,))
+        thread.start()
+        # until it waits for its turn
+        while not self.scheduler.waiting()[priority]:
+            time.sleep(0.001)
+        return thread
+
+    def test_priority_order(self):
+        with self.scheduler.turn():
+            threads = [self.start(BULK), self.start(PREFETCH), self.start(INTERACTIVE)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual([INTERACTIVE, PREFETCH, BULK], self.order)
+        self.assertEqual([2, 1, 1], self.scheduler.blocks)
+
+    def test_max_waiting(self):
+        with self.scheduler.turn():
+            thread = self.start(BULK)
+            with self.scheduler.priority(BULK):
+                with self.assertRaises(SchedulerBusy):
+                    with self.scheduler.turn():
+                        pass
+        thread.join()
+        self.assertEqual([BULK], self.order)
+
+    def test_not_shed(self):
+        def take_turn():
+            with self.scheduler.priority(BULK, shed=False):
+                with self.scheduler.turn():
+                    self.order.append(BULK)
+
+        with self.scheduler.turn():
+            threads = [self.start(BULK)]
+            threads.append(threading.Thread(target=take_turn))
+            threads[-1].start()
+            while self.scheduler.waiting()[BULK] < 2:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([BULK, BULK], self.order)
+
+    def test_decoding(self):
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        chm_file.scheduler = self.scheduler
+        with self.scheduler.priority(BULK):
+            ui = chm_file.resolve_object("/back.jpg")
+            expected = read_file(get_filename("chm_files/back.jpg"))
+            self.assertEqual(expected, ui.get_content())
+        self.assertEqual([0, 0, 2], self.scheduler.blocks)
+        chm_file.close()
+
+    def test_interval_not_held(self):
+        # a thread waiting for a turn does not keep others from the interval
+        chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        chm_file.scheduler = self.scheduler
+        chm_file.block_cache = LRUCache()
+        contents = {}
+
+        def read(name, priority):
+            with self.scheduler.priority(priority):
+                contents[name] = chm_file.resolve_object(name).get_content()
+
+        threads = []
+        with self.scheduler.turn():
+            for name, priority in [("/back.jpg", BULK), ("/backfwd.jpg", INTERACTIVE)]:
+                threads.append(threading.Thread(target=read, args=(name, priority)))
+                threads[-1].start()
+                deadline = time.monotonic() + 5
+                while not self.scheduler.waiting()[priority]:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        other = chm(get_filename("chm_files/iexplore.chm"))
+        for name in ["/back.jpg", "/backfwd.jpg"]:
+            expected = other.resolve_object(name).get_content()
+            self.assertEqual(expected, contents[name])
+        other.close()
+        chm_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,881 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import gzip
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+import aserver
+import hhc
+import server
+from aserver import parse_request
+from server import Request, ResponseCache, accepts_gzip, not_modified
+from server import if_range_matches, parse_ranges, LibrarySite
+from server import AdmissionControl, CHMSite, Response, content_href, inline_depth
+from server import connection_closed
+from pychmlib.chm import chm
+from pychmlib.scheduler import DecodeScheduler, INTERACTIVE
+
+ETAG = '"1234-1-0-10"'
+# the archive's modification time, and its HTTP date
+MTIME = 1234567890
+LAST_MODIFIED = "Fri, 13 Feb 2009 23:31:30 GMT"
+
+
+class ParseRequestTest(unittest.TestCase):
+    "test cases for aserver.parse_request"
+
+    def test_parse(self):
+        head = (
+            b"GET /a%20b.htm?x=1 HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Accept-Encoding:  gzip \r\n"
+            b"\r\n"
+        )
+        method, target, version, headers = parse_request(head)
+        self.assertEqual("GET", method)
+        self.assertEqual("/a%20b.htm?x=1", target)
+        self.assertEqual("HTTP/1.1", version)
+        self.assertEqual({"host": "localhost", "accept-encoding": "gzip"}, headers)
+
+    def test_repeated_header(self):
+        head = b"GET / HTTP/1.0\r\nAccept: a\r\naccept: b\r\n\r\n"
+        headers = parse_request(head)[3]
+        self.assertEqual("a, b", headers["accept"])
+
+    def test_malformed(self):
+        for head in [
+            b"GET /\r\n\r\n",
+            b"GET / HTTP/2\r\n\r\n",
+            b"GET /a b HTTP/1.1\r\n\r\n",
+            b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+            b"GET / HTTP/1.1\r\nName : value\r\n\r\n",
+            b"GET / HTTP/1.1\r\n: value\r\n\r\n",
+        ]:
+            self.assertRaises(ValueError, parse_request, head)
+
+
+class NotModifiedTest(unittest.TestCase):
+    "test cases for server.not_modified"
+
+    def check(self, expected, **headers):
+        request = Request("GET", "/a.htm", headers)
+        self.assertEqual(expected, not_modified(request, ETAG, MTIME))
+
+    def test_if_none_match(self):
+        self.check(True, **{"if-none-match": ETAG})
+        self.check(True, **{"if-none-match": '"other", ' + ETAG})
+        self.check(True, **{"if-none-match": "W/" + ETAG})
+        self.check(True, **{"if-none-match": "*"})
+        self.check(False, **{"if-none-match": '"other"'})
+        self.check(False)
+
+    def test_if_modified_since(self):
+        self.check(True, **{"if-modified-since": LAST_MODIFIED})
+        self.check(True, **{"if-modified-since": "Sat, 14 Feb 2009 00:00:00 GMT"})
+        self.check(False, **{"if-modified-since": "Fri, 13 Feb 2009 23:31:29 GMT"})
+        self.check(False, **{"if-modified-since": "yesterday"})
+        request = Request("GET", "/a.htm", {"if-modified-since": LAST_MODIFIED})
+        self.assertFalse(not_modified(request, ETAG, None))
+
+    def test_precedence(self):
+        # If-Modified-Since is ignored along with If-None-Match
+        headers = {"if-none-match": '"other"', "if-modified-since": LAST_MODIFIED}
+        self.check(False, **headers)
+
+
+class ConnectionClosedTest(unittest.TestCase):
+    "test cases for telling whether a client has gone"
+
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+
+    def test_open(self):
+        self.assertFalse(connection_closed(self.server_side))
+        # input not read yet
+        self.client_side.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        self.assertFalse(connection_closed(self.server_side))
+        self.assertEqual(b"GET", self.server_side.recv(3))
+
+    def test_closed(self):
+        self.client_side.close()
+        self.assertTrue(connection_closed(self.server_side))
+
+    def test_shut_down(self):
+        self.client_side.shutdown(socket.SHUT_WR)
+        self.assertTrue(connection_closed(self.server_side))
+
+    def tearDown(self):
+        self.server_side.close()
+        self.client_side.close()
+        self.assertTrue(connection_closed(self.server_side))
+
+
+class AcceptsGzipTest(unittest.TestCase):
+    "test cases for server.accepts_gzip"
+
+    def check(self, expected, value=None):
+        headers = {} if value is None else {"accept-encoding": value}
+        self.assertEqual(expected, accepts_gzip(Request("GET", "/", headers)))
+
+    def test_accepts(self):
+        self.check(True, "gzip")
+        self.check(True, "deflate, GZIP, br")
+        self.check(True, "gzip;q=0.5")
+        self.check(True, "x-gzip")
+        self.check(True, "*")
+        self.check(True, "identity;q=1, *;q=0.1")
+
+    def test_refuses(self):
+        self.check(False)
+        self.check(False, "")
+        self.check(False, "deflate, br")
+        self.check(False, "gzip;q=0")
+        self.check(False, "gzip; q=0.0, *")
+        self.check(False, "*;q=0")
+        self.check(False, "gzip;q=none")
+
+
+class RangesTest(unittest.TestCase):
+    "test cases for server.parse_ranges and server.if_range_matches"
+
+    def test_ranges(self):
+        self.assertEqual([(0, 9)], parse_ranges("bytes=0-9", 100))
+        self.assertEqual([(90, 99)], parse_ranges("bytes=90-", 100))
+        self.assertEqual([(90, 99)], parse_ranges("bytes=-10", 100))
+        self.assertEqual([(0, 99)], parse_ranges("bytes=-200", 100))
+        self.assertEqual([(95, 99)], parse_ranges("bytes=95-200", 100))
+        self.assertEqual([(0, 0), (5, 9)], parse_ranges("Bytes = 0-0, 5-9", 100))
+
+    def test_unsatisfiable(self):
+        self.assertEqual([], parse_ranges("bytes=100-", 100))
+        self.assertEqual([], parse_ranges("bytes=100-200, 300-", 100))
+        self.assertEqual([], parse_ranges("bytes=-0", 100))
+        # ranges that cannot be satisfied are left out
+        self.assertEqual([(0, 9)], parse_ranges("bytes=100-, 0-9", 100))
+
+    def test_ignored(self):
+        for value in [
+            "items=0-9",
+            "bytes",
+            "bytes=5-1",
+            "bytes=a-9",
+            "bytes=0-9a",
+            "bytes=-",
+            "bytes=1",
+            "bytes=0-9,,20-29",
+            "bytes=" + ",".join(["0-1"] * (server.MAX_RANGES + 1)),
+        ]:
+            self.assertEqual(None, parse_ranges(value, 100), value)
+
+    def test_if_range(self):
+        for value, expected in [
+            (None, True),
+            (ETAG, True),
+            ('"other"', False),
+            # weak tags never match
+            ("W/" + ETAG, False),
+            (LAST_MODIFIED, True),
+            ("Sat, 14 Feb 2009 00:00:00 GMT", False),
+        ]:
+            headers = {} if value is None else {"if-range": value}
+            request = Request("GET", "/a.htm", headers)
+            self.assertEqual(
+                expected, if_range_matches(request, ETAG, LAST_MODIFIED), value
+            )
+
+
+class ResponseCacheTest(unittest.TestCase):
+    "test cases for server.ResponseCache"
+
+    def test_get(self):
+        cache = ResponseCache(100)
+        headers = {"ETag": ETAG}
+        cache.put("a", headers, b"a" * 10)
+        headers["ETag"] = "changed"
+        self.assertEqual(({"ETag": ETAG}, b"a" * 10), cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+
+    def test_size(self):
+        cache = ResponseCache(100)
+        cache.put("a", {}, b"a" * 60)
+        cache.put("b", {}, b"b" * 30)
+        cache.get("a")
+        cache.put("c", {}, b"c" * 30)
+        # b was used least recently
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        cache.put("d", {}, b"d" * 101)
+        self.assertFalse("d" in cache)
+        self.assertEqual(90, cache.stats()["size"])
+
+    def test_stats(self):
+        cache = ResponseCache()
+        self.assertEqual(0.0, cache.stats()["hit_ratio"])
+        cache.put("a", {}, b"abc")
+        cache.get("a")
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        cache.saved(3)
+        cache.saved(5)
+        stats = cache.stats()
+        self.assertEqual(3, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+        self.assertEqual(0.75, stats["hit_ratio"])
+        self.assertEqual(8, stats["bytes_saved"])
+
+
+class AdmissionControlTest(unittest.TestCase):
+    "test cases for server.AdmissionControl"
+
+    def setUp(self):
+        self.admission = AdmissionControl(
+            max_decodes=1, max_queued=2, max_bytes=100, retry_after=5
+        )
+
+    def in_use(self):
+        gauges = self.admission.gauges()
+        return gauges["queued"], gauges["decoding"], gauges["bytes"]
+
+    def assertBusy(self, response):
+        self.assertEqual(503, response.status)
+        self.assertEqual("5", response.headers["Retry-After"])
+
+    def test_load(self):
+        response = Response(load=lambda: self.admission.gauges())
+        self.assertTrue(self.admission.admit(response, 60) is response)
+        gauges = self.admission.gauges()
+        self.assertEqual(1, gauges["queued"])
+        self.assertEqual(60, gauges["bytes"])
+        # while loading, the response is decoding rather than queued
+        gauges = response.load()
+        self.assertEqual(0, gauges["queued"])
+        self.assertEqual(1, gauges["decoding"])
+        self.assertEqual(60, gauges["bytes"])
+        self.assertEqual((0, 0, 0), self.in_use())
+
+    def test_max_queued(self):
+        for n in range(2):
+            self.admission.admit(Response(load=lambda: b""), 1)
+        self.assertBusy(self.admission.admit(Response(load=lambda: b""), 1))
+        self.assertEqual(1, self.admission.gauges()["rejected"])
+
+    def test_max_bytes(self):
+        # one response is let through however long it is
+        self.admission.admit(Response(load=lambda: b""), 150)
+        self.assertBusy(self.admission.admit(Response(load=lambda: b""), 1))
+        admission = AdmissionControl(max_bytes=100)
+        admission.admit(Response(load=lambda: b""), 60)
+        self.assertEqual(503, admission.admit(Response(load=lambda: b""), 41).status)
+        self.assertEqual(200, admission.admit(Response(load=lambda: b""), 40).status)
+
+    def test_failed_load(self):
+        def load():
+            raise ValueError()
+
+        response = self.admission.admit(Response(load=load), 10)
+        self.assertRaises(ValueError, response.load)
+        self.assertEqual((0, 0, 0), self.in_use())
+
+    def test_streamed(self):
+        response = self.admission.admit(Response(body=iter([b"a", b"b"])), 50)
+        self.assertEqual(50, self.admission.gauges()["bytes"])
+        self.assertEqual([b"a", b"b"], list(response.body))
+        response.close()
+        self.assertEqual((0, 0, 0), self.in_use())
+        # closed before it is sent
+        response = self.admission.admit(Response(body=iter([b"a"])), 50)
+        response.close()
+        response.close()
+        gauges = self.admission.gauges()
+        self.assertEqual((0, 0), (gauges["queued"], gauges["bytes"]))
+
+    def test_max_decodes(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def load():
+            started.set()
+            finish.wait(10)
+            return b""
+
+        first = self.admission.admit(Response(load=load), 1)
+        thread = threading.Thread(target=first.load)
+        thread.start()
+        started.wait(10)
+        second = self.admission.admit(Response(load=lambda: b"second"), 1)
+        waiting = threading.Thread(target=second.load)
+        waiting.start()
+        waiting.join(0.05)
+        # the second waits for the first to finish
+        self.assertTrue(waiting.is_alive())
+        self.assertEqual(1, self.admission.gauges()["queued"])
+        finish.set()
+        thread.join()
+        waiting.join()
+        self.assertEqual(0, self.admission.gauges()["queued"])
+
+
+class IndexPageTest(unittest.TestCase):
+    "test cases for the index page of a CHMSite"
+
+    def setUp(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.site = CHMSite(get_filename("chm_files/iexplore.chm"))
+
+    def test_content_href(self):
+        self.assertEqual('javascript:loadContent("a.htm")', content_href("a.htm"))
+        self.assertEqual(
+            'javascript:loadContent("it\'s \\"q\\"%2522.htm")',
+            content_href('it\'s "q"%22.htm'),
+        )
+
+    def test_links_escaped(self):
+        toc = hhc.from_data(
+            ["root", None, [["<b>'quoted'</b>", "');alert(1);('\".htm", None]]]
+        )
+        hhc.number(toc)
+        html = self.site.generate_toc_html(toc)
+        self.assertEqual(
+            '<ul><li><a href="javascript:loadContent(&quot;&#x27;);alert(1);(&#x27;'
+            '\\&quot;.htm&quot;)">&lt;b&gt;\'quoted\'&lt;/b&gt;</a></li></ul>',
+            html,
+        )
+
+    def test_inline_depth(self):
+        toc = self.toc()
+        # two nodes on each of the first two levels, one on the third
+        self.assertEqual(None, inline_depth(toc, 5))
+        self.assertEqual(2, inline_depth(toc, 4))
+        self.assertEqual(1, inline_depth(toc, 3))
+        self.assertEqual(1, inline_depth(toc, 1))
+
+    def test_collapsed(self):
+        toc = self.toc()
+        b = '<li><a href="javascript:loadContent(&quot;b.htm&quot;)">b</a></li>'
+        self.assertEqual(
+            '<ul><li><span class="folder collapsed" data-node="1">a</span></li>'
+            + b
+            + "</ul>",
+            self.site.generate_toc_html(toc, 1),
+        )
+        self.assertEqual(
+            '<ul><li><span class="folder">a</span><ul>'
+            '<li><a href="javascript:loadContent(&quot;a1.htm&quot;)">a1</a>'
+            '<span class="folder collapsed" data-node="2"></span></li>'
+            '<li><a href="javascript:loadContent(&quot;a2.htm&quot;)">a2</a></li>'
+            "</ul></li>" + b + "</ul>",
+            self.site.generate_toc_html(toc, 2),
+        )
+        self.assertEqual(
+            self.site.generate_toc_html(toc, 3), self.site.generate_toc_html(toc)
+        )
+        self.assertNotIn("collapsed", self.site.generate_toc_html(toc))
+
+    def test_index_page(self):
+        body, compressed = self.site.get_index_page()
+        # rendered once
+        self.assertIs(body, self.site.get_index_page()[0])
+        self.assertEqual(body, gzip.decompress(compressed))
+        # the same as rendering the archive's HHC file
+        toc = hhc.parse(self.site.chm_file.get_hhc().get_content())
+        hhc.number(toc)
+        self.assertEqual(self.site.generate_index_html(toc).encode("utf-8"), body)
+        self.assertIn(b">Using Feeds (RSS) in Internet Explorer<", body)
+
+    def toc(self):
+        toc = hhc.from_data(
+            [
+                "root",
+                None,
+                [
+                    [
+                        "a",
+                        None,
+                        [
+                            ["a1", "a1.htm", [["x", "x.htm", None]]],
+                            ["a2", "a2.htm", None],
+                        ],
+                    ],
+                    ["b", "b.htm", None],
+                ],
+            ]
+        )
+        hhc.number(toc)
+        return toc
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.site.close()
+
+
+class LibraryPrefetchTest(unittest.TestCase):
+    "test cases for prefetching from a LibrarySite"
+
+    def setUp(self):
+        self.site = LibrarySite(
+            get_filename("chm_files"),
+            max_open=1,
+            idle_timeout=0,
+            response_cache=ResponseCache(),
+        )
+        self.library = self.site.library
+
+    def test_held(self):
+        path = self.site.find("iexplore")
+        site = self.library.acquire(path)
+        self.library.release(path)
+        # the library keys its files by absolute path
+        key = os.path.abspath(path)
+        users = []
+        original = site.warm
+
+        def warm(*args):
+            users.append(self.library._archives[key][1])
+            return original(*args)
+
+        site.warm = warm
+        site.prefetch("back.jpg", True)
+        # the file was kept open while it was read
+        self.assertEqual([1], users)
+        self.assertTrue((site._identity, "/back.jpg", None) in site.response_cache)
+        self.assertEqual(0, self.library._archives[key][1])
+
+    def test_closed(self):
+        path = self.site.find("iexplore")
+        site = self.library.acquire(path)
+        self.library.release(path)
+        other = self.site.find("CHM-example")
+        self.library.acquire(other)
+        self.library.release(other)
+        self.assertFalse(path in self.library)
+        site.prefetch("back.jpg", True)
+        # not opened again
+        self.assertFalse(path in self.library)
+        self.assertFalse((site._identity, "/back.jpg", None) in site.response_cache)
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.site.close()
+
+
+class RoundTripTests:
+    """requests to a server on the loopback interface, for each backend;
+    start_server returns it serving filename with options"""
+
+    def setUp(self):
+        self.filename = get_filename("chm_files/iexplore.chm")
+        self.server = None
+
+    def serve(self, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.server = self.start_server(self.filename, **options)
+        return self.server.server_address[1]
+
+    def get(self, path, headers=None, method="GET"):
+        "returns the status, headers and body of the response to a request"
+        if self.server is None:
+            self.serve()
+        port = self.server.server_address[1]
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def test_get(self):
+        for name in ["back.jpg", "search.jpg"]:
+            expected = read_file(get_filename("chm_files/" + name))
+            status, headers, body = self.get("/" + name)
+            self.assertEqual(200, status)
+            self.assertEqual("image/jpeg", headers["Content-Type"])
+            self.assertEqual(expected, body)
+        status, headers, body = self.get("/browstip.htm")
+        self.assertEqual(200, status)
+        self.assertEqual(read_file(get_filename("chm_files/browstip.htm")), body)
+
+    def test_head(self):
+        length = len(read_file(get_filename("chm_files/back.jpg")))
+        status, headers, body = self.get("/back.jpg", method="HEAD")
+        self.assertEqual(200, status)
+        self.assertEqual(str(length), headers["Content-Length"])
+        self.assertEqual(b"", body)
+
+    def test_not_found(self):
+        status, headers, body = self.get("/missing.htm")
+        self.assertEqual(404, status)
+
+    def test_not_modified(self):
+        self.serve(response_cache=ResponseCache())
+        for path in ["/back.jpg", "/browstip.htm", "/browstip.htm"]:
+            status, headers, body = self.get(path)
+            etag = headers["ETag"]
+            last_modified = headers["Last-Modified"]
+            for conditional in [
+                {"If-None-Match": etag},
+                {"If-None-Match": '"other", W/' + etag},
+                {"If-Modified-Since": last_modified},
+            ]:
+                status, headers, body = self.get(path, conditional)
+                self.assertEqual(304, status)
+                self.assertEqual(etag, headers["ETag"])
+                self.assertEqual(b"", body)
+            status, headers, body = self.get(path, {"If-None-Match": '"other"'})
+            self.assertEqual(200, status)
+        stats = self.server.site.response_cache.stats()
+        self.assertTrue(stats["hits"] > 0)
+        self.assertTrue(stats["bytes_saved"] > 0)
+
+    def test_gzip(self):
+        accept = {"Accept-Encoding": "gzip, deflate"}
+        # iexplore.hhk is long enough to be streamed
+        for path in ["/browstip.htm", "/iexplore.hhk"]:
+            status, headers, plain = self.get(path)
+            self.assertEqual(None, headers["Content-Encoding"])
+            self.assertEqual("Accept-Encoding", headers["Vary"])
+            status, headers, body = self.get(path, accept)
+            self.assertEqual(200, status)
+            self.assertEqual("gzip", headers["Content-Encoding"])
+            self.assertEqual("Accept-Encoding", headers["Vary"])
+            self.assertEqual(plain, gzip.decompress(body))
+            self.assertTrue(len(body) < len(plain))
+        status, headers, body = self.get("/back.jpg", accept)
+        self.assertEqual(None, headers["Content-Encoding"])
+        self.assertEqual(read_file(get_filename("chm_files/back.jpg")), body)
+
+    def test_ranges(self):
+        chm_file = chm(self.filename)
+        stored = chm_file.resolve_object("/#SYSTEM").get_content()
+        chm_file.close()
+        for path, content in [
+            ("/back.jpg", read_file(get_filename("chm_files/back.jpg"))),
+            # stored as is, sent from the file
+            ("/%23SYSTEM", stored),
+        ]:
+            total = len(content)
+            status, headers, body = self.get(path, {"Range": "bytes=10-99"})
+            self.assertEqual(206, status)
+            self.assertEqual(f"bytes 10-99/{total}", headers["Content-Range"])
+            self.assertEqual(content[10:100], body)
+            status, headers, body = self.get(path, {"Range": "bytes=-50"})
+            self.assertEqual(206, status)
+            self.assertEqual(content[-50:], body)
+
+            status, headers, body = self.get(path, {"Range": "bytes=0-1,-2"})
+            self.assertEqual(206, status)
+            content_type = headers["Content-Type"]
+            self.assertTrue(content_type.startswith("multipart/byteranges"))
+            self.assertTrue(content[:2] in body)
+            self.assertTrue(f"bytes {total - 2}-{total - 1}/{total}".encode() in body)
+
+            status, headers, body = self.get(path, {"Range": f"bytes={total}-"})
+            self.assertEqual(416, status)
+            self.assertEqual(f"bytes */{total}", headers["Content-Range"])
+
+            etag = self.get(path)[1]["ETag"]
+            ranged = {"Range": "bytes=0-9", "If-Range": etag}
+            self.assertEqual(206, self.get(path, ranged)[0])
+            ranged["If-Range"] = '"other"'
+            status, headers, body = self.get(path, ranged)
+            self.assertEqual(200, status)
+            self.assertEqual(content, body)
+
+    def test_busy(self):
+        self.serve(admission=AdmissionControl(max_queued=0, retry_after=3))
+        # entries that need decoding are turned away
+        for path in ["/back.jpg", "/browstip.htm", "/iexplore.hhk"]:
+            status, headers, body = self.get(path)
+            self.assertEqual(503, status)
+            self.assertEqual("3", headers["Retry-After"])
+        # short entries stored as they are are not
+        status, headers, body = self.get("/%23SYSTEM")
+        self.assertEqual(200, status)
+        gauges = self.server.site.admission.gauges()
+        self.assertEqual(3, gauges["rejected"])
+        self.assertEqual(0, gauges["bytes"])
+
+    def test_keyword_index(self):
+        status, headers, body = self.get("/__index.json?q=ActiveX&start=2&count=3")
+        self.assertEqual(200, status)
+        self.assertEqual("application/json", headers["Content-Type"])
+        index = json.loads(body)
+        self.assertEqual(10, index["total"])
+        self.assertEqual(2, index["start"])
+        self.assertEqual(
+            [
+                "ActiveX controls, ActiveX add-ons",
+                "ActiveX controls, blocked ActiveX control installations, what to do",
+                "ActiveX controls, browser add-ons",
+            ],
+            [keyword["name"] for keyword in index["keywords"]],
+        )
+        topic = index["keywords"][0]["topics"][0]
+        self.assertEqual("To see all Internet Explorer add-ons", topic["name"])
+        self.assertEqual("dc_showlist.htm", topic["local"])
+        accept = {"Accept-Encoding": "gzip"}
+        status, headers, compressed = self.get("/__index.json?q=zooming", accept)
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertEqual(5, json.loads(gzip.decompress(compressed))["total"])
+        self.assertEqual(0, json.loads(self.get("/__index.json?q=zzz")[2])["total"])
+        self.assertEqual(400, self.get("/__index.json?count=many")[0])
+
+    def test_index_page(self):
+        status, headers, body = self.get("/")
+        self.assertEqual(200, status)
+        self.assertEqual("text/html", headers["Content-Type"])
+        self.assertEqual(self.server.site.get_index_page()[0], body)
+        etag = headers["ETag"]
+        status, headers, compressed = self.get("/", {"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", headers["Content-Encoding"])
+        self.assertNotEqual(etag, headers["ETag"])
+        self.assertEqual(body, gzip.decompress(compressed))
+        status, headers, body = self.get("/", {"If-None-Match": etag})
+        self.assertEqual(304, status)
+
+    def test_toc_json(self):
+        status, headers, body = self.get("/__toc.json?node=0&depth=1")
+        self.assertEqual(200, status)
+        self.assertEqual("application/json", headers["Content-Type"])
+        root = json.loads(body)
+        self.assertEqual(0, root["id"])
+        self.assertEqual(17, len(root["children"]))
+        first = root["children"][0]
+        self.assertEqual(
+            {
+                "id": 1,
+                "name": "Getting Started with Internet Explorer",
+                "local": None,
+                "children": None,
+            },
+            first,
+        )
+        # the subtree left out, one level deep by default
+        status, headers, body = self.get("/__toc.json?node=1")
+        node = json.loads(body)
+        self.assertEqual(12, len(node["children"]))
+        self.assertEqual(["id", "local", "name"], sorted(node["children"][0]))
+        self.assertEqual(2, node["children"][0]["id"])
+        root = json.loads(self.get("/__toc.json?depth=2")[2])
+        self.assertEqual(node["children"], root["children"][0]["children"])
+        conditional = {"If-None-Match": headers["ETag"]}
+        self.assertEqual(304, self.get("/__toc.json?node=1", conditional)[0])
+        self.assertEqual(404, self.get("/__toc.json?node=1000")[0])
+        self.assertEqual(400, self.get("/__toc.json?node=first")[0])
+
+    def test_library(self):
+        # each file in a directory under its own name
+        self.filename = get_filename("chm_files")
+        status, headers, body = self.get("/")
+        self.assertEqual(200, status)
+        self.assertEqual("text/html", headers["Content-Type"])
+        self.assertIn(b'<li><a href="/CHM-example/">CHM-example</a></li>', body)
+        self.assertIn(b'<li><a href="/iexplore/">iexplore</a></li>', body)
+        status, headers, body = self.get("/iexplore?node=1")
+        self.assertEqual(301, status)
+        self.assertEqual("/iexplore/?node=1", headers["Location"])
+        status, headers, body = self.get("/iexplore/back.jpg")
+        self.assertEqual(200, status)
+        self.assertEqual(read_file(get_filename("chm_files/back.jpg")), body)
+        status, headers, body = self.get("/iexplore/")
+        self.assertEqual(200, status)
+        self.assertIn(b">Using Feeds (RSS) in Internet Explorer<", body)
+        status, headers, body = self.get("/iexplore/__toc.json?node=1")
+        self.assertEqual(12, len(json.loads(body)["children"]))
+        self.assertEqual(200, self.get("/CHM-example/")[0])
+        self.assertEqual(404, self.get("/CHM-example/missing.htm")[0])
+        for path in ["/missing/", "/missing", "/missing/back.jpg"]:
+            status, headers, body = self.get(path)
+            self.assertEqual(404, status)
+            self.assertIn(b"No such archive: missing", body)
+
+    def test_stats(self):
+        self.serve(response_cache=ResponseCache())
+        sent = 0
+        for path in ["/back.jpg", "/back.jpg", "/search.jpg", "/missing.htm"]:
+            sent += len(self.get(path)[2])
+        # requests are counted once their response is sent
+        deadline = time.monotonic() + 5
+        while True:
+            requests = self.server.site.stats.snapshot()["requests"].values()
+            if sum(sum(counts.values()) for counts in requests) == 4:
+                break
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        status, headers, body = self.get("/__stats")
+        self.assertEqual(200, status)
+        self.assertEqual("application/json", headers["Content-Type"])
+        self.assertEqual("no-store", headers["Cache-Control"])
+        stats = json.loads(body)
+        self.assertEqual(
+            {"image/jpeg": {"200": 3}, "text/html": {"404": 1}}, stats["requests"]
+        )
+        self.assertEqual(3, stats["latency_seconds"]["image/jpeg"]["count"])
+        self.assertEqual(sent, stats["bytes_sent"])
+        self.assertGreater(stats["lzx"]["blocks_decoded"], 0)
+        self.assertEqual(1, stats["caches"]["response"]["hits"])
+        status, headers, body = self.get("/__stats?format=prometheus")
+        self.assertTrue(headers["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            'chm_requests_total{content_type="image/jpeg",status="200"} 3\n',
+            body.decode(),
+        )
+        self.assertEqual(400, self.get("/__stats?format=xml")[0])
+
+    def test_half_close(self):
+        # a client that shuts down its side once the request is sent looks
+        # gone, but entries that need no decoding are still sent
+        port = self.serve()
+        chm_file = chm(self.filename)
+        expected = chm_file.resolve_object("/#SYSTEM").get_content()
+        chm_file.close()
+        for path, response in [("/%23SYSTEM", expected), ("/back.jpg", None)]:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+            try:
+                sock.sendall(b"GET %s HTTP/1.0\r\n\r\n" % path.encode())
+                sock.shutdown(socket.SHUT_WR)
+                data = b""
+                while True:
+                    received = sock.recv(65536)
+                    if not received:
+                        break
+                    data += received
+            finally:
+                sock.close()
+            if response is None:
+                self.assertEqual(b"", data)
+                continue
+            head, blank, body = data.partition(b"\r\n\r\n")
+            self.assertTrue(head.startswith(b"HTTP/1.1 200 "), head)
+            self.assertEqual(response, body)
+
+    def test_client_gone(self):
+        # decoding stops once the client has closed the connection
+        scheduler = DecodeScheduler()
+        port = self.serve(scheduler=scheduler)
+        with scheduler.turn():
+            sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+            sock.sendall(b"GET /back.jpg HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            deadline = time.monotonic() + 5
+            while not scheduler.waiting()[INTERACTIVE]:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.001)
+            sock.close()
+            # until the server has seen the end of the input
+            time.sleep(0.1)
+        # the turn taken by the request is its last
+        while scheduler.blocks[INTERACTIVE] < 2:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+        time.sleep(0.1)
+        self.assertEqual(2, scheduler.blocks[INTERACTIVE])
+        self.assertEqual(0, self.server.site.stats.decode.blocks)
+
+    def test_keep_alive(self):
+        port = self.serve()
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            for name in ["back.jpg", "search.jpg", "back.jpg"]:
+                connection.request("GET", "/" + name)
+                response = connection.getresponse()
+                expected = read_file(get_filename("chm_files/" + name))
+                self.assertEqual(expected, response.read())
+        finally:
+            connection.close()
+
+    def test_keep_alive_unknown_length(self):
+        # the body of an entry compressed as it is decoded ends when the
+        # connection does
+        port = self.serve()
+        sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        try:
+            sock.sendall(
+                b"GET /iexplore.hhk HTTP/1.0\r\nConnection: keep-alive\r\n"
+                b"Accept-Encoding: gzip\r\n\r\n"
+            )
+            data = b""
+            while True:
+                received = sock.recv(65536)
+                if not received:
+                    break
+                data += received
+        finally:
+            sock.close()
+        head = data.partition(b"\r\n\r\n")[0].lower()
+        self.assertIn(b"\r\nconnection: close", head)
+        self.assertNotIn(b"keep-alive", head)
+        self.assertNotIn(b"content-length", head)
+
+    def tearDown(self):
+        if self.server is not None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.server.shutdown()
+
+
+class ThreadedServerTest(RoundTripTests, unittest.TestCase):
+    "round trips to server.CHMHTTPServer"
+
+    def start_server(self, filename, **options):
+        instance = server.CHMHTTPServer(("127.0.0.1", 0), filename, **options)
+        thread = threading.Thread(target=instance.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return instance
+
+    def test_idle_keep_alive(self):
+        # idle connections give their threads up to those waiting for one
+        port = self.serve(max_threads=2, keepalive_timeout=30)
+        idle = []
+        try:
+            for n in range(2):
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                connection.request("GET", "/browstip.htm")
+                connection.getresponse().read()
+                idle.append(connection)
+            started = time.monotonic()
+            status, headers, body = self.get("/search.jpg")
+            self.assertEqual(200, status)
+            self.assertLess(time.monotonic() - started, 5)
+        finally:
+            for connection in idle:
+                connection.close()
+
+
+class AsyncServerTest(RoundTripTests, unittest.TestCase):
+    "round trips to aserver.AsyncCHMServer"
+
+    def start_server(self, filename, **options):
+        instance = aserver.AsyncCHMServer(("127.0.0.1", 0), filename, **options)
+        instance.start()
+        return instance
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.chm import chm
+from pychmlib import sidecar
+
+
+class SidecarTest(unittest.TestCase):
+    "test cases for the sidecar metadata cache"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "iexplore.chm")
+        shutil.copy(get_filename("chm_files/iexplore.chm"), self.filename)
+        self.path = sidecar.default_path(self.filename)
+
+    def test_created_on_first_open(self):
+        chm_file = chm(self.filename, self.path)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(None, chm_file._sidecar)
+        chm_file.close()
+
+    def test_reopen(self):
+        chm(self.filename, self.path).close()
+        chm_file = chm(self.filename, self.path)
+        plain = chm(self.filename)
+        self.assertNotEqual(None, chm_file._sidecar)
+        self.assertEqual(plain.lrt.block_length, chm_file.lrt.block_length)
+        self.assertEqual(
+            list(plain.lrt.block_addresses), list(chm_file.lrt.block_addresses)
+        )
+        self.assertEqual(plain.clcd.window_size, chm_file.clcd.window_size)
+        self.assertEqual(plain.clcd.reset_interval, chm_file.clcd.reset_interval)
+        self.assertEqual(
+            [ui.name for ui in plain.all_files()],
+            [ui.name for ui in chm_file.all_files()],
+        )
+        self.assertEqual("/iexplore.hhc", chm_file.get_hhc().name)
+        self.assertEqual(None, chm_file.resolve_object("/missing.htm"))
+        ui = chm_file.resolve_object("/lock.jpg")
+        content = chm_file.retrieve_object(ui)
+        self.assertEqual(read_file(get_filename("chm_files/lock.jpg")), content)
+        plain.close()
+        chm_file.close()
+
+    def test_cached_data(self):
+        chm_file = chm(self.filename, self.path)
+        self.assertEqual(None, chm_file.get_cached("toc"))
+        chm_file.set_cached("toc", ["Table of Contents", None, []])
+        chm_file.close()
+        chm_file = chm(self.filename, self.path)
+        self.assertEqual(["Table of Contents", None, []], chm_file.get_cached("toc"))
+        chm_file.close()
+
+    def test_stale(self):
+        chm(self.filename, self.path).close()
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        chm_file = chm(self.filename, self.path)
+        self.assertEqual(None, chm_file._sidecar)
+        chm_file.close()
+        chm_file = chm(self.filename, self.path)
+        self.assertNotEqual(None, chm_file._sidecar)
+        chm_file.close()
+
+    def test_corrupt(self):
+        f = open(self.path, "wb")
+        f.write(b"garbage")
+        f.close()
+        chm_file = chm(self.filename, self.path)
+        self.assertEqual(None, chm_file._sidecar)
+        self.assertEqual(246, len(list(chm_file.all_files())))
+        chm_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.cache import LRUCache
+from pychmlib.chm import chm
+from pychmlib.stats import DecodeStats
+
+
+class DecodeStatsTest(unittest.TestCase):
+    "test cases for DecodeStats"
+
+    def setUp(self):
+        self.chm_file = chm(get_filename("chm_files/iexplore.chm"))
+        self.stats = self.chm_file.decode_stats = DecodeStats()
+
+    def test_decoding(self):
+        self.chm_file.block_cache = LRUCache()
+        # back.jpg spans blocks 12 and 13
+        ui = self.chm_file.resolve_object("/back.jpg")
+        ui.get_content()
+        ui.get_content()
+        stats = self.stats.stats()
+        self.assertEqual(2, stats["reads"])
+        self.assertEqual(0, stats["content_hits"])
+        self.assertEqual(2, stats["block_hits"])
+        self.assertEqual(2, stats["blocks"])
+        self.assertTrue(stats["seconds"] > 0)
+
+    def test_counting(self):
+        self.chm_file.block_cache = LRUCache()
+        self.chm_file.resolve_object("/back.jpg").get_content()
+        request_stats = DecodeStats()
+        with self.stats.counting(request_stats):
+            # backfwd.jpg is in block 13, decoded for back.jpg
+            self.chm_file.resolve_object("/backfwd.jpg").get_content()
+        stats = request_stats.stats()
+        self.assertEqual(1, stats["reads"])
+        self.assertEqual(1, stats["block_hits"])
+        self.assertEqual(0, stats["blocks"])
+        # and in the stats of the file
+        self.assertEqual(2, self.stats.stats()["reads"])
+
+    def test_stored(self):
+        # entries stored as they are are not counted
+        self.chm_file.resolve_object("/#SYSTEM").get_content()
+        self.assertEqual(0, self.stats.stats()["reads"])
+
+    def tearDown(self):
+        self.chm_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pychmlib.tests.util import *
+
+load_modules()
+
+from pychmlib.scheduler import DecodeScheduler
+from server import CHMSite, ResponseCache
+import warmup
+from warmup import AccessProfile, load, warm_up
+
+
+class AccessProfileTest(unittest.TestCase):
+    "test cases for AccessProfile and load"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "profile.json")
+
+    def write(self, data):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(data)
+
+    def test_round_trip(self):
+        profile = AccessProfile(self.path, top=2, save_interval=0)
+        self.assertEqual([], profile.previous)
+        for entry in ["/a.htm", "/b.jpg", "/a.htm", "/c.css", "/a.htm", "/b.jpg"]:
+            profile.hit("iexplore", entry)
+        profile.hit("other", "/a.htm")
+        profile.close()
+        expected = [("iexplore", "/a.htm", 3), ("iexplore", "/b.jpg", 2)]
+        self.assertEqual(expected, load(self.path))
+        # written in one step, without leaving a temporary file behind
+        self.assertEqual(["profile.json"], os.listdir(self.dir))
+
+        # counts carry on, halved
+        profile = AccessProfile(self.path, top=2, save_interval=0)
+        self.assertEqual(expected, profile.previous)
+        profile.hit("iexplore", "/b.jpg")
+        profile.hit("iexplore", "/b.jpg")
+        profile.save()
+        expected = [("iexplore", "/b.jpg", 3), ("iexplore", "/a.htm", 1)]
+        self.assertEqual(expected, load(self.path))
+
+    def test_nothing_read(self):
+        AccessProfile(self.path, save_interval=0).close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_max_tracked(self):
+        profile = AccessProfile(self.path, save_interval=0)
+        tracked = warmup.MAX_TRACKED
+        warmup.MAX_TRACKED = 4
+        try:
+            for n in range(5):
+                profile.hit("iexplore", "/%d.htm" % n)
+                profile.hit("iexplore", "/0.htm")
+        finally:
+            warmup.MAX_TRACKED = tracked
+        profile.save()
+        entries = load(self.path)
+        self.assertEqual(("iexplore", "/0.htm", 6), entries[0])
+        self.assertTrue(len(entries) <= 4)
+
+    def test_unusable(self):
+        self.assertEqual([], load(self.path))
+        complete = json.dumps({"version": 1, "entries": [["a", "/b.htm", 2]]})
+        for data in [
+            complete[:-10],
+            "",
+            "\0\0\0",
+            "[]",
+            json.dumps({"version": 2, "entries": [["a", "/b.htm", 2]]}),
+            json.dumps({"version": 1}),
+            json.dumps({"version": 1, "entries": [["a", "/b.htm"]]}),
+            json.dumps({"version": 1, "entries": [["a", "/b.htm", "many"]]}),
+            json.dumps({"version": 1, "entries": 5}),
+        ]:
+            self.write(data)
+            self.assertEqual([], load(self.path), data)
+            self.assertEqual([], AccessProfile(self.path, save_interval=0).previous)
+        self.write(complete)
+        self.assertEqual([("a", "/b.htm", 2)], load(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class WarmUpTest(unittest.TestCase):
+    "test cases for warm_up"
+
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.scheduler = DecodeScheduler()
+        self.site = CHMSite(
+            get_filename("chm_files/iexplore.chm"),
+            response_cache=self.cache,
+            scheduler=self.scheduler,
+        )
+        self.entries = [
+            ("iexplore", "/back.jpg", 5),
+            ("other", "/back.jpg", 4),
+            ("iexplore", "/missing.htm", 3),
+            ("iexplore", "/browstip.htm", 2),
+        ]
+
+    def warm(self, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            warm_up(self.site, self.entries, *args).join(30)
+
+    def cached(self, path, coding=None):
+        return (self.site._identity, path, coding) in self.cache
+
+    def test_warm_up(self):
+        self.warm(self.scheduler)
+        self.assertTrue(self.cached("/back.jpg"))
+        self.assertTrue(self.cached("/browstip.htm", "gzip"))
+        # decoded at BULK priority
+        blocks = self.scheduler.blocks
+        self.assertEqual([0, 0], blocks[:2])
+        self.assertTrue(blocks[2] >= 2)
+
+    def test_budget(self):
+        self.warm(None, 0)
+        self.assertFalse(self.cached("/back.jpg"))
+        self.warm(None, 30, 0)
+        self.assertFalse(self.cached("/back.jpg"))
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.site.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,13 +13,50 @@
 # limitations under the License.
 
 from pychmlib.chm import chm
+from pychmlib.cache import LRUCache
+from pychmlib.cancel import CancelToken, Cancelled
+from pychmlib import sidecar
+from pychmlib.decodepool import DecodePool
+from pychmlib.library import Library
+from pychmlib.scheduler import PREFETCH
 
 import socket
+import ssl
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import hhc
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import unquote
+import hhk
+import profiling
+from accesslog import active, phase, timed, RequestTiming
+from metrics import PROMETHEUS_CONTENT_TYPE, ServerStats, hit_stats, to_prometheus
+import codecs
+import hmac
+import json
+import gzip
+import uuid
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape as html_escape
+from http import HTTPStatus
+from http.server import (
+    HTTPServer,
+    BaseHTTPRequestHandler,
+    DEFAULT_ERROR_MESSAGE,
+    DEFAULT_ERROR_CONTENT_TYPE,
+)
+from urllib.parse import quote, unquote, urlsplit, parse_qs
 import os
+import posixpath
+import queue
+import re
+import select
+import selectors
+from collections import OrderedDict
+from contextlib import contextmanager
+
+sendfile = getattr(os, "sendfile", None)
+_Selector = getattr(selectors, "PollSelector", selectors.SelectSelector)
 
 HOST = "127.0.0.1"
 PORT = 8081
@@ -39,15 +76,59 @@ TYPES = {
     ".pdf": "application/pdf",
 }
 
+# types worth compressing, others are either compressed already or rare
+COMPRESSIBLE_TYPES = {
+    "text/css",
+    "application/javascript",
+    "text/html",
+    "text/plain",
+    "application/json",
+}
+GZIP_LEVEL = 6
+
+# Range headers asking for more ranges are ignored
+MAX_RANGES = 16
+
+# longest request body read and thrown away to keep the connection usable
+MAX_BODY_BYTES = 1024 * 1024
+
+# entries longer than this are streamed as they are decoded, not cached
+STREAM_THRESHOLD = 256 * 1024
+
+# entries stored as they are and no longer than this bypass admission control
+ADMISSION_EXEMPT_BYTES = 64 * 1024
+
 ERR_NO_HHC = 1
 ERR_INVALID_CHM = 2
 
+INDEX_PAGE_SIZE = 50
+INDEX_MAX_PAGE_SIZE = 500
+
+# larger tables of contents are rendered only a few levels deep in the index
+# page, the rest is fetched from /__toc.json as folders are opened
+TOC_INLINE_NODES = 5000
+TOC_MAX_DEPTH = 8
+
+# longest stack sampling asked of /__profile, in seconds
+PROFILE_MAX_SECONDS = 60
+
+# how often an idle connection checks whether others wait for its thread
+IDLE_CHECK_SECONDS = 0.25
+
+# references in the HTML of pages, for prefetching
+_REFERENCE = re.compile(
+    r"""<(\w+)\b[^>]*?\b(src|href)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""",
+    re.IGNORECASE,
+)
+
 server_instance = None
 
 
-def start(filename, hhc_callback=None):
+def start(filename, hhc_callback=None, **options):
+    """Serve filename, a CHM file or a directory of them, in a background
+    thread. options are passed on to CHMHTTPServer."""
     global server_instance
-    server_instance = CHMHTTPServer((HOST, PORT), filename, hhc_callback)
+    server_instance = CHMHTTPServer((HOST, PORT), filename, hhc_callback, **options)
     thread = threading.Thread(target=server_instance.serve_forever)
     thread.daemon = True
     thread.start()
@@ -61,67 +142,1148 @@ def stop():
         server_instance = None
 
 
-class CHMRequestHandler(BaseHTTPRequestHandler):
-    def do_HEAD(self):
-        """Handle HEAD requests by calling do_GET but not sending content"""
-        self._head_request = True
-        self.do_GET()
+class Request:
+    """The parts of an HTTP request a CHMSite looks at. headers maps lower
+    case header names to their values. Decoding for the request stops once
+    token, a CancelToken, is cancelled."""
 
-    def do_GET(self):
+    def __init__(self, method, target, headers=None, token=None):
+        self.method = method
+        self.target = target
+        self.headers = headers or {}
+        self.token = token
+        parts = urlsplit(target)
+        self.path = unquote(parts.path)
+        self.query = parse_qs(parts.query)
+
+
+class Response:
+    """An HTTP response. When the body is slow to produce, for instance
+    because it has to be decoded, load is set instead: a function returning
+    the body, or another Response to send in its place, which the server
+    calls away from connection handling.
+
+    The body may also be an iterator of bytes, sent as they are produced;
+    length is then their total length, or None if it is not known."""
+
+    def __init__(
+        self, status=200, content_type=None, body=b"", load=None, length=None
+    ):
+        self.status = status
+        self.headers = {}
+        if content_type:
+            self.headers["Content-Type"] = content_type
+        self.body = body
+        self.load = load
+        self.length = length
+        # body bytes written so far by the server
+        self.bytes_sent = 0
+
+    def is_streamed(self):
+        return not isinstance(self.body, bytes)
+
+    def get_length(self):
+        return self.length if self.is_streamed() else len(self.body)
+
+    def close(self):
+        "Release a streamed body that is not going to be sent"
+        close = getattr(self.body, "close", None)
+        if close is not None:
+            close()
+
+
+def accepts_gzip(request):
+    """Whether the Accept-Encoding header of request allows a gzip body"""
+    qualities = {}
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, semicolon, params = coding.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, equals, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    if "gzip" in qualities:
+        return qualities["gzip"] > 0
+    return qualities.get("x-gzip", qualities.get("*", 0)) > 0
+
+
+def transcode(chunks, encoding):
+    """Re-encode the text in chunks from encoding to UTF-8, a chunk at a
+    time"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    for chunk in chunks:
+        with phase("transcode"):
+            chunk = decoder.decode(chunk).encode("utf-8")
+        yield chunk
+    yield decoder.decode(b"", final=True).encode("utf-8")
+
+
+def gzip_stream(chunks):
+    "Compress chunks into a gzip stream, a chunk at a time"
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        with phase("transcode"):
+            chunk = compressor.compress(chunk)
+        yield chunk
+    yield compressor.flush()
+
+
+def parse_ranges(value, total):
+    """Return the (first, last) byte positions of the ranges in Range header
+    value that fall within total bytes, an empty list if none does, or None
+    if the header is to be ignored"""
+    unit, equals, specs = value.partition("=")
+    if unit.strip().lower() != "bytes" or not equals:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = (part.strip() for part in spec.partition("-"))
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # the last bytes
+            start, end = max(total - int(last), 0), total - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), total - 1) if last else total - 1
+        if start <= end:
+            ranges.append((start, end))
+    return ranges
+
+
+def if_range_matches(request, etag, last_modified):
+    """Whether the If-Range header of request, if any, allows sending ranges:
+    it must be the current strong ETag or Last-Modified date"""
+    value = request.headers.get("if-range")
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith(('"', "W/")):
+        return value == etag
+    return value == last_modified
+
+
+class FileBody:
+    """A body stored as is in an open file, which servers can send with
+    os.sendfile. Iterating over it reads it in pieces instead."""
+
+    def __init__(self, ui, start=0, length=None):
+        self.file, offset, total = ui.get_file_range()
+        if length is None:
+            length = total - start
+        self.offset = offset + start
+        self.length = length
+        self._pieces = ui.stream(start, length)
+        # called once the body is closed
+        self.on_close = None
+
+    def can_sendfile(self):
+        return sendfile is not None and hasattr(self.file, "fileno")
+
+    def __iter__(self):
+        return self._pieces
+
+    def close(self):
+        self._pieces.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+
+def is_plain_socket(sock):
+    """Whether sock is a socket os.sendfile can write to. Other sockets, TLS
+    ones among them, would fall back to seeking and reading the archive's
+    file, which other threads are reading too."""
+    return isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket)
+
+
+def not_modified(request, etag, mtime):
+    """Whether the copy a client holds, according to the If-None-Match or
+    If-Modified-Since header of request, is still current"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and mtime is not None:
         try:
-            # Remove leading slash and decode URL
-            path = unquote(self.path.lstrip("/"))
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def error_response(status, message=None):
+    """Return an HTML error page like BaseHTTPRequestHandler.send_error"""
+    status = HTTPStatus(status)
+    body = DEFAULT_ERROR_MESSAGE % {
+        "code": status.value,
+        "message": html_escape(message or status.phrase, quote=False),
+        "explain": html_escape(status.description, quote=False),
+    }
+    return Response(
+        status.value, DEFAULT_ERROR_CONTENT_TYPE, body.encode("utf-8", "replace")
+    )
+
+
+def content_href(local):
+    """Return the href of a link loading entry local into the content frame.
+    local is quoted as a JavaScript string, with % escaped as well, since a
+    javascript: URL is percent-decoded before it runs."""
+    quoted = json.dumps(local, ensure_ascii=False).replace("%", "%25")
+    return f"javascript:loadContent({quoted})"
+
+
+def inline_depth(toc, max_nodes):
+    """Return how many levels of toc fit in max_nodes nodes, at least one,
+    or None if all of them do"""
+    level = toc.children
+    depth = 0
+    count = 0
+    while level:
+        count += len(level)
+        if count > max_nodes:
+            return max(depth, 1)
+        depth += 1
+        level = [
+            child for node in level if node.is_inner_node for child in node.children
+        ]
+    return None
+
+
+def report_response_cache(cache):
+    if cache is not None:
+        stats = cache.stats()
+        print(
+            f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_ratio']:.0%} hit ratio), "
+            f"{stats['bytes_saved']} bytes saved"
+        )
+
+
+def report_admission(admission):
+    if admission is not None and admission.rejected:
+        print(f"Admission control: {admission.rejected} requests turned away")
+
+
+def add_gauges(stats, scheduler=None, prefetcher=None):
+    "Add the queues of scheduler and prefetcher to the gauges of stats"
+    if scheduler is not None:
+        for priority, name in enumerate(("interactive", "prefetch", "bulk")):
+            stats.gauges[f"decode_waiting_{name}"] = (
+                lambda priority=priority: scheduler.waiting()[priority]
+            )
+    if prefetcher is not None:
+        stats.gauges["prefetch_queued"] = prefetcher.queued
+
+
+def collect_stats(stats, response_cache, block_cache, content_cache, admission):
+    """Return the snapshot of stats with the hit ratios of the caches and the
+    use of admission control added"""
+    data = stats.snapshot()
+    caches = OrderedDict()
+    if response_cache is not None:
+        cache = response_cache.stats()
+        caches["response"] = hit_stats(cache["hits"], cache["misses"])
+    if content_cache is not None:
+        decode = stats.decode.stats()
+        hits = decode["content_hits"]
+        caches["content"] = hit_stats(hits, decode["reads"] - hits)
+    if block_cache is not None:
+        caches["block"] = hit_stats(block_cache.hits, block_cache.misses)
+    data["caches"] = caches
+    if admission is not None:
+        data["admission"] = admission.gauges()
+    return data
+
+
+def stats_response(request, data):
+    """Return data, from collect_stats, as JSON or, when asked for with
+    ?format=prometheus or by the Accept header, in the Prometheus text
+    format"""
+    format = request.query.get("format", [None])[0]
+    if format is None:
+        accept = request.headers.get("accept", "")
+        prometheus = "text/plain" in accept or "openmetrics" in accept
+        format = "prometheus" if prometheus else "json"
+    if format == "prometheus":
+        response = Response(
+            200, PROMETHEUS_CONTENT_TYPE, to_prometheus(data).encode("utf-8")
+        )
+    elif format == "json":
+        response = Response(
+            200, "application/json", json.dumps(data, indent=1).encode("utf-8")
+        )
+    else:
+        return error_response(400, f"Unknown stats format ({format!r})")
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+class ResponseCache:
+    """Final response headers and bodies by path, dropping the least recently
+    used once they take more than max_bytes. bytes_saved counts the body
+    bytes that did not have to be read again: those of hits, and those not
+    sent at all because the client's copy was current."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self._cache = LRUCache(max_bytes)
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        "returns (headers, body) or None"
+        return self._cache.get(key)
+
+    def put(self, key, headers, body):
+        self._cache.put(key, (dict(headers), body), len(body))
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def saved(self, length):
+        with self._lock:
+            self.bytes_saved += length
+
+    def stats(self):
+        hits, misses = self._cache.hits, self._cache.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "size": self._cache.size,
+        }
+
+
+def admin_response(site, request):
+    """Return the response to an admin request to site, or None if request
+    is not one. Admin requests are only answered when the site has an
+    admin_token, which they must send as "Authorization: Bearer <token>".
+
+    /__profile?seconds=N samples the stacks of the server threads for N
+    seconds and returns them collapsed, for flame graph tools. A request
+    with an X-CHM-Profile header is answered with a cProfile report of
+    answering it instead, sorted as the header says if it names a sort
+    order in profiling.PROFILE_SORTS."""
+    if site.admin_token is None:
+        return None
+    profile = request.headers.get("x-chm-profile")
+    if request.path != "/__profile" and profile is None:
+        return None
+    authorization = request.headers.get("authorization", "").encode("utf-8")
+    expected = ("Bearer " + site.admin_token).encode("utf-8")
+    if not hmac.compare_digest(authorization, expected):
+        response = error_response(401, "Admin token required")
+        response.headers["WWW-Authenticate"] = "Bearer"
+        return response
+
+    if profile is not None:
+        headers = dict(request.headers)
+        del headers["x-chm-profile"]
+        request = Request(request.method, request.target, headers, request.token)
+        sort = profile if profile in profiling.PROFILE_SORTS else "cumulative"
+        return profiled_response(site, request, sort)
+
+    try:
+        seconds = float(request.query.get("seconds", [10])[0])
+    except ValueError:
+        return error_response(400, "Invalid profile duration")
+    seconds = min(max(seconds, 0), PROFILE_MAX_SECONDS)
+
+    def load():
+        stacks = profiling.sample_stacks(seconds)
+        return profiling.collapse(stacks).encode("utf-8")
+
+    response = Response(200, "text/plain; charset=utf-8", load=load)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def profiled_response(site, request, sort):
+    """Return a response whose body is the cProfile report of site answering
+    request, the body of its response read and thrown away"""
+
+    def answer():
+        response = site.complete(site.respond(request))
+        try:
+            if response.is_streamed():
+                for chunk in response.body:
+                    pass
+        finally:
+            response.close()
+        return response
+
+    def load():
+        response, report = profiling.profile(answer, sort)
+        return f"{request.target}: {response.status}\n\n{report}".encode("utf-8")
+
+    response = Response(200, "text/plain; charset=utf-8", load=load)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+class AdmissionControl:
+    """Limits the decoding work a server takes on, so that a burst of
+    requests is turned away rather than exhausting memory. At most
+    max_decodes responses are decoded at once and max_queued wait for
+    their turn; the entries being read take up to max_bytes between them,
+    counting their decoded length. Requests beyond these limits are
+    answered at once with a 503 and Retry-After: retry_after.
+
+    Streamed entries take a turn for each piece, and count one LZX block
+    against max_bytes while they are sent. Use gauges() to watch it."""
+
+    def __init__(
+        self,
+        max_decodes=4,
+        max_queued=64,
+        max_bytes=64 * 1024 * 1024,
+        retry_after=1,
+    ):
+        self.max_decodes = max_decodes
+        self.max_queued = max_queued
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self.rejected = 0
+        self._decoding = 0
+        self._queued = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._turns = threading.Semaphore(max_decodes)
+
+    def admit(self, response, length):
+        """Return response, whose load or streamed body reads length bytes
+        of decoded content, to be produced within the limits; or a 503
+        response if they have been reached"""
+        with self._lock:
+            full = self._queued >= self.max_queued or (
+                self._bytes and self._bytes + length > self.max_bytes
+            )
+            if full:
+                self.rejected += 1
+            else:
+                self._queued += 1
+                self._bytes += length
+        if full:
+            busy = error_response(503, "Server busy, try again later")
+            busy.headers["Retry-After"] = str(self.retry_after)
+            return busy
+        if response.load is not None:
+            load = response.load
+            response.load = lambda: self._load(load, length)
+        else:
+            response.body = AdmittedBody(self, response.body, length)
+        return response
+
+    def gauges(self):
+        "Return the current use of each limit, and the limits"
+        with self._lock:
+            return {
+                "decoding": self._decoding,
+                "max_decodes": self.max_decodes,
+                "queued": self._queued,
+                "max_queued": self.max_queued,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "rejected": self.rejected,
+            }
+
+    @contextmanager
+    def turn(self, queued=False):
+        """Decode within the limit on concurrent decodes. queued is whether
+        the caller is counted as queued until then."""
+        self._turns.acquire()
+        with self._lock:
+            if queued:
+                self._queued -= 1
+            self._decoding += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._decoding -= 1
+            self._turns.release()
+
+    def release(self, length, queued=False):
+        "Give back what an admitted response took"
+        with self._lock:
+            if queued:
+                self._queued -= 1
+            self._bytes -= length
+
+    def _load(self, load, length):
+        try:
+            with self.turn(queued=True):
+                return load()
+        finally:
+            self.release(length)
+
+
+class AdmittedBody:
+    "A streamed body admitted by AdmissionControl, produced a turn at a time"
+
+    def __init__(self, admission, body, length):
+        self._admission = admission
+        self._pieces = iter(body)
+        self._body = body
+        self._length = length
+        self._queued = True
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._released:
+            raise StopIteration
+        try:
+            with self._admission.turn(self._queued):
+                self._queued = False
+                return next(self._pieces)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._admission.release(self._length, self._queued)
+            close = getattr(self._body, "close", None)
+            if close is not None:
+                close()
+
+
+class CHMSite:
+    """Answers HTTP requests for one CHM file, independently of how the
+    connections are handled. With decode_processes, content that is not in
+    the block cache is decoded by that many worker processes, which with a
+    shared block cache also share the blocks they decode.
+
+    Entries carry an ETag made of the archive identity and their place in
+    it, so conditional requests are answered without decoding anything.
+    With a response_cache, bodies are kept ready to send.
+
+    With a prefetcher, the resources of pages sent and the pages they link
+    to are read ahead of the requests for them. With a scheduler (see
+    pychmlib.scheduler), requests decode before prefetching and other
+    background work. With admission (an AdmissionControl), requests that
+    need decoding are turned away once too many are under way; those that
+    are answered from a cache are not.
+
+    /__stats reports the requests answered, the decoding done and the
+    use of the caches and queues; see metrics.ServerStats. Servers count
+    the requests they answer in stats, which is made if not given. With an
+    admin_token, the server can be profiled; see admin_response. With an
+    access_profile (see warmup.AccessProfile), the entries asked for are
+    counted there under name, the file name without its extension.
+
+    A decode_pool given is used instead of starting one. With shared, the
+    caches and the decode pool belong to a LibrarySite serving other files
+    too, which reports on them and closes them; library is then the
+    SiteLibrary the site was opened from."""
+
+    def __init__(
+        self,
+        chm_filename,
+        hhc_callback=None,
+        use_sidecar=False,
+        content_cache=None,
+        block_cache=None,
+        decode_processes=0,
+        response_cache=None,
+        decode_pool=None,
+        shared=False,
+        library=None,
+        prefetcher=None,
+        scheduler=None,
+        admission=None,
+        stats=None,
+        admin_token=None,
+        access_profile=None,
+    ):
+        self.filename = chm_filename
+        self.name = os.path.splitext(os.path.basename(chm_filename))[0]
+        self.admin_token = admin_token
+        self.access_profile = access_profile
+        self.response_cache = response_cache
+        self.content_cache = content_cache
+        self.shared = shared
+        self.library = library
+        self.prefetcher = prefetcher
+        self.scheduler = scheduler
+        self.admission = admission
+        self.stats = stats if stats is not None else ServerStats()
+        if not shared:
+            add_gauges(self.stats, scheduler, prefetcher)
+        try:
+            sidecar_path = sidecar.default_path(chm_filename) if use_sidecar else None
+            self.chm_file = chm(chm_filename, sidecar_path)
+            self.chm_file.block_cache = block_cache
+            self.chm_file.scheduler = scheduler
+            self.chm_file.decode_stats = self.stats.decode
+            self.mtime = os.stat(chm_filename).st_mtime
+        except Exception as e:
+            print(f"Error opening CHM file: {e}")
+            if hhc_callback:
+                hhc_callback(error=ERR_INVALID_CHM)
+            raise
+
+        self._toc = None
+        self._toc_nodes = None
+        self._index = None
+        self._lock = threading.Lock()
+        # the index page, and its gzip-compressed form, once rendered
+        self._index_page = None
+        self._index_page_lock = threading.Lock()
+        self._identity = self.chm_file.get_identity()
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+        # Serve compressed entries from a materialized copy when available
+        if content_cache:
+            content_cache.attach(self.chm_file)
+
+        # Process HHC callback if provided
+        if hhc_callback:
+            contents = self.get_toc()
+            if contents:
+                encoding = self.chm_file.encoding
+                hhc_callback(chm_filename, contents, encoding)
+            else:
+                self.chm_file.close()
+                hhc_callback(error=ERR_NO_HHC)
+                raise Exception("No HHC file found")
+
+        self._decode_pool = decode_pool
+        if decode_processes and decode_pool is None:
+            self._decode_pool = DecodePool(
+                decode_processes,
+                cache_bytes=getattr(block_cache, "max_bytes", 32 * 1024 * 1024),
+                block_cache=block_cache,
+                use_sidecar=use_sidecar,
+            )
+
+    def respond(self, request):
+        """Return the Response to request. Work that may need decoding is left
+        to the response's load function, so this returns quickly."""
+        try:
+            admin = admin_response(self, request)
+            if admin is not None:
+                return admin
+
+            # Remove leading slash
+            path = request.path.lstrip("/")
 
             if not path:
-                self.send_index_page()
-                return
+                return self.index_response(request)
+            if path == "__index.json":
+                return self.keyword_index(request)
+            if path == "__toc.json":
+                return self.toc_subtree(request)
+            if path == "__stats":
+                return stats_response(request, self.stats_data())
+
+            # Determine content type, and whether to send it compressed
+            extension = os.path.splitext(path)[1].lower()
+            content_type = TYPES.get(extension, "text/html")
+            compressible = content_type in COMPRESSIBLE_TYPES
+            # ranges are always of the uncompressed entry
+            ranged = "range" in request.headers
+            coding = None
+            if compressible and not ranged and accepts_gzip(request):
+                coding = "gzip"
+
+            cache = self.response_cache
+            # archives may share a cache
+            key = (self._identity, "/" + path)
+            if cache is not None and not ranged:
+                cached = cache.get(key + (coding,))
+                if cached is not None:
+                    if self.access_profile is not None:
+                        self.access_profile.hit(self.name, "/" + path)
+                    headers, body = cached
+                    cache.saved(len(body))
+                    if not_modified(request, headers["ETag"], self.mtime):
+                        return self.not_modified_response(headers)
+                    response = Response(200, body=body)
+                    response.headers.update(headers)
+                    return response
 
             # Get file from CHM
-            ui = self.server.chm_file.resolve_object("/" + path)
-            if ui:
-                content = ui.get_content()
-                # Determine content type
-                extension = os.path.splitext(path)[1].lower()
-                content_type = TYPES.get(extension, "text/html")
-
-                self.send_response(200)
-                self.send_header("Content-Type", content_type)
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-
-                # Only send content for GET requests, not HEAD requests
-                if not getattr(self, "_head_request", False):
-                    if isinstance(content, str):
-                        self.wfile.write(content.encode("utf-8"))
-                    else:
-                        self.wfile.write(content)
+            with phase("lookup"):
+                ui = self.chm_file.resolve_object("/" + path)
+            if not ui:
+                return error_response(404, f"File not found: {path}")
+            if self.access_profile is not None:
+                self.access_profile.hit(self.name, "/" + path)
+            identity_headers, headers = self.entry_headers(ui, content_type, coding)
+            etag = identity_headers["ETag"]
+
+            if not_modified(request, headers["ETag"], self.mtime):
+                if cache is not None:
+                    cache.saved(ui.length)
+                return self.not_modified_response(headers)
+
+            if ranged and if_range_matches(request, etag, self.last_modified):
+                return self.admit(
+                    Response(
+                        load=lambda: self.partial_entry(request, ui, identity_headers)
+                    ),
+                    ui,
+                )
+
+            if not coding and not ui.compressed and not ui.is_text():
+                # stored as is, send it straight from the file
+                response = Response(200, body=FileBody(ui), length=ui.length)
+                response.headers.update(headers)
+                return response
+
+            token = request.token
+            if ui.length > STREAM_THRESHOLD:
+                # decoding in worker processes returns the whole entry at once
+                if not (self._decode_pool and ui.needs_decoding()):
+                    return self.admit(
+                        self.stream_entry(ui, headers, coding, token), ui
+                    )
+
+            response = Response(200)
+            response.headers.update(headers)
+            response.load = lambda: self.load_entry(
+                path, ui, content_type, coding, token
+            )
+            return self.admit(response, ui)
+        except Exception as e:
+            print(f"Error serving request: {e}")
+            return error_response(500, "Internal server error")
+
+    def entry_headers(self, ui, content_type, coding):
+        """Return the headers of entry ui sent as stored, and those of it
+        sent with coding, which are the same without one"""
+        etag = self.entity_tag(ui)
+        identity_headers = {
+            "Content-Type": content_type,
+            "ETag": etag,
+            "Last-Modified": self.last_modified,
+            "Accept-Ranges": "bytes",
+        }
+        if content_type in COMPRESSIBLE_TYPES:
+            identity_headers["Vary"] = "Accept-Encoding"
+        headers = identity_headers
+        if coding:
+            # the compressed variant is another representation
+            headers = dict(identity_headers, ETag=etag[:-1] + '-gz"')
+            headers["Content-Encoding"] = "gzip"
+        return identity_headers, headers
+
+    def stats_data(self):
+        "Return what /__stats reports"
+        data = collect_stats(
+            self.stats,
+            self.response_cache,
+            self.chm_file.block_cache,
+            self.content_cache,
+            self.admission,
+        )
+        data["archives"] = {self.name: 1}
+        return data
+
+    def admit(self, response, ui):
+        """Return response, which reads entry ui, subject to admission
+        control unless the entry is quick to read: found in a cache, or
+        stored as is and short"""
+        admission = self.admission
+        if admission is None:
+            return response
+        if ui.compressed:
+            if not ui.needs_decoding():
+                return response
+        elif ui.length <= ADMISSION_EXEMPT_BYTES:
+            return response
+        length = ui.length
+        if response.is_streamed():
+            # only one piece is held at a time
+            length = min(length, self.chm_file.lrt.block_length)
+        return admission.admit(response, length)
+
+    def load_entry(self, path, ui, content_type, coding, token=None):
+        """Return the body of entry ui at path sent with coding, adding it to
+        the response cache. Pages are handed to the prefetcher."""
+        body = self.read(ui, token)
+        identity_headers, headers = self.entry_headers(ui, content_type, coding)
+        cache = self.response_cache
+        key = (self._identity, "/" + path)
+        if cache is not None:
+            cache.put(key + (None,), identity_headers, body)
+        if self.prefetcher is not None and content_type == "text/html":
+            self.prefetcher.page_loaded(self, path, body)
+        if coding:
+            with phase("transcode"):
+                body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            if cache is not None:
+                cache.put(key + (coding,), headers, body)
+        return body
+
+    def warm(self, path, resource):
+        """Read entry path ahead of a request for it. A resource of a page
+        is loaded into the response cache, as the browser will ask for it;
+        for a page linked to, filling the block cache is enough."""
+        ui = self.chm_file.resolve_object("/" + path)
+        if ui is None or not ui.compressed:
+            # entries stored as they are are quick to read
+            return
+        cache = self.response_cache
+        if resource and cache is not None and ui.length <= STREAM_THRESHOLD:
+            extension = os.path.splitext(path)[1].lower()
+            content_type = TYPES.get(extension, "text/html")
+            coding = "gzip" if content_type in COMPRESSIBLE_TYPES else None
+            if (self._identity, "/" + path, coding) not in cache:
+                self.load_entry(path, ui, content_type, coding)
+        elif ui.needs_decoding():
+            if self._decode_pool:
+                self.read(ui)
+            else:
+                for piece in ui.stream():
+                    pass
+
+    def prefetch(self, path, resource):
+        """Warm entry path for the prefetcher. A site of a library is kept
+        open meanwhile; if it has been closed since, nothing is read."""
+        library = self.library
+        if library is None:
+            self.warm(path, resource)
+            return
+        if self.filename not in library:
+            return
+        with library.archive(self.filename) as site:
+            site.warm(path, resource)
+
+    def warm_entry(self, name, path):
+        "Read entry path of the archive served under name, if it is this one"
+        if name == self.name:
+            self.warm(path.lstrip("/"), True)
+
+    def complete(self, response):
+        """Fill in the body of response if it is still to be loaded. Returns
+        the response to send, which is an error if loading failed."""
+        if response.load is None:
+            return response
+        try:
+            if self.prefetcher is not None:
+                with self.prefetcher.loading():
+                    body = response.load()
             else:
-                self.send_error(404, f"File not found: {path}")
+                body = response.load()
+            if isinstance(body, Response):
+                return body
+            response.body = body
+            response.load = None
+            return response
+        except Cancelled:
+            # nobody is waiting for it any more
+            return error_response(503, "Request cancelled")
         except Exception as e:
             print(f"Error serving request: {e}")
-            self.send_error(500, "Internal server error")
+            return error_response(500, "Internal server error")
+
+    def stream_entry(self, ui, headers, coding, token=None):
+        """Return a response sending entry ui as it is decoded, one block at a
+        time, without caching it"""
+        chunks = ui.stream(token=token)
+        length = ui.length
+        if ui.is_text():
+            chunks = transcode(chunks, self.chm_file.encoding)
+            length = None
+        if coding:
+            chunks = gzip_stream(chunks)
+            length = None
+        response = Response(200, body=chunks, length=length)
+        response.headers.update(headers)
+        return response
+
+    def partial_entry(self, request, ui, headers):
+        """Return the response to a request for ranges of entry ui, reading
+        only those ranges where the entry is sent as stored"""
+        token = request.token
+        body = None
+        if self.response_cache is not None:
+            key = (self._identity, "/" + request.path.lstrip("/"), None)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                body = cached[1]
+        if body is None and ui.is_text():
+            # sent re-encoded, so ranges are of the re-encoded text
+            body = self.read(ui, token)
+        if body is None:
+            total = ui.length
+            read = lambda start, length: ui.read(start, length, token)
+        else:
+            total, read = len(body), lambda start, length: body[start : start + length]
+
+        ranges = parse_ranges(request.headers["range"], total)
+        if ranges is None:
+            # not a range header we understand, send the whole entry
+            if body is None:
+                body = self.read(ui, token)
+            response = Response(200, body=body)
+            response.headers.update(headers)
+            return response
+        if not ranges:
+            response = error_response(416)
+            response.headers["Content-Range"] = f"bytes */{total}"
+            return response
+
+        response = Response(206)
+        response.headers.update(headers)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+            if body is None and not ui.compressed:
+                response.body = FileBody(ui, start, end - start + 1)
+                response.length = end - start + 1
+            elif body is None:
+                response.body = ui.stream(start, end - start + 1, token)
+                response.length = end - start + 1
+            else:
+                response.body = read(start, end - start + 1)
+            return response
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, end in ranges:
+            parts.append(
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {headers['Content-Type']}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{total}\r\n\r\n"
+                ).encode("latin-1")
+            )
+            parts.append(read(start, end - start + 1))
+            parts.append(b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode("latin-1"))
+        response.headers["Content-Type"] = "multipart/byteranges; boundary=" + boundary
+        response.body = b"".join(parts)
+        return response
+
+    def entity_tag(self, ui):
+        """Return a strong ETag for entry ui: it is unchanged as long as the
+        archive is, and differs between entries"""
+        return f'"{self._identity}-{ui.compressed:x}-{ui.offset:x}-{ui.length:x}"'
 
-    def send_index_page(self):
-        """Send a simple index page with CHM table of contents"""
+    def not_modified_response(self, headers):
+        response = Response(304)
+        for name in ("ETag", "Last-Modified", "Vary"):
+            if name in headers:
+                response.headers[name] = headers[name]
+        return response
+
+    def read(self, ui, token=None):
+        if self._decode_pool and ui.needs_decoding():
+            # other reads may be waiting for it, the workers finish it anyway
+            content = self._decode_pool.read(self.filename, ui.name)
+        else:
+            content = ui.get_content(token)
+        if isinstance(content, str):
+            with phase("transcode"):
+                return content.encode("utf-8")
+        return content
+
+    def index_response(self, request):
+        """Return the index page. It is rendered once, on first use; after
+        that it is sent as it is, compressed or not."""
+        coding = "gzip" if accepts_gzip(request) else None
+        etag = f'"{self._identity}-toc"'
+        if coding:
+            etag = f'"{self._identity}-toc-gz"'
+        headers = {
+            "Content-Type": "text/html",
+            "ETag": etag,
+            "Last-Modified": self.last_modified,
+            "Vary": "Accept-Encoding",
+        }
+        if coding:
+            headers["Content-Encoding"] = "gzip"
+        if not_modified(request, etag, self.mtime):
+            return self.not_modified_response(headers)
+
+        def load():
+            body, compressed = self.get_index_page()
+            return compressed if coding else body
+
+        response = Response(200)
+        response.headers.update(headers)
+        if self._index_page is None:
+            response.load = load
+        else:
+            response.body = load()
+        return response
+
+    def get_index_page(self):
+        """Return the index page and its gzip-compressed form, rendering them
+        on first use"""
+        with self._index_page_lock:
+            if self._index_page is None:
+                body = self.index_page()
+                compressed = gzip.compress(body, GZIP_LEVEL, mtime=0)
+                self._index_page = (body, compressed)
+            return self._index_page
+
+    def index_page(self):
+        """Return a simple index page with CHM table of contents"""
+        contents = self.get_toc()
+        if contents:
+            html = self.generate_index_html(contents)
+        else:
+            html = "<html><body><h1>CHM File</h1><p>No table of contents available</p></body></html>"
+        return html.encode("utf-8")
+
+    def toc_subtree(self, request):
+        """Return the table of contents below the node with the given id as
+        JSON, depth levels deep. Nodes whose children are left out have
+        null children; leaves have none."""
+        query = request.query
         try:
-            hhc_file = self.server.chm_file.get_hhc()
-            if hhc_file:
-                contents = hhc.parse(hhc_file.get_content())
-                html = self.generate_index_html(contents)
+            node_id = int(query.get("node", [0])[0])
+            depth = int(query.get("depth", [1])[0])
+        except ValueError:
+            return error_response(400, "Invalid table of contents query")
+        depth = max(1, min(depth, TOC_MAX_DEPTH))
+        compress = accepts_gzip(request)
+        etag = f'"{self._identity}-toc-{node_id}-{depth}'
+        etag += '-gz"' if compress else '"'
+        headers = {
+            "Content-Type": "application/json",
+            "ETag": etag,
+            "Last-Modified": self.last_modified,
+            "Vary": "Accept-Encoding",
+        }
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        if not_modified(request, etag, self.mtime):
+            return self.not_modified_response(headers)
+
+        def load():
+            toc = self.get_toc()
+            if toc is None or not 0 <= node_id < len(self._toc_nodes):
+                return error_response(404, "No such table of contents node")
+            data = self.toc_data(self._toc_nodes[node_id], depth)
+            body = json.dumps(data).encode("utf-8")
+            if compress:
+                body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            return body
+
+        response = Response(200, load=load)
+        response.headers.update(headers)
+        return response
+
+    def toc_data(self, node, depth):
+        data = {"id": node.id, "name": self.node_name(node), "local": node.local}
+        if node.is_inner_node:
+            if depth > 0:
+                data["children"] = [
+                    self.toc_data(child, depth - 1) for child in node.children
+                ]
             else:
-                html = "<html><body><h1>CHM File</h1><p>No table of contents available</p></body></html>"
+                data["children"] = None if node.children else []
+        return data
 
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html")
-            self.send_header("Content-Length", str(len(html)))
-            self.end_headers()
+    def node_name(self, node):
+        if hasattr(node.name, "decode"):
+            return node.name.decode(self.chm_file.encoding)
+        return node.name
 
-            # Only send content for GET requests, not HEAD requests
-            if not getattr(self, "_head_request", False):
-                self.wfile.write(html.encode("utf-8"))
-        except Exception as e:
-            print(f"Error generating index: {e}")
-            self.send_error(500, "Error generating index")
+    def keyword_index(self, request):
+        """Return a page of keywords from the HHK index matching a prefix"""
+        query = request.query
+        try:
+            prefix = query.get("q", [""])[0]
+            start = int(query.get("start", [0])[0])
+            count = int(query.get("count", [INDEX_PAGE_SIZE])[0])
+        except ValueError:
+            return error_response(400, "Invalid index query")
+        count = min(count, INDEX_MAX_PAGE_SIZE)
+
+        def load():
+            index = self.get_index()
+            if index is None:
+                return error_response(404, "No keyword index available")
+            total, page = index.lookup(prefix, start, count)
+            result = {
+                "total": total,
+                "start": start,
+                "keywords": [
+                    {
+                        "name": keyword,
+                        "topics": [{"name": t, "local": l} for t, l in topics],
+                    }
+                    for keyword, topics in page
+                ],
+            }
+            body = json.dumps(result).encode("utf-8")
+            if compress:
+                body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            return body
+
+        response = Response(200, "application/json", load=load)
+        response.headers["Vary"] = "Accept-Encoding"
+        compress = accepts_gzip(request)
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    def get_toc(self):
+        """Return the parsed HHC table of contents, parsing it on first use"""
+        with self._lock:
+            if self._toc is None:
+                data = self.chm_file.get_cached("toc")
+                if data is not None:
+                    self._toc = data and hhc.from_data(data)
+                else:
+                    hhc_file = self.chm_file.get_hhc()
+                    if hhc_file:
+                        self._toc = hhc.parse(hhc_file.get_content())
+                        self.chm_file.set_cached("toc", hhc.to_data(self._toc))
+                    else:
+                        self._toc = False
+                        self.chm_file.set_cached("toc", False)
+                if self._toc:
+                    self._toc_nodes = hhc.number(self._toc)
+            return self._toc or None
+
+    def get_index(self):
+        """Return the HHK keyword index, parsing it on first use"""
+        with self._lock:
+            if self._index is None:
+                data = self.chm_file.get_cached("index")
+                if data is not None:
+                    self._index = data and hhk.from_data(data)
+                else:
+                    hhk_file = self.chm_file.get_hhk()
+                    if hhk_file:
+                        self._index = hhk.parse(hhk_file.get_content())
+                        self.chm_file.set_cached("index", hhk.to_data(self._index))
+                    else:
+                        self._index = False
+                        self.chm_file.set_cached("index", False)
+            return self._index or None
+
+    def close(self):
+        if not self.shared:
+            report_response_cache(self.response_cache)
+            report_admission(self.admission)
+            if self._decode_pool:
+                self._decode_pool.close()
+        self.chm_file.close()
 
     def generate_index_html(self, hhc_obj):
         """Generate HTML index from HHC object"""
@@ -232,6 +1394,12 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
             display: none;
         }
         
+        .sidebar input {
+            width: 100%;
+            box-sizing: border-box;
+            margin-bottom: 10px;
+        }
+        
         .welcome-text {
             color: #666;
             line-height: 1.6;
@@ -252,6 +1420,11 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
         }
     </style>
     <script>
+        // the href of a link to path, like content_href on the server
+        function contentHref(path) {
+            return 'javascript:loadContent(' + JSON.stringify(path).replace(/%/g, '%25') + ')';
+        }
+        
         function loadContent(path) {
             const welcomeDiv = document.querySelector('.welcome-text');
             const contentDiv = document.querySelector('.content');
@@ -278,14 +1451,18 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
         }
         
         function updateCurrentPageHighlight(currentPath) {
-            // Remove current class from all links
+            // Remove current class from all links, finding the current page
+            const href = contentHref(currentPath);
+            let currentLink = null;
             const allLinks = document.querySelectorAll('.sidebar a');
             allLinks.forEach(function(link) {
                 link.classList.remove('current');
+                if (!currentLink && link.getAttribute('href') === href) {
+                    currentLink = link;
+                }
             });
             
-            // Find and highlight the current page
-            const currentLink = document.querySelector(`.sidebar a[href="javascript:loadContent('${currentPath}')"]`);
+            // Highlight the current page
             if (currentLink) {
                 currentLink.classList.add('current');
                 
@@ -303,8 +1480,91 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
             }
         }
         
+        let indexRequest = 0;
+        
+        function searchIndex(prefix) {
+            const results = document.getElementById('indexResults');
+            const toc = document.getElementById('toc');
+            if (!prefix) {
+                results.innerHTML = '';
+                toc.style.display = 'block';
+                return;
+            }
+            const request = ++indexRequest;
+            fetch('__index.json?q=' + encodeURIComponent(prefix))
+                .then(function(response) { return response.ok ? response.json() : null; })
+                .then(function(index) {
+                    // ignore responses to keystrokes that have been superseded
+                    if (!index || request !== indexRequest) {
+                        return;
+                    }
+                    results.innerHTML = '';
+                    index.keywords.forEach(function(keyword) {
+                        keyword.topics.forEach(function(topic) {
+                            const li = document.createElement('li');
+                            const a = document.createElement('a');
+                            a.textContent = keyword.name + ' - ' + topic.name;
+                            a.href = contentHref(topic.local);
+                            li.appendChild(a);
+                            results.appendChild(li);
+                        });
+                    });
+                    toc.style.display = 'none';
+                });
+        }
+        
         function toggleFolder(element) {
             element.classList.toggle('collapsed');
+            // folders left empty in large tables of contents are fetched
+            if (element.dataset.node && !element.dataset.loaded) {
+                element.dataset.loaded = 'true';
+                fetch('__toc.json?node=' + element.dataset.node)
+                    .then(function(response) { return response.ok ? response.json() : null; })
+                    .then(function(node) {
+                        if (node) {
+                            element.after(tocList(node.children));
+                        } else {
+                            delete element.dataset.loaded;
+                        }
+                    });
+            }
+        }
+        
+        // Build the list for nodes returned by /__toc.json, like the server does
+        function tocList(nodes) {
+            const ul = document.createElement('ul');
+            nodes.forEach(function(node) {
+                if (!node.name) {
+                    return;
+                }
+                const li = document.createElement('li');
+                if (node.local) {
+                    const a = document.createElement('a');
+                    a.textContent = node.name;
+                    a.href = contentHref(node.local);
+                    li.appendChild(a);
+                }
+                if (!node.local || node.children === null) {
+                    const folder = document.createElement('span');
+                    folder.className = 'folder';
+                    if (!node.local) {
+                        folder.textContent = node.name;
+                    }
+                    if (node.children === null) {
+                        folder.classList.add('collapsed');
+                        folder.dataset.node = node.id;
+                    }
+                    folder.addEventListener('click', function() {
+                        toggleFolder(this);
+                    });
+                    li.appendChild(folder);
+                }
+                if (node.children && node.children.length) {
+                    li.appendChild(tocList(node.children));
+                }
+                ul.appendChild(li);
+            });
+            return ul;
         }
         
         // Add click handlers to folders when page loads
@@ -321,9 +1581,9 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
             if (firstLink) {
                 // Extract the path from the href
                 const href = firstLink.getAttribute('href');
-                const match = href.match(/loadContent\\('([^']+)'\\)/);
+                const match = href.match(/^javascript:loadContent\\((.*)\\)$/);
                 if (match) {
-                    const firstPath = match[1];
+                    const firstPath = JSON.parse(decodeURIComponent(match[1]));
                     // Uncomment the next line to auto-load the first page
                     // loadContent(firstPath);
                 }
@@ -334,9 +1594,14 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
 <body>
     <div class="sidebar">
         <h2>Table of Contents</h2>
+        <input type="search" placeholder="Search index" oninput="searchIndex(this.value)">
+        <ul id="indexResults"></ul>
+        <div id="toc">
 """
-        html += self.generate_toc_html(hhc_obj)
+        depth = inline_depth(hhc_obj, TOC_INLINE_NODES)
+        html += self.generate_toc_html(hhc_obj, depth)
         html += """
+        </div>
     </div>
     <div class="content">
         <div class="welcome-text">
@@ -349,41 +1614,668 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
 </html>"""
         return html
 
-    def generate_toc_html(self, node):
-        """Recursively generate TOC HTML"""
-        html = "<ul>"
+    def generate_toc_html(self, node, depth=None):
+        """Generate TOC HTML, depth levels deep if given. Folders below that
+        are left empty, to be fetched from /__toc.json when opened."""
+        parts = []
+        self._append_toc_html(node, depth, parts)
+        return "".join(parts)
+
+    def _append_toc_html(self, node, depth, parts):
+        parts.append("<ul>")
         for child in node.children:
-            name = (
-                child.name.decode(self.server.chm_file.encoding)
-                if hasattr(child.name, "decode")
-                else str(child.name)
-            )
+            name = self.node_name(child)
 
             # Skip items with no name
             if not name or name == "None":
                 continue
+            name = html_escape(str(name), quote=False)
 
-            html += "<li>"
+            parts.append("<li>")
+            children = child.is_inner_node and child.children
+            # children beyond depth are fetched by node id
+            more = children and depth is not None and depth <= 1
+            folder = '<span class="folder">'
+            if more:
+                folder = f'<span class="folder collapsed" data-node="{child.id}">'
 
             # If it has a local link, make it clickable
-            if hasattr(child, "local") and child.local:
-                html += (
-                    f"<a href=\"javascript:loadContent('{child.local}')\">{name}</a>"
-                )
+            if child.local:
+                href = html_escape(content_href(child.local))
+                parts.append(f'<a href="{href}">{name}</a>')
+                if more:
+                    parts.append(folder + "</span>")
             else:
-                # If it's a folder (has children but no local link), style as folder
-                if hasattr(child, "children") and child.children:
-                    html += f'<span class="folder">{name}</span>'
-                else:
-                    html += f'<span class="folder">{name}</span>'
+                # a folder, or an item that links nowhere
+                parts.append(f"{folder}{name}</span>")
 
             # Add nested children
-            if hasattr(child, "children") and child.children:
-                html += self.generate_toc_html(child)
+            if children and not more:
+                self._append_toc_html(child, depth and depth - 1, parts)
 
-            html += "</li>"
-        html += "</ul>"
-        return html
+            parts.append("</li>")
+        parts.append("</ul>")
+
+
+def references(path, html, max_links):
+    """Return (name, resource) for the entries the page at path refers to:
+    its images, style sheets, scripts and frames, which are resources, and
+    up to max_links pages it links to. Resources come first."""
+    base = posixpath.dirname(path)
+    found = {}
+    links = 0
+    for match in _REFERENCE.finditer(html.decode("utf-8", "replace")):
+        tag, attribute = match.group(1).lower(), match.group(2).lower()
+        resource = attribute == "src" or tag == "link"
+        if not resource and tag not in ("a", "area"):
+            continue
+        value = next(group for group in match.group(3, 4, 5) if group is not None)
+        value = value.split("#")[0].split("?")[0].strip()
+        # skip other sites and schemes such as javascript: and ms-its:
+        if not value or ":" in value:
+            continue
+        if value.startswith("/"):
+            name = posixpath.normpath(unquote(value)).lstrip("/")
+        else:
+            name = posixpath.normpath(posixpath.join(base, unquote(value)))
+        if name in found or name == "." or name.startswith(".."):
+            continue
+        if not resource:
+            if links >= max_links:
+                continue
+            links += 1
+        found[name] = resource
+    return sorted(found.items(), key=lambda item: not item[1])
+
+
+class Prefetcher:
+    """Reads what the pages sites send refer to into the caches of the
+    site ahead of the browser asking for it: the resources of a page into
+    the response cache, and up to max_links of the pages it links to into
+    the block cache. Reading is done in a background thread, one entry at
+    a time and only while no response is being loaded, and at PREFETCH
+    priority with a scheduler, so requests do not wait for it. Up to
+    max_queue entries wait to be read; beyond that, new ones are dropped."""
+
+    # entries read lately, not to be read again
+    RECENT = 1024
+
+    def __init__(self, max_queue=256, max_links=8):
+        self.max_links = max_links
+        self.prefetched = 0
+        self._queue = queue.Queue(max_queue)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = 0
+        self._idle = threading.Condition()
+        self._closed = False
+        thread = threading.Thread(target=self._run, name="chm-prefetch")
+        thread.daemon = True
+        thread.start()
+
+    def queued(self):
+        "Return the number of entries waiting to be read"
+        return self._queue.qsize()
+
+    @contextmanager
+    def loading(self):
+        "Keep prefetching paused while a response is being loaded"
+        with self._idle:
+            self._loading += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._loading -= 1
+                if not self._loading:
+                    self._idle.notify_all()
+
+    def page_loaded(self, site, path, body):
+        "Queue what the page at path of site refers to"
+        for name, resource in references(path, body, self.max_links):
+            key = (site.filename, name)
+            with self._lock:
+                if key in self._recent:
+                    continue
+                self._recent[key] = True
+                if len(self._recent) > self.RECENT:
+                    self._recent.popitem(last=False)
+            try:
+                self._queue.put_nowait((site, name, resource))
+            except queue.Full:
+                break
+
+    def close(self):
+        self._closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while not self._closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            with self._idle:
+                while self._loading:
+                    self._idle.wait()
+            site, name, resource = item
+            try:
+                if site.scheduler is not None:
+                    with site.scheduler.priority(PREFETCH):
+                        site.prefetch(name, resource)
+                else:
+                    site.prefetch(name, resource)
+                self.prefetched += 1
+            except Exception:
+                # the site may have been closed since, or the scheduler has
+                # too much prefetching waiting already
+                pass
+
+
+class SiteLibrary(Library):
+    """A Library of CHMSites instead of bare CHM files. The sites share its
+    block cache, response_cache, decode_pool, stats and access_profile."""
+
+    def __init__(
+        self,
+        response_cache=None,
+        decode_pool=None,
+        prefetcher=None,
+        scheduler=None,
+        admission=None,
+        stats=None,
+        access_profile=None,
+        **options,
+    ):
+        self.response_cache = response_cache
+        self.decode_pool = decode_pool
+        self.prefetcher = prefetcher
+        self.scheduler = scheduler
+        self.admission = admission
+        self.stats = stats
+        self.access_profile = access_profile
+        super().__init__(**options)
+
+    def _open(self, path):
+        return CHMSite(
+            path,
+            use_sidecar=self.use_sidecar,
+            content_cache=self.content_cache,
+            block_cache=self.block_cache,
+            response_cache=self.response_cache,
+            decode_pool=self.decode_pool,
+            shared=True,
+            library=self,
+            prefetcher=self.prefetcher,
+            scheduler=self.scheduler,
+            admission=self.admission,
+            stats=self.stats,
+            access_profile=self.access_profile,
+        )
+
+
+class HeldBody:
+    """A streamed body that runs on_close once it is closed"""
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            close = getattr(self._body, "close", None)
+            if close is not None:
+                close()
+            on_close()
+
+
+class LibrarySite:
+    """Answers HTTP requests for every CHM file in a directory, each served
+    under /<name>/ where name is its file name without the extension; / is
+    a catalogue of them.
+
+    Files are opened on first use. At most max_open are kept open, closing
+    the least recently used one first, and those without a request for
+    idle_timeout seconds are closed. They all share block_cache (or one of
+    cache_bytes), the response_cache and one pool of decode_processes
+    worker processes, and the prefetcher, scheduler and admission control if
+    any. /__stats reports on all of them, and admin requests are answered
+    with an admin_token, as for a CHMSite."""
+
+    def __init__(
+        self,
+        directory,
+        max_open=64,
+        idle_timeout=300,
+        use_sidecar=False,
+        content_cache=None,
+        block_cache=None,
+        cache_bytes=64 * 1024 * 1024,
+        decode_processes=0,
+        response_cache=None,
+        prefetcher=None,
+        scheduler=None,
+        admission=None,
+        stats=None,
+        admin_token=None,
+        access_profile=None,
+    ):
+        self.directory = directory
+        self.admin_token = admin_token
+        self.response_cache = response_cache
+        self.content_cache = content_cache
+        self.prefetcher = prefetcher
+        self.admission = admission
+        self.stats = stats if stats is not None else ServerStats()
+        add_gauges(self.stats, scheduler, prefetcher)
+        self._decode_pool = None
+        if decode_processes:
+            self._decode_pool = DecodePool(
+                decode_processes,
+                cache_bytes=getattr(block_cache, "max_bytes", 32 * 1024 * 1024),
+                block_cache=block_cache,
+                use_sidecar=use_sidecar,
+            )
+        self.library = SiteLibrary(
+            response_cache=response_cache,
+            decode_pool=self._decode_pool,
+            prefetcher=prefetcher,
+            scheduler=scheduler,
+            admission=admission,
+            stats=self.stats,
+            access_profile=access_profile,
+            max_open=max_open,
+            cache_bytes=cache_bytes,
+            idle_timeout=idle_timeout,
+            block_cache=block_cache,
+            use_sidecar=use_sidecar,
+            content_cache=content_cache,
+        )
+        self._archives = {}
+        self.scan()
+
+    def scan(self):
+        """Look for CHM files in the directory again. Returns a dict of their
+        paths by name."""
+        archives = {}
+        for filename in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(filename)
+            path = os.path.join(self.directory, filename)
+            if extension.lower() == ".chm" and os.path.isfile(path):
+                archives.setdefault(name, path)
+        self._archives = archives
+        return archives
+
+    def find(self, name):
+        "Return the path of the CHM file served under name, or None"
+        path = self._archives.get(name)
+        if path is None:
+            # it may have been added since the last look
+            path = self.scan().get(name)
+        return path
+
+    def respond(self, request):
+        """Return the Response to request, passing requests under /<name>/
+        on to the site for that file. A file that is not open yet is opened
+        by the response's load function."""
+        try:
+            admin = admin_response(self, request)
+            if admin is not None:
+                return admin
+
+            parts = urlsplit(request.target)
+            name, slash, rest = parts.path.lstrip("/").partition("/")
+            if not name:
+                return self.catalogue(request)
+            if name == "__stats" and not slash:
+                return stats_response(request, self.stats_data())
+            path = self.find(unquote(name))
+            if path is None:
+                return error_response(404, f"No such archive: {unquote(name)}")
+            if not slash:
+                # relative links in the index page need the slash
+                response = Response(301)
+                location = f"/{name}/"
+                if parts.query:
+                    location += "?" + parts.query
+                response.headers["Location"] = location
+                return response
+
+            target = "/" + rest
+            if parts.query:
+                target += "?" + parts.query
+            request = Request(request.method, target, request.headers, request.token)
+            if path not in self.library:
+                return Response(load=lambda: self.respond_from(path, request, True))
+            return self.respond_from(path, request)
+        except Exception as e:
+            print(f"Error serving request: {e}")
+            return error_response(500, "Internal server error")
+
+    def stats_data(self):
+        "Return what /__stats reports, for all the files served"
+        data = collect_stats(
+            self.stats,
+            self.response_cache,
+            self.library.block_cache,
+            self.content_cache,
+            self.admission,
+        )
+        names = {path: name for name, path in self._archives.items()}
+        data["archives"] = {
+            names.get(path, path): count
+            for path, count in sorted(self.library.open_counts.items())
+        }
+        return data
+
+    def warm_entry(self, name, path):
+        "Read entry path of the archive served under name, opening it"
+        archive = self.find(name)
+        if archive is None:
+            return
+        site = self.library.acquire(archive)
+        try:
+            site.warm(path.lstrip("/"), True)
+        finally:
+            self.library.release(archive)
+
+    def respond_from(self, path, request, complete=False):
+        """Return the response of the site for path, which is kept open until
+        the response has been sent"""
+        site = self.library.acquire(path)
+        try:
+            response = site.respond(request)
+        except BaseException:
+            self.library.release(path)
+            raise
+        if complete:
+            response = site.complete(response)
+        if response.load is None:
+            return self.hold(response, path)
+        return Response(load=lambda: self.hold(site.complete(response), path))
+
+    def hold(self, response, path):
+        "Release the site for path once response is sent"
+        if not response.is_streamed():
+            self.library.release(path)
+        elif isinstance(response.body, FileBody):
+            response.body.on_close = lambda: self.library.release(path)
+        else:
+            response.body = HeldBody(
+                response.body, lambda: self.library.release(path)
+            )
+        return response
+
+    # loading works as for a single file
+    complete = CHMSite.complete
+
+    def catalogue(self, request):
+        "Return a page listing the CHM files served"
+        names = sorted(self.scan(), key=str.lower)
+        items = "".join(
+            f'<li><a href="/{quote(name)}/">{html_escape(name, quote=False)}</a></li>'
+            for name in names
+        )
+        html = f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>CHM Library</title>
+    <meta charset="UTF-8">
+</head>
+<body>
+    <h1>CHM Library</h1>
+    <ul>{items}</ul>
+</body>
+</html>"""
+        body = html.encode("utf-8")
+        response = Response(200, "text/html")
+        response.headers["Vary"] = "Accept-Encoding"
+        if accepts_gzip(request):
+            body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            response.headers["Content-Encoding"] = "gzip"
+        response.body = body
+        return response
+
+    def close(self):
+        self.library.close()
+        report_response_cache(self.response_cache)
+        report_admission(self.admission)
+        if self._decode_pool:
+            self._decode_pool.close()
+
+
+def make_site(path, hhc_callback=None, max_open=64, idle_timeout=300, **options):
+    """Return a LibrarySite serving the CHM files in path if it is a
+    directory, or else a CHMSite serving the CHM file at path. options are
+    passed on to the site."""
+    if os.path.isdir(path):
+        return LibrarySite(path, max_open=max_open, idle_timeout=idle_timeout, **options)
+    return CHMSite(path, hhc_callback, **options)
+
+
+def connection_closed(sock):
+    """Return whether the client on sock has gone, without waiting: the
+    connection has failed, or the client has closed it. A client that shuts
+    down its side once it has sent its request cannot be told apart and
+    counts as gone too. Over TLS, only failures and hang-ups tell, and where
+    poll is not available, only failed writes."""
+    if not hasattr(select, "poll"):
+        return False
+    try:
+        poller = select.poll()
+        # hang-ups and errors are reported without being asked for
+        poller.register(sock, select.POLLIN)
+        for fd, events in poller.poll(0):
+            if events & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                return True
+            if events & select.POLLIN and is_plain_socket(sock):
+                # the end of the input rather than another request; readable,
+                # so this does not wait
+                return sock.recv(1, socket.MSG_PEEK) == b""
+        return False
+    except (ValueError, OSError):
+        # reset, or closed already
+        return True
+
+
+class CHMRequestHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests; pipelined requests are read
+    # from the buffered input one after the other
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; with Nagle's algorithm the
+    # body of a response on a reused connection waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # how long an idle connection is kept open
+        self.timeout = self.server.keepalive_timeout
+        self.requests_handled = 0
+        super().setup()
+
+    def handle_one_request(self):
+        if self.requests_handled and not self.wait_for_request():
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def wait_for_request(self):
+        """Wait for the next request on a connection kept open, giving up the
+        thread as soon as other connections wait for one. Returns whether
+        there is something to read."""
+        deadline = time.monotonic() + self.timeout
+        with _Selector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ)
+            while True:
+                # pipelined requests may have been read into the buffer already
+                self.connection.settimeout(0)
+                try:
+                    if self.rfile.peek(1):
+                        return True
+                except OSError:
+                    return False
+                finally:
+                    self.connection.settimeout(self.timeout)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.server.keep_alive_allowed():
+                    return False
+                if selector.select(min(remaining, IDLE_CHECK_SECONDS)):
+                    return True
+
+    def do_HEAD(self):
+        """Handle HEAD requests like GET requests but without sending content"""
+        self.do_GET()
+
+    def do_GET(self):
+        started = time.perf_counter()
+        # requests for CHM content have no body, skip over any that is sent
+        if "Transfer-Encoding" in self.headers:
+            self.close_connection = True
+        elif self.headers.get("Content-Length"):
+            try:
+                length = int(self.headers["Content-Length"])
+            except ValueError:
+                length = -1
+            if not 0 <= length <= MAX_BODY_BYTES:
+                self.send_error(400)
+                return
+            self.rfile.read(length)
+
+        site = self.server.site
+        access_log = self.server.access_log
+        timing = None
+        if access_log is not None and access_log.sampled():
+            timing = RequestTiming(site.stats.decode)
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        # stop decoding for a client that has gone
+        token = CancelToken(lambda: connection_closed(self.connection))
+        request = Request(self.command, self.path, headers, token)
+        with active(timing):
+            response = site.respond(request)
+            loaded = response.load is not None
+            if loaded:
+                response = site.complete(response)
+        if loaded and token.is_cancelled():
+            response.close()
+            self.close_connection = True
+            return
+        self.send(response, timing)
+        seconds = time.perf_counter() - started
+        site.stats.request_done(
+            response.headers.get("Content-Type"),
+            response.status,
+            seconds,
+            response.bytes_sent,
+        )
+        if access_log is not None:
+            access_log.log(
+                self.client_address[0],
+                self.command,
+                self.path,
+                response,
+                seconds,
+                timing,
+            )
+
+    def send(self, response, timing=None):
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.requests_handled += 1
+        if (
+            self.requests_handled >= self.server.max_keepalive_requests
+            or not self.server.keep_alive_allowed()
+        ):
+            self.close_connection = True
+        length = response.get_length()
+        chunked = False
+        if response.status == 304:
+            pass
+        elif length is not None:
+            self.send_header("Content-Length", str(length))
+        elif self.request_version != "HTTP/1.0" and self.protocol_version != "HTTP/1.0":
+            self.send_header("Transfer-Encoding", "chunked")
+            chunked = True
+        else:
+            # the body ends when the connection does
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
+        try:
+            self.end_headers()
+        except OSError:
+            # the client has gone
+            self.close_connection = True
+            response.close()
+            return
+
+        # Only send content for GET requests, not HEAD requests
+        if self.command == "HEAD" or response.status == 304:
+            response.close()
+        elif not response.is_streamed():
+            try:
+                with timed(timing, "write"):
+                    self.wfile.write(response.body)
+            except OSError:
+                self.close_connection = True
+                return
+            response.bytes_sent = len(response.body)
+        elif (
+            isinstance(response.body, FileBody)
+            and response.body.can_sendfile()
+            and is_plain_socket(self.connection)
+        ):
+            with timed(timing, "write"):
+                response.bytes_sent = self.send_file(response.body)
+        else:
+            self.send_stream(response, chunked, timing)
+
+    def send_file(self, body):
+        """Send body from its file without copying it through Python. Returns
+        the number of bytes sent."""
+        try:
+            return self.connection.sendfile(body.file, body.offset, body.length)
+        except OSError:
+            self.close_connection = True
+            return 0
+        finally:
+            body.close()
+
+    def send_stream(self, response, chunked, timing=None):
+        """Write a streamed body, producing each chunk with timing active
+        once the previous one is written"""
+        chunks = iter(response.body)
+        try:
+            while True:
+                with active(timing):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                with timed(timing, "write"):
+                    if chunked:
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    else:
+                        self.wfile.write(chunk)
+                response.bytes_sent += len(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (OSError, Cancelled):
+            self.close_connection = True
+        except Exception as e:
+            # too late for an error response, cut the body short instead
+            print(f"Error streaming response: {e}")
+            self.close_connection = True
+        finally:
+            response.close()
 
     def log_message(self, format, *args):
         """Override to reduce console spam"""
@@ -393,34 +2285,105 @@ class CHMRequestHandler(BaseHTTPRequestHandler):
 
 
 class CHMHTTPServer(HTTPServer):
-    def __init__(self, server_address, chm_filename, hhc_callback=None):
-        try:
-            self.chm_file = chm(chm_filename)
-        except Exception as e:
-            print(f"Error opening CHM file: {e}")
-            if hhc_callback:
-                hhc_callback(error=ERR_INVALID_CHM)
-            raise
+    """Serves one CHM file, or a directory of them. Connections are handled
+    by a pool of max_threads threads, with up to max_queue accepted
+    connections waiting for a free thread; beyond that, connections wait in
+    the listen backlog. With max_threads=0, requests are handled one at a
+    time.
 
-        # Process HHC callback if provided
-        if hhc_callback:
-            hhc_file = self.chm_file.get_hhc()
-            if hhc_file:
-                contents = hhc.parse(hhc_file.get_content())
-                encoding = self.chm_file.encoding
-                hhc_callback(chm_filename, contents, encoding)
-            else:
-                self.chm_file.close()
-                hhc_callback(error=ERR_NO_HHC)
-                raise Exception("No HHC file found")
+    Connections are kept open for up to max_keepalive_requests requests,
+    and closed after keepalive_timeout seconds without one. An idle
+    connection holds a thread, so while connections are waiting for one,
+    idle connections and those finishing a response are closed. With an
+    access_log (see accesslog.AccessLog), requests are logged there. Other
+    options are passed on to make_site."""
+
+    # browsers open many connections at once, the default backlog is 5
+    request_queue_size = 64
+
+    def __init__(
+        self,
+        server_address,
+        chm_filename,
+        hhc_callback=None,
+        max_threads=8,
+        max_queue=32,
+        keepalive_timeout=15,
+        max_keepalive_requests=100,
+        access_log=None,
+        **options,
+    ):
+        self.site = make_site(chm_filename, hhc_callback, **options)
+        self.access_log = access_log
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.max_threads = max_threads
+        # open connections, and whether the server is stopping
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._stopping = False
+
+        self._executor = None
+        if max_threads:
+            self._executor = ThreadPoolExecutor(
+                max_threads, thread_name_prefix="chm-server"
+            )
+            self._slots = threading.BoundedSemaphore(max_threads + max_queue)
+            gauges = self.site.stats.gauges
+            gauges["connections_open"] = lambda: len(self._connections)
+            gauges["connections_waiting"] = lambda: max(
+                len(self._connections) - max_threads, 0
+            )
 
         super().__init__(server_address, CHMRequestHandler)
         print(f"CHM server started on http://{server_address[0]}:{server_address[1]}/")
 
+    def process_request(self, request, client_address):
+        """Hand the connection to the thread pool, waiting while it is full"""
+        if self._executor is None:
+            super().process_request(request, client_address)
+            return
+        self._slots.acquire()
+        with self._connections_lock:
+            self._connections.add(request)
+        self._executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._connections_lock:
+                self._connections.discard(request)
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def keep_alive_allowed(self):
+        """Whether a connection may stay open after its current response:
+        not while others wait for a thread, or the server is stopping"""
+        return (
+            self._executor is not None
+            and len(self._connections) <= self.max_threads
+            and not self._stopping
+        )
+
     def shutdown(self):
+        """Stop accepting connections, close the idle ones and wait for the
+        others to finish their response"""
         super().shutdown()
-        if hasattr(self, "chm_file"):
-            self.chm_file.close()
+        self._stopping = True
+        with self._connections_lock:
+            for request in self._connections:
+                # a thread waiting for the next request sees the end of input
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self.server_close()
+        self.site.close()
         print("CHM server stopped")
 
 
@@ -431,8 +2394,6 @@ if __name__ == "__main__":
     if filenames:
         start(filenames.pop())
         # serve chm files for 30 seconds
-        import time
-
         time.sleep(30)
         stop()
     else:
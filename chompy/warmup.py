@@ -0,0 +1,141 @@
+# Copyright 2009 Wayne See
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+from pychmlib.scheduler import BULK
+
+# entries counted at most, beyond which the least read are forgotten
+MAX_TRACKED = 10000
+
+# longest a warmup may take, in seconds, whatever CPU time it used
+MAX_WARMUP_SECONDS = 300
+
+
+class AccessProfile:
+    """Counts the entries sites are asked for, as their access_profile, and
+    keeps the top most asked for in the file at path: saved every
+    save_interval seconds and on close. The entries saved by an earlier run
+    are in previous, hottest first, ready for warm_up; their counts are
+    halved and carried on, so the record follows what is read lately."""
+
+    def __init__(self, path, top=200, save_interval=300):
+        self.path = path
+        self.top = top
+        self.previous = load(path)
+        self._counts = Counter()
+        for name, entry, hits in self.previous:
+            if hits // 2:
+                self._counts[(name, entry)] = hits // 2
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if save_interval:
+            thread = threading.Thread(
+                target=self._save_loop, args=(save_interval,), name="chm-profile"
+            )
+            thread.daemon = True
+            thread.start()
+
+    def hit(self, name, entry):
+        "Count a request for entry of the archive served under name"
+        with self._lock:
+            self._counts[(name, entry)] += 1
+            if len(self._counts) > MAX_TRACKED:
+                self._counts = Counter(dict(self._counts.most_common(MAX_TRACKED // 2)))
+
+    def save(self):
+        "Write the top entries to the file, replacing it in one step"
+        with self._lock:
+            hottest = self._counts.most_common(self.top)
+        if not hottest:
+            return
+        data = {
+            "version": 1,
+            "entries": [[name, entry, hits] for (name, entry), hits in hottest],
+        }
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(temporary, self.path)
+
+    def close(self):
+        self._closed.set()
+        self.save()
+
+    def _save_loop(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Error saving access profile: {e}")
+
+
+def load(path):
+    """Return the entries saved in the access profile at path as (name,
+    entry, hits), hottest first; none if there is no usable profile"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != 1:
+            return []
+        return [
+            (str(name), str(entry), int(hits))
+            for name, entry, hits in data["entries"]
+        ]
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return []
+
+
+def warm_up(
+    site, entries, scheduler=None, cpu_budget=30, max_seconds=MAX_WARMUP_SECONDS
+):
+    """Read entries, from load, into the caches of site in a background
+    thread, hottest first, at BULK priority with a scheduler so requests
+    come first. It stops once it has used cpu_budget seconds of CPU time or
+    max_seconds have passed. Returns the thread."""
+    thread = threading.Thread(
+        target=_warm_up,
+        args=(site, entries, scheduler, cpu_budget, max_seconds),
+        name="chm-warmup",
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _warm_up(site, entries, scheduler, cpu_budget, max_seconds):
+    cpu_start = time.thread_time()
+    started = time.monotonic()
+    warmed = 0
+    priority = scheduler.priority(BULK) if scheduler is not None else nullcontext()
+    with priority:
+        for name, entry, hits in entries:
+            if time.thread_time() - cpu_start >= cpu_budget:
+                break
+            if time.monotonic() - started >= max_seconds:
+                break
+            try:
+                site.warm_entry(name, entry)
+                warmed += 1
+            except Exception:
+                # the entry may be gone, or the site closed since
+                pass
+    if warmed:
+        elapsed = time.monotonic() - started
+        print(f"Warmed {warmed} of {len(entries)} entries in {elapsed:.1f} seconds")